@@ -0,0 +1,11 @@
+from django.db import models
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=100)
+    price = models.IntegerField(default=0)
+
+
+class Tag(models.Model):
+    """Only watched, never queried by the views"""
+    name = models.CharField(max_length=100)
@@ -0,0 +1,22 @@
+from django.http import HttpResponse
+from query_optimizer.decorators import track_queries
+from benchapp.models import Item
+
+ITEMS = 100
+
+
+def run_queries(count):
+    total = 0
+    for number in range(count):
+        item = Item.objects.filter(pk=number % ITEMS + 1).first()
+        total += item.price if item else 0
+    return HttpResponse(str(total))
+
+
+def items(request, count):
+    return run_queries(count)
+
+
+@track_queries
+def decorated_items(request, count):
+    return run_queries(count)
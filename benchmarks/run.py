@@ -0,0 +1,218 @@
+"""
+Measure what query capture adds to a request.
+
+Every scenario serves the same view, which runs N single-row queries,
+through the test client: "off" without any capture, the others with the
+middleware or the decorator in a given configuration. Latency is timed with
+time.perf_counter over `--repeat` requests after `--warmup` ones, and the
+peak memory allocated during a request is measured separately with
+tracemalloc, which would slow the timed requests down.
+
+Overheads are reported relative to "off", so results from different machines
+can be compared with the stored baseline:
+
+    python benchmarks/run.py                       # compare with benchmarks/baseline.json
+    python benchmarks/run.py --update-baseline     # store the new results as the baseline
+    BENCH_DB_ENGINE=django.db.backends.postgresql BENCH_DB_NAME=bench python benchmarks/run.py
+
+The exit status is 1 when a scenario regressed by more than `--tolerance`.
+"""
+from pathlib import Path
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path[:0] = [str(BENCH_DIR), str(BENCH_DIR.parent)]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from benchapp.models import Item  # noqa: E402
+from query_optimizer import models as qo_models  # noqa: E402
+
+MIDDLEWARE = ['query_optimizer.middleware.QueryCaptureMiddleware']
+
+# name: (middleware, view path, config overrides)
+SCENARIOS = {
+    'off': ([], 'items', {}),
+    'middleware': (MIDDLEWARE, 'items', {}),
+    'stack_off': (MIDDLEWARE, 'items', {'capture_stack': False}),
+    'stack_all': (MIDDLEWARE, 'items', {'stack_sample_rate': 1.0}),
+    'watched_models': (MIDDLEWARE, 'items', {'watched_models': ['benchapp.Tag']}),
+    'sampled': (MIDDLEWARE, 'items', {'sample_rate': 0.1}),
+    'decorator': ([], 'decorated', {}),
+}
+# Stack traces are kept: their ids are cached by the stack interner
+CAPTURED_MODELS = ['QueryRecord', 'QueryPattern', 'QueryRollup', 'PatternRollup', 'NPlusOneFinding', 'BudgetViolation']
+
+
+def setup_database():
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    if not Item.objects.exists():
+        Item.objects.bulk_create([Item(name=f"item {number}", price=number) for number in range(1, 101)])
+
+
+def clear_captures():
+    """Keep the capture tables the same size from one scenario to the next"""
+    for name in CAPTURED_MODELS:
+        getattr(qo_models, name).objects.all().delete()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def measure(name, count, repeat, warmup, memory_runs):
+    middleware, view, overrides = SCENARIOS[name]
+    config = dict(settings.QUERY_OPTIMIZER_CONFIG, **overrides)
+    url = f"/{view}/{count}/"
+    with override_settings(MIDDLEWARE=middleware, QUERY_OPTIMIZER_CONFIG=config):
+        client = Client()
+        for _ in range(warmup):
+            client.get(url)
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get(url)
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code} in the {name} scenario")
+
+        peaks = []
+        tracemalloc.start()
+        try:
+            for _ in range(memory_runs):
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                client.get(url)
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        finally:
+            tracemalloc.stop()
+
+    clear_captures()
+    return {
+        'scenario': name,
+        'queries': count,
+        'median_ms': statistics.median(timings) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'peak_kib': max(peaks) / 1024,
+    }
+
+
+def add_overheads(results):
+    """Overhead of each scenario over "off" with the same number of queries"""
+    off = {result['queries']: result for result in results if result['scenario'] == 'off'}
+    for result in results:
+        base = off.get(result['queries'])
+        if base is None:
+            continue
+        overhead = result['median_ms'] - base['median_ms']
+        result['overhead_ms'] = overhead
+        result['overhead_ratio'] = overhead / base['median_ms'] if base['median_ms'] else 0.0
+        result['overhead_per_query_us'] = overhead * 1000 / result['queries']
+        result['extra_peak_kib'] = result['peak_kib'] - base['peak_kib']
+
+
+def compare(results, baseline, tolerance, min_ratio):
+    """
+    Regressions against the baseline, matched on scenario and query count.
+
+    The overhead ratio (relative to "off" on the same machine) regresses when
+    it grows by more than `tolerance` of its baseline value and by more than
+    `min_ratio`, below which run-to-run noise dominates. Extra peak memory is
+    compared the same way.
+    """
+    expected = {(row['scenario'], row['queries']): row for row in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = expected.get((result['scenario'], result['queries']))
+        if base is None or result['scenario'] == 'off':
+            continue
+        ratio, base_ratio = result['overhead_ratio'], base['overhead_ratio']
+        if ratio - base_ratio > max(abs(base_ratio) * tolerance, min_ratio):
+            regressions.append(f"{result['scenario']} with {result['queries']} queries: overhead "
+                               f"{ratio:.1%} of the request, baseline {base_ratio:.1%}")
+        memory, base_memory = result['extra_peak_kib'], base['extra_peak_kib']
+        if memory - base_memory > max(abs(base_memory) * tolerance, 64):
+            regressions.append(f"{result['scenario']} with {result['queries']} queries: {memory:.0f} KiB "
+                               f"of extra peak memory, baseline {base_memory:.0f} KiB")
+    return regressions
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'platform': platform.platform(),
+    }
+
+
+def print_table(results):
+    print(f"{'scenario':<16}{'queries':>8}{'median ms':>12}{'p95 ms':>10}{'overhead':>10}{'us/query':>10}{'peak KiB':>10}")
+    for result in results:
+        print(f"{result['scenario']:<16}{result['queries']:>8}{result['median_ms']:>12.2f}{result['p95_ms']:>10.2f}"
+              f"{result['overhead_ratio']:>10.1%}{result['overhead_per_query_us']:>10.1f}{result['peak_kib']:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the capture overhead of query_optimizer")
+    parser.add_argument('--queries', type=int, nargs='+', default=[10, 100, 1000], help="Queries run per request")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=20, help="Timed requests per scenario")
+    parser.add_argument('--warmup', type=int, default=3, help="Untimed requests before the timed ones")
+    parser.add_argument('--memory-runs', type=int, default=3, help="Requests traced with tracemalloc")
+    parser.add_argument('--output', default=str(BENCH_DIR / 'results.json'), help="Where to write the results")
+    parser.add_argument('--baseline', default=str(BENCH_DIR / 'baseline.json'))
+    parser.add_argument('--update-baseline', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed relative growth of an overhead")
+    parser.add_argument('--min-ratio', type=float, default=0.1, help="Overhead growth always ignored, as a share of the request")
+    options = parser.parse_args(argv)
+
+    scenarios = options.scenarios if 'off' in options.scenarios else ['off'] + options.scenarios
+    setup_database()
+    clear_captures()
+
+    results = []
+    for count in options.queries:
+        for name in scenarios:
+            results.append(measure(name, count, options.repeat, options.warmup, options.memory_runs))
+    add_overheads(results)
+    print_table(results)
+
+    report = {'environment': environment(), 'options': {'repeat': options.repeat, 'warmup': options.warmup}, 'results': results}
+    Path(options.output).write_text(json.dumps(report, indent=2) + '\n')
+
+    if options.update_baseline:
+        Path(options.baseline).write_text(json.dumps(report, indent=2) + '\n')
+        print(f"Stored the baseline in {options.baseline}")
+        return 0
+
+    if not Path(options.baseline).exists():
+        print(f"No baseline at {options.baseline}, run with --update-baseline to store one")
+        return 0
+
+    regressions = compare(results, json.loads(Path(options.baseline).read_text()), options.tolerance, options.min_ratio)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regression against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+"""Settings of the benchmark project; BENCH_DB_* environment variables select the database"""
+import os
+
+SECRET_KEY = 'benchmark'
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+USE_TZ = True
+ROOT_URLCONF = 'urls'
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'query_optimizer',
+    'benchapp',
+]
+
+# Set per scenario by run.py
+MIDDLEWARE = []
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('BENCH_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('BENCH_DB_NAME', os.path.join(os.path.dirname(__file__), 'bench.sqlite3')),
+        'USER': os.environ.get('BENCH_DB_USER', ''),
+        'PASSWORD': os.environ.get('BENCH_DB_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_DB_HOST', ''),
+        'PORT': os.environ.get('BENCH_DB_PORT', ''),
+    }
+}
+
+QUERY_OPTIMIZER_CONFIG = {
+    'provider': 'openai',
+    'model': 'gpt-4o-mini',
+    'api_key': 'benchmark',
+}
+
+# N+1 warnings would be logged on every request
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'loggers': {'query_optimizer': {'level': 'ERROR'}},
+}
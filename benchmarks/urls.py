@@ -0,0 +1,7 @@
+from django.urls import path
+from benchapp import views
+
+urlpatterns = [
+    path('items/<int:count>/', views.items),
+    path('decorated/<int:count>/', views.decorated_items),
+]
@@ -0,0 +1,26 @@
+"""
+Run the Django test cases of query_optimizer/tests.py with plain pytest.
+
+The test databases are created once for the session, as Django's test
+runner would do.
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+
+def pytest_configure(config):
+    from django.test.utils import setup_databases, setup_test_environment
+
+    django.setup()
+    setup_test_environment()
+    config._query_optimizer_databases = setup_databases(verbosity=0, interactive=False)
+
+
+def pytest_unconfigure(config):
+    from django.test.utils import teardown_databases, teardown_test_environment
+
+    teardown_databases(config._query_optimizer_databases, verbosity=0)
+    teardown_test_environment()
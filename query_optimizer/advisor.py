@@ -0,0 +1,351 @@
+from django.apps import apps
+from django.db import DatabaseError, connections, models, transaction
+from query_optimizer.models import QueryPattern
+from query_optimizer.plans import PlanCollector, estimate_rows, is_explainable
+from query_optimizer.sinks import capture_alias, get_config
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+APP_LABEL = 'query_optimizer'
+WHAT_IF_VENDORS = ['postgresql', 'sqlite']
+
+IDENTIFIER = r'"?([\w$]+)"?'
+COLUMN = rf'{IDENTIFIER}\.{IDENTIFIER}'
+TABLE_REF_RE = re.compile(
+    rf'\b(?:FROM|JOIN)\s+(?:"?[\w$]+"?\.)?{IDENTIFIER}'
+    r'(?:\s+(?:AS\s+)?(?!(?:ON|WHERE|INNER|LEFT|RIGHT|FULL|CROSS|JOIN|GROUP|ORDER|LIMIT|HAVING|UNION|USING)\b)"?([\w$]+)"?)?',
+    re.I,
+)
+CLAUSE_RE = re.compile(r'\b(WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|OFFSET|UNION|FOR\s+UPDATE)\b', re.I)
+PREDICATE_RE = re.compile(rf'{COLUMN}\s*(<>|!=|<=|>=|=|<|>|\bIN\b|\bIS\s+NULL\b|\bBETWEEN\b)', re.I)
+JOIN_ON_RE = re.compile(rf'\bON\s*\(?\s*{COLUMN}\s*=\s*{COLUMN}', re.I)
+ORDER_COLUMN_RE = re.compile(rf'{COLUMN}(?:\s+(ASC|DESC))?', re.I)
+EQUALITY_OPERATORS = {'=', 'IN', 'IS NULL'}
+RANGE_OPERATORS = {'<', '>', '<=', '>=', 'BETWEEN'}
+
+
+class QueryShape:
+    """The indexable columns of one statement: equality and range filters, join keys and sort order per table"""
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.tables = {}
+        for table, alias in TABLE_REF_RE.findall(sql):
+            self.tables[alias or table] = table
+            self.tables.setdefault(table, table)
+        self.equality = {}
+        self.range = {}
+        self.joins = {}
+        self.order = {}
+        self.has_limit = False
+        self.parse()
+
+    def clauses(self):
+        """{keyword: text} of the top-level clauses, keywords upper-cased and single-spaced"""
+        found = {}
+        matches = list(CLAUSE_RE.finditer(self.sql))
+        for number, match in enumerate(matches):
+            end = matches[number + 1].start() if number + 1 < len(matches) else len(self.sql)
+            found.setdefault(' '.join(match.group(1).upper().split()), self.sql[match.end():end])
+        return found
+
+    def add(self, columns, alias, column, value=None):
+        table = self.tables.get(alias)
+        if table is None:
+            return
+        values = columns.setdefault(table, [])
+        entry = column if value is None else (column, value)
+        if entry not in values:
+            values.append(entry)
+
+    def parse(self):
+        clauses = self.clauses()
+        self.has_limit = 'LIMIT' in clauses
+
+        for alias, column, operator in PREDICATE_RE.findall(clauses.get('WHERE', '')):
+            operator = ' '.join(operator.upper().split())
+            if operator in EQUALITY_OPERATORS:
+                self.add(self.equality, alias, column)
+            elif operator in RANGE_OPERATORS:
+                self.add(self.range, alias, column)
+
+        for left_alias, left, right_alias, right in JOIN_ON_RE.findall(self.sql):
+            self.add(self.joins, left_alias, left)
+            self.add(self.joins, right_alias, right)
+
+        for alias, column, direction in ORDER_COLUMN_RE.findall(clauses.get('ORDER BY', '')):
+            self.add(self.order, alias, column, direction.upper() == 'DESC')
+
+    def candidates(self, max_columns=3):
+        """
+        Column lists worth an index, per table, in equality, sort, range order.
+
+        Sort columns are only added when the whole ORDER BY is on the table
+        and no range filter comes before them; an index on the sort columns
+        alone is proposed for filterless queries with a LIMIT.
+        """
+        found = []
+        tables = set(self.equality) | set(self.range) | set(self.order) | set(self.joins)
+        for table in sorted(tables):
+            equality = [(column, False) for column in self.equality.get(table, [])]
+            ranges = [(column, False) for column in self.range.get(table, []) if column not in self.equality.get(table, [])]
+            order = self.order.get(table, [])
+            order_only_here = order and len(self.order) == 1
+
+            columns = list(equality)
+            if order_only_here and not ranges:
+                columns += [entry for entry in order if entry[0] not in {column for column, desc in columns}]
+            columns += ranges[:1]
+            if columns and (equality or ranges):
+                found.append((table, tuple(columns[:max_columns])))
+            elif order_only_here and self.has_limit and len(self.tables) == 1:
+                found.append((table, tuple(order[:max_columns])))
+
+            for column in self.joins.get(table, []):
+                found.append((table, ((column, False),)))
+        return found
+
+
+class IndexCandidate:
+    """A proposed index and the captured workload it would serve"""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        # fingerprint: (sample query, estimated total time)
+        self.fingerprints = {}
+        self.benefit = 0.0
+        self.rows = None
+        self.extends = None
+        self.model = None
+        self.index = None
+        self.what_if = None
+
+    def serve(self, fingerprint, sample_query, duration):
+        self.fingerprints.setdefault(fingerprint, (sample_query, duration))
+
+    @property
+    def served_time(self):
+        return sum(duration for sample, duration in self.fingerprints.values())
+
+    @property
+    def column_names(self):
+        return [column for column, desc in self.columns]
+
+    def sql(self, connection):
+        """CREATE INDEX statement for the candidate"""
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(column) + (' DESC' if desc else '') for column, desc in self.columns)
+        name = self.index.name if self.index is not None else f"{self.table}_{'_'.join(self.column_names)}_idx"[:30]
+        return f"CREATE INDEX {quote(name)} ON {quote(self.table)} ({columns})"
+
+    def meta_snippet(self):
+        """The models.Index to add to the model's Meta.indexes"""
+        if self.index is None:
+            return None
+        fields = ', '.join(repr(field) for field in self.index.fields)
+        return f"models.Index(fields=[{fields}], name={self.index.name!r})"
+
+    def migration_snippet(self):
+        """An AddIndex operation creating the index in a migration of the model's app"""
+        if self.index is None:
+            return None
+        return (
+            f"migrations.AddIndex(\n"
+            f"    model_name={self.model._meta.model_name!r},\n"
+            f"    index={self.meta_snippet()},\n"
+            f")"
+        )
+
+    def as_dict(self):
+        return {
+            'table': self.table,
+            'columns': [f"-{column}" if desc else column for column, desc in self.columns],
+            'model': self.model._meta.label if self.model is not None else None,
+            'benefit': self.benefit,
+            'served_time': self.served_time,
+            'rows': self.rows,
+            'extends': self.extends,
+            'fingerprints': list(self.fingerprints),
+            'meta': self.meta_snippet(),
+            'migration': self.migration_snippet(),
+            'what_if': self.what_if,
+        }
+
+
+class IndexAdvisor:
+    """
+    Proposes indexes for the captured workload.
+
+    The statements of the `max_patterns` QueryPattern rows with the most
+    estimated total time are parsed for the columns they filter, join and
+    sort on, in the tables of the `using` database. Candidates are weighted
+    by the time of the patterns they serve, merged when one is a prefix of
+    another, and dropped when an existing index (from
+    `connection.introspection`) already starts with the same columns or the
+    table has fewer than `min_rows` rows. A candidate that only extends an
+    existing index counts for half of its time.
+
+    what_if() checks a candidate on a scratch database: the index is created
+    inside a transaction, the served statements are explained before and
+    after, and the transaction is rolled back.
+    """
+
+    def __init__(self, using='default', config=None, min_rows=None, max_patterns=None, max_columns=None):
+        config = config if config is not None else get_config()
+        self.using = using
+        self.connection = connections[using]
+        self.min_rows = min_rows if min_rows is not None else config.get('advisor_min_rows', 1000)
+        self.max_patterns = max_patterns or config.get('advisor_max_patterns', 500)
+        self.max_columns = max_columns or config.get('advisor_max_columns', 3)
+        self.capture_alias = capture_alias(config)
+        self.models = {
+            model._meta.db_table: model
+            for model in apps.get_models(include_auto_created=True)
+            if model._meta.app_label != APP_LABEL
+        }
+        self._constraints = {}
+
+    def workload(self):
+        """(fingerprint, normalized query, sample query, estimated total time) of the heaviest patterns"""
+        totals = {}
+        patterns = (
+            QueryPattern.objects.using(self.capture_alias)
+            .order_by('-estimated_total_duration')
+            .values_list('fingerprint', 'normalized_query', 'sample_query', 'estimated_total_duration')
+        )
+        for fingerprint, normalized, sample, duration in patterns[:self.max_patterns]:
+            # The same statement shape runs in several views
+            if fingerprint in totals:
+                totals[fingerprint][3] += duration
+            else:
+                totals[fingerprint] = [fingerprint, normalized, sample, duration]
+        return list(totals.values())
+
+    def indexes(self, table):
+        """Column lists of the existing indexes, primary key and unique constraints of `table`"""
+        if table not in self._constraints:
+            try:
+                with self.connection.cursor() as cursor:
+                    constraints = self.connection.introspection.get_constraints(cursor, table)
+            except DatabaseError:
+                constraints = {}
+            self._constraints[table] = {
+                name: info['columns'] for name, info in constraints.items()
+                if (info['index'] or info['primary_key'] or info['unique']) and info['columns']
+            }
+        return self._constraints[table]
+
+    def table_rows(self, table):
+        try:
+            with self.connection.cursor() as cursor:
+                return estimate_rows(self.connection, cursor, table)
+        except DatabaseError:
+            return None
+
+    def candidates(self):
+        """Candidates keyed by (table, columns), with the workload each one serves"""
+        tables = set(self.connection.introspection.table_names())
+        found = {}
+        for fingerprint, normalized, sample, duration in self.workload():
+            for table, columns in QueryShape(normalized).candidates(self.max_columns):
+                if table not in tables or table not in self.models:
+                    continue
+                candidate = found.get((table, columns))
+                if candidate is None:
+                    candidate = found[(table, columns)] = IndexCandidate(table, columns)
+                candidate.serve(fingerprint, sample, duration)
+        return self.merge(found)
+
+    def merge(self, found):
+        """Fold every candidate into the longest candidate of its table that starts with its columns"""
+        merged = {}
+        for key in sorted(found, key=lambda key: len(key[1]), reverse=True):
+            candidate = found[key]
+            names = candidate.column_names
+            wider = next(
+                (other for other in merged.values()
+                 if other.table == candidate.table and other.column_names[:len(names)] == names),
+                None,
+            )
+            if wider is None:
+                merged[key] = candidate
+                continue
+            for fingerprint, (sample, duration) in candidate.fingerprints.items():
+                wider.serve(fingerprint, sample, duration)
+        return list(merged.values())
+
+    def describe(self, candidate):
+        """Check the candidate against the existing indexes; False when it is already covered"""
+        names = candidate.column_names
+        existing = self.indexes(candidate.table)
+        for columns in existing.values():
+            if columns[:len(names)] == names:
+                return False
+
+        candidate.extends = next((name for name, columns in existing.items() if columns[0] == names[0]), None)
+        candidate.benefit = candidate.served_time * (0.5 if candidate.extends else 1.0)
+
+        model = self.models[candidate.table]
+        fields = {field.column: field.name for field in model._meta.concrete_fields}
+        if all(column in fields for column in names):
+            candidate.model = model
+            candidate.index = models.Index(
+                fields=[('-' if desc else '') + fields[column] for column, desc in candidate.columns],
+            )
+            candidate.index.set_name_with_model(model)
+        return True
+
+    def recommend(self, limit=10):
+        """The candidates not covered by an existing index, highest estimated benefit first"""
+        recommended = []
+        for candidate in self.candidates():
+            if not self.describe(candidate):
+                continue
+            candidate.rows = self.table_rows(candidate.table)
+            if self.min_rows and candidate.rows is not None and candidate.rows < self.min_rows:
+                continue
+            recommended.append(candidate)
+        recommended.sort(key=lambda candidate: candidate.benefit, reverse=True)
+        return recommended[:limit]
+
+    def what_if(self, candidate, using):
+        """
+        Explain the candidate's statements on `using` without and with the index.
+
+        Stores and returns, per statement, the plan cost (PostgreSQL) and
+        whether the plan uses the new index. Only PostgreSQL and SQLite are
+        supported: their DDL is transactional, so the index never outlives
+        the check.
+        """
+        connection = connections[using]
+        if connection.vendor not in WHAT_IF_VENDORS:
+            raise ValueError(f"What-if checks need transactional DDL ({', '.join(WHAT_IF_VENDORS)}), not {connection.vendor}")
+
+        explainer = PlanCollector({'explain_analyze': False})
+        statements = [sql for sql, duration in candidate.fingerprints.values() if sql and is_explainable(sql)]
+        name = candidate.index.name if candidate.index is not None else None
+        results = []
+        with transaction.atomic(using=using):
+            before = [self.plan_cost(explainer, connection, sql) for sql in statements]
+            with connection.cursor() as cursor:
+                cursor.execute(candidate.sql(connection))
+            after = [self.plan_cost(explainer, connection, sql) for sql in statements]
+            transaction.set_rollback(True, using=using)
+
+        for sql, (cost_before, _), (cost_after, nodes) in zip(statements, before, after):
+            used = name is not None and any(node.get('index') and name in node['index'] for node in nodes)
+            results.append({'query': sql[:200], 'cost_before': cost_before, 'cost_after': cost_after, 'uses_index': used})
+        candidate.what_if = results
+        return results
+
+    def plan_cost(self, explainer, connection, sql):
+        try:
+            analyzed, nodes, raw = explainer.explain(connection, sql)
+        except DatabaseError as e:
+            logger.debug(f"Could not explain {sql[:100]}: {e}")
+            return None, []
+        costs = [node['cost'] for node in nodes if node.get('cost') is not None]
+        return (max(costs) if costs else None), nodes
@@ -0,0 +1,141 @@
+from datetime import timedelta
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils import timezone
+from query_optimizer.fingerprint import fingerprint, normalize_sql
+from query_optimizer.models import AnalysisCacheEntry
+from query_optimizer.rules import LOCAL_SOURCE
+from query_optimizer.sinks import capture_alias, get_config
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+_schema_version = None
+
+
+def get_schema_version(config):
+    """
+    Version of the database schema that cached analyses depend on.
+
+    `analysis_schema_version` in QUERY_OPTIMIZER_CONFIG is used as is, except
+    "auto", which hashes the list of applied migrations so that analyses made
+    before a migration (new index, dropped column) are not reused after it.
+    """
+    global _schema_version
+    version = config.get('analysis_schema_version') or ''
+    if version != 'auto':
+        return str(version)
+
+    if _schema_version is None:
+        applied = MigrationRecorder.Migration.objects.order_by('app', 'name').values_list('app', 'name')
+        key = '\n'.join(f"{app}.{name}" for app, name in applied)
+        _schema_version = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return _schema_version
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache of AI analyses.
+
+    Entries are keyed by the SQL fingerprint, provider, model and schema
+    version, so every execution of a statement shape reuses one analysis.
+    They are stored in AnalysisCacheEntry, with Django's cache framework in
+    front to skip the database on repeated lookups. Entries older than
+    `analysis_cache_ttl` seconds are ignored and deleted, and beyond
+    `analysis_cache_max_entries` the least recently used ones are evicted.
+
+    Front-cache hits do not refresh the entry's last use, so the front cache
+    is kept short-lived (`analysis_cache_timeout`) to keep the LRU order of
+    hot entries accurate.
+    """
+
+    def __init__(self, provider, model, config=None):
+        config = config if config is not None else get_config()
+        self.provider = provider
+        self.model = model
+        self.enabled = config.get('analysis_cache', True)
+        self.ttl = config.get('analysis_cache_ttl', 30 * 24 * 3600)
+        self.max_entries = config.get('analysis_cache_max_entries', 10000)
+        self.timeout = config.get('analysis_cache_timeout', 300)
+        self.cache = caches[config.get('analysis_cache_backend', 'default')]
+        self.using = capture_alias(config)
+        self.schema_version = get_schema_version(config) if self.enabled else ''
+
+    def key(self, query_record):
+        shape = query_record.fingerprint or fingerprint(query_record.query)
+        key = f"{shape}:{self.provider}:{self.model}:{self.schema_version}"
+        return shape, hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def cache_key(self, key):
+        return f"query_optimizer:analysis:{key}"
+
+    @property
+    def entries(self):
+        return AnalysisCacheEntry.objects.using(self.using)
+
+    def is_expired(self, entry):
+        return self.ttl is not None and entry.created_at < timezone.now() - timedelta(seconds=self.ttl)
+
+    def get(self, query_record):
+        """Return the cached analysis of the shape of `query_record`, or None"""
+        if not self.enabled:
+            return None
+
+        _, key = self.key(query_record)
+        analysis = self.cache.get(self.cache_key(key))
+        if analysis is not None:
+            return analysis
+
+        entry = self.entries.filter(key=key).only('id', 'analysis', 'created_at').first()
+        if entry is None:
+            return None
+        if self.is_expired(entry):
+            entry.delete()
+            return None
+
+        self.entries.filter(id=entry.id).update(hits=F('hits') + 1, last_used_at=timezone.now())
+        self.cache.set(self.cache_key(key), entry.analysis, self.timeout)
+        return entry.analysis
+
+    def set(self, query_record, analysis):
+        # Analyses of the local rules are cheap to redo, and must not hide the provider's
+        if not self.enabled or analysis.get('source') == LOCAL_SOURCE:
+            return
+
+        shape, key = self.key(query_record)
+        now = timezone.now()
+        updated = self.entries.filter(key=key).update(analysis=analysis, created_at=now, last_used_at=now)
+        if not updated:
+            try:
+                with transaction.atomic(using=self.using):
+                    self.entries.create(
+                        key=key,
+                        fingerprint=shape,
+                        provider=self.provider,
+                        model=self.model,
+                        schema_version=self.schema_version,
+                        normalized_query=normalize_sql(query_record.query),
+                        analysis=analysis,
+                        created_at=now,
+                        last_used_at=now,
+                    )
+            except IntegrityError:
+                # Another worker cached the same shape first
+                pass
+        self.cache.set(self.cache_key(key), analysis, self.timeout)
+        self.evict()
+
+    def evict(self):
+        """Delete expired entries, then the least recently used ones beyond the size limit"""
+        entries = self.entries
+        if self.ttl is not None:
+            entries.filter(created_at__lt=timezone.now() - timedelta(seconds=self.ttl)).delete()
+
+        if self.max_entries:
+            stale = list(entries.order_by('-last_used_at').values_list('id', flat=True)[self.max_entries:])
+            if stale:
+                self.entries.filter(id__in=stale).delete()
+                logger.debug(f"Evicted {len(stale)} cached analyses")
@@ -3,3 +3,13 @@ from django.apps import AppConfig
 class QueryOptimizerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'query_optimizer'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from query_optimizer.capture import on_connection_created
+        from query_optimizer.routers import configure_connection
+
+        # Route the queries of every new connection, in any thread, to the
+        # collectors of the current context
+        connection_created.connect(on_connection_created, dispatch_uid='query_optimizer_capture')
+        connection_created.connect(configure_connection, dispatch_uid='query_optimizer_connection')
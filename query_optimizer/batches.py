@@ -0,0 +1,154 @@
+from django.utils import timezone
+from query_optimizer.analysis_cache import AnalysisCache
+from query_optimizer.jobs import record_analysis, select_candidates
+from query_optimizer.models import AnalysisBatch, AnalysisJob, QueryRecord
+from query_optimizer.services import BATCH_ENDED, BATCH_FAILED, get_client, get_optimizer
+from query_optimizer.sinks import capture_alias, get_config
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def pending_record_ids():
+    """Ids of the QueryRecords in batches that were submitted but not collected yet"""
+    ids = set()
+    for requests in AnalysisBatch.objects.using(capture_alias()).filter(status=AnalysisBatch.STATUS_SUBMITTED).values_list('requests', flat=True):
+        for record_ids in requests.values():
+            ids.update(record_ids)
+    return ids
+
+
+def submit_batches(source=AnalysisJob.SOURCE_SLOW, limit=None, optimizer=None):
+    """
+    Submit unanalyzed queries to the provider's batch API.
+
+    Queries are selected like a bulk analysis job. Those whose shape is in
+    the AnalysisCache, or that the local rules can answer, are analyzed
+    right away, and queries sharing a shape are sent as a single request. Requests are split into batches of
+    at most `batch_max_size`. Returns the AnalysisBatch rows created.
+    """
+    config = get_config()
+    optimizer = optimizer or get_optimizer()
+    client = optimizer.client
+    cache = AnalysisCache(optimizer.provider, optimizer.model, config)
+    ids = select_candidates(source, limit, pending_record_ids())
+
+    groups = {}
+    cached = local = 0
+    for query_record in QueryRecord.objects.using(capture_alias(config)).select_related('stack').filter(id__in=ids).order_by('id'):
+        analysis = cache.get(query_record)
+        if analysis is not None:
+            record_analysis(query_record, analysis, cached=True)
+            cached += 1
+            continue
+        analysis = optimizer.analyze_locally(query_record)
+        if analysis is not None:
+            record_analysis(query_record, analysis)
+            local += 1
+            continue
+        key = cache.key(query_record)[1] if cache.enabled else query_record.id
+        groups.setdefault(key, []).append(query_record)
+
+    if cached or local:
+        logger.info(f"{cached} queries were analyzed from the analysis cache and {local} by the local rules")
+    if groups and not client.supports_batch:
+        raise ValueError(f"The {optimizer.provider} provider does not support batch analysis")
+
+    batch_size = max(config.get('batch_max_size', 1000), 1)
+    groups = list(groups.values())
+    batches = []
+    for start in range(0, len(groups), batch_size):
+        chunk = groups[start:start + batch_size]
+        # Custom ids only allow letters, digits, "_" and "-" at some providers
+        requests = {f"query-{records[0].id}": records for records in chunk}
+        batch_id = client.submit_batch(
+            [(custom_id, optimizer.build_prompt(records[0])) for custom_id, records in requests.items()],
+            optimizer.model,
+        )
+        batches.append(AnalysisBatch.objects.using(capture_alias(config)).create(
+            provider=optimizer.provider,
+            model=optimizer.model,
+            batch_id=batch_id,
+            requests={custom_id: [record.id for record in records] for custom_id, records in requests.items()},
+            size=sum(len(records) for records in chunk),
+        ))
+        logger.info(f"Submitted analysis batch {batch_id} with {len(requests)} requests")
+    return batches
+
+
+def batch_client(batch, optimizer=None):
+    """
+    Client of the provider `batch` was submitted to, which may not be the configured one anymore.
+
+    Its key is `api_keys[provider]` in QUERY_OPTIMIZER_CONFIG, or `api_key`
+    while the batch's provider is still the configured one.
+    """
+    if optimizer is not None and optimizer.provider == batch.provider:
+        return optimizer.client
+
+    config = get_config()
+    api_key = (config.get('api_keys') or {}).get(batch.provider)
+    if api_key is None and config.get('provider') == batch.provider:
+        api_key = config.get('api_key')
+    if api_key is None and batch.provider != 'stub':
+        raise ValueError(f"No API key for the {batch.provider} provider of batch {batch.batch_id}, set api_keys in QUERY_OPTIMIZER_CONFIG")
+    return get_client(batch.provider, api_key, config)
+
+
+def collect_batch(batch, optimizer=None):
+    """
+    Poll `batch` and, once the provider is done, fan its results out into QueryAnalysis rows.
+
+    Each result is stored on every query of its request and added to the
+    AnalysisCache. Queries without a result stay unanalyzed and can be sent
+    again in a later batch. Returns True when the batch is no longer pending.
+    Results are fetched from the batch's own provider, so batches survive a
+    change of `provider`.
+    """
+    client = batch_client(batch, optimizer)
+    optimizer = optimizer or get_optimizer()
+    status = client.batch_status(batch.batch_id)
+    batch.provider_status = status
+    batch.checked_at = timezone.now()
+
+    if status == BATCH_FAILED:
+        batch.status = AnalysisBatch.STATUS_FAILED
+        batch.last_error = f"The provider reported batch {batch.batch_id} as failed"
+    elif status == BATCH_ENDED:
+        cache = AnalysisCache(batch.provider, batch.model)
+        records = QueryRecord.objects.using(capture_alias()).in_bulk(batch.record_ids)
+        for custom_id, text, error in client.batch_results(batch.batch_id):
+            group = [records[record_id] for record_id in batch.requests.get(custom_id, []) if record_id in records]
+            if not group:
+                continue
+            if text is None:
+                batch.failed += len(group)
+                batch.last_error = f"{custom_id}: {error}"
+                continue
+            analysis = optimizer.parse_response(text)
+            record_analysis(group[0], analysis)
+            cache.set(group[0], analysis)
+            for other in group[1:]:
+                record_analysis(other, analysis, cached=True)
+            batch.succeeded += len(group)
+        batch.status = AnalysisBatch.STATUS_COLLECTED
+        batch.collected_at = timezone.now()
+
+    batch.save(using=capture_alias())
+    if batch.status != AnalysisBatch.STATUS_SUBMITTED:
+        logger.info(f"Analysis batch {batch.batch_id} {batch.status}: {batch.succeeded} analyzed, {batch.failed} failed")
+    return batch.status != AnalysisBatch.STATUS_SUBMITTED
+
+
+def collect_batches(optimizer=None):
+    """Poll every pending batch and return the ones still pending"""
+    pending = []
+    for batch in AnalysisBatch.objects.using(capture_alias()).filter(status=AnalysisBatch.STATUS_SUBMITTED).order_by('created_at'):
+        try:
+            done = collect_batch(batch, optimizer)
+        except Exception as e:
+            logger.error(f"Failed to collect analysis batch {batch.batch_id}: {str(e)}", exc_info=True)
+            done = False
+        if not done:
+            pending.append(batch)
+    return pending
@@ -0,0 +1,148 @@
+from query_optimizer.matchers import PrefixMatcher
+import logging
+
+logger = logging.getLogger(__name__)
+
+BUDGET_ACTIONS = ['log', 'record', 'raise']
+BUDGET_LIMITS = ['queries', 'duration', 'duplicates']
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a request or a block of code goes over its query budget"""
+
+    def __init__(self, breach, queries=None):
+        self.breach = breach
+        self.queries = queries or []
+        message = breach.describe()
+        if self.queries:
+            message += '\n' + '\n'.join(f"{number}. {sql}" for number, sql in enumerate(self.queries, 1))
+        super().__init__(message)
+
+
+class QueryUsage:
+    """Queries run by a request or a block: count, total time and repeated identical statements"""
+
+    def __init__(self, count=0, duration=0.0, duplicates=0):
+        self.count = count
+        self.duration = duration
+        self.duplicates = duplicates
+
+    @classmethod
+    def from_collector(cls, collector):
+        return cls(collector.count, collector.total_time, collector.duplicates)
+
+
+class BudgetBreach:
+    """The limits of a budget that a QueryUsage went over"""
+
+    def __init__(self, name, limits, usage, exceeded):
+        self.name = name
+        self.limits = limits
+        self.usage = usage
+        self.exceeded = exceeded
+
+    def as_event(self):
+        """Fields of the BudgetViolation row recording this breach"""
+        return {
+            'budget': self.name,
+            'limits': self.limits,
+            'exceeded': self.exceeded,
+            'query_count': self.usage.count,
+            'total_duration': self.usage.duration,
+            'duplicate_count': self.usage.duplicates,
+        }
+
+    def describe(self):
+        values = {'queries': self.usage.count, 'duration': self.usage.duration, 'duplicates': self.usage.duplicates}
+        parts = []
+        for limit in self.exceeded:
+            if limit == 'duration':
+                parts.append(f"{values[limit]:.3f}s of database time (budget {self.limits[limit]}s)")
+            else:
+                parts.append(f"{values[limit]} {limit} (budget {self.limits[limit]})")
+        return f"Query budget {self.name} exceeded: {', '.join(parts)}"
+
+
+def check_budget(name, limits, usage):
+    """Return the BudgetBreach of `usage` against `limits`, or None when it is within them"""
+    exceeded = []
+    if limits.get('queries') is not None and usage.count > limits['queries']:
+        exceeded.append('queries')
+    if limits.get('duration') is not None and usage.duration > limits['duration']:
+        exceeded.append('duration')
+    if limits.get('duplicates') is not None and usage.duplicates > limits['duplicates']:
+        exceeded.append('duplicates')
+    return BudgetBreach(name, limits, usage, exceeded) if exceeded else None
+
+
+class QueryBudgets:
+    """
+    Per-request query budgets.
+
+    `query_budget` in QUERY_OPTIMIZER_CONFIG is the budget of every request,
+    and `query_budgets` overrides it per path prefix (keys starting with
+    "/", the longest match wins) or per view name (other keys, which take
+    precedence). A budget has up to three limits: "queries" (count),
+    "duration" (total database time in seconds) and "duplicates" (executions
+    of a statement with the same parameters beyond the first).
+
+    `budget_action` says what happens to a request over budget: "log" a
+    warning, "record" a BudgetViolation row as well, or "raise"
+    QueryBudgetExceeded, meant for test and staging environments.
+    """
+
+    def __init__(self, config):
+        self.default = config.get('query_budget') or {}
+        budgets = config.get('query_budgets', {}) or {}
+        self.path_budgets = {prefix: limits for prefix, limits in budgets.items() if prefix.startswith('/')}
+        self.path_matcher = PrefixMatcher(self.path_budgets)
+        self.view_budgets = {name: limits for name, limits in budgets.items() if not name.startswith('/')}
+        self.action = config.get('budget_action', 'log')
+        self.check_config()
+
+    def check_config(self):
+        if self.action not in BUDGET_ACTIONS:
+            raise ValueError(f"budget_action must be one of {', '.join(BUDGET_ACTIONS)}")
+        for limits in [self.default] + list(self.path_budgets.values()) + list(self.view_budgets.values()):
+            unknown = set(limits) - set(BUDGET_LIMITS)
+            if unknown:
+                raise ValueError(f"Unknown query budget limits: {', '.join(sorted(unknown))}, use {', '.join(BUDGET_LIMITS)}")
+
+    @property
+    def is_enabled(self):
+        return bool(self.default or self.path_budgets or self.view_budgets)
+
+    @property
+    def tracks_duplicates(self):
+        budgets = [self.default] + list(self.path_budgets.values()) + list(self.view_budgets.values())
+        return any(limits.get('duplicates') is not None for limits in budgets)
+
+    def budget_for(self, path=None, view_name=None):
+        """(name, limits) of the budget that applies, or (None, {}) when there is none"""
+        if view_name and view_name in self.view_budgets:
+            return view_name, self.view_budgets[view_name]
+        prefix = self.path_matcher.match(path) if path else None
+        if prefix is not None:
+            return prefix, self.path_budgets[prefix]
+        if self.default:
+            return 'default', self.default
+        return None, {}
+
+    def check(self, usage, path=None, view_name=None):
+        name, limits = self.budget_for(path, view_name)
+        if not limits:
+            return None
+        return check_budget(name, limits, usage)
+
+    def enforce(self, breach):
+        """Raise QueryBudgetExceeded for `breach` with the "raise" action"""
+        if breach is not None and self.action == 'raise':
+            raise QueryBudgetExceeded(breach)
+
+
+def server_timing(usage):
+    """Server-Timing header value with the database time and query count of a request"""
+    value = f'db;dur={usage.duration * 1000:.2f};desc="{usage.count} queries"'
+    if usage.duplicates:
+        value += f', db-duplicates;desc="{usage.duplicates} duplicate queries"'
+    return value
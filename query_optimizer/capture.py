@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import connections
+from query_optimizer.stacks import capture_frames
+from functools import partial, wraps
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CapturedQuery:
+    """A query kept by a QueryCollector"""
+    __slots__ = ('sql', 'duration', 'alias', 'frames', 'weight')
+
+    def __init__(self, sql, duration, alias, frames=None, weight=1.0):
+        self.sql = sql
+        self.duration = duration
+        self.alias = alias
+        self.frames = frames
+        self.weight = weight
+
+
+class QueryCollector:
+    """
+    Execute wrapper that times every query with time.perf_counter.
+
+    Unlike connection.queries it works with DEBUG=False and only keeps the
+    queries selected by the capture rules:
+
+    - queries slower than `slow_query_threshold` are always kept
+    - other queries are kept when they take at least `min_duration` seconds
+      and are picked by `sample_rate`
+    - `query_filter`, if given, is called with the SQL and must return True
+      for the query to be kept
+
+    A `detector`, if given, sees every query (SQL and duration) to spot
+    repeated statements, such as an NPlusOneDetector.
+
+    When `capture_stack` is on, the raw application frames of slow queries,
+    and of `stack_sample_rate` of the others, are kept. They are formatted
+    later, when the query is persisted.
+
+    While `sampled` is False the collector runs in light mode: it only keeps
+    (sql, duration, alias) of each query, with no stack, parameters or N+1
+    bookkeeping, until promote() applies the capture rules to them. This lets
+    a request that was not sampled still be captured if it turns out to be
+    over budget. Without `keep_light`, when nothing could promote the
+    request, light mode keeps nothing but `count` and `total_time`.
+
+    `count` and `total_time` cover every query, kept or not. With
+    `track_duplicates`, `duplicates` counts the executions of a statement
+    with the same parameters beyond the first. With `keep_timings`,
+    `timings` holds the (sql, duration) of every query, for the metrics.
+    `overhead` is the time spent in the collector's own bookkeeping.
+    """
+
+    def __init__(self, slow_query_threshold=0.5, min_duration=0.0, sample_rate=1.0,
+                 capture_stack=True, stack_sample_rate=0.0, query_filter=None, detector=None,
+                 track_duplicates=False, keep_timings=False, keep_light=True):
+        self.slow_query_threshold = slow_query_threshold
+        self.min_duration = min_duration
+        self.sample_rate = sample_rate
+        self.capture_stack = capture_stack
+        self.stack_sample_rate = stack_sample_rate
+        self.query_filter = query_filter
+        self.detector = detector
+        self.sampled = True
+        self.queries = []
+        self.light = []
+        self.count = 0
+        self.total_time = 0.0
+        self.duplicates = 0
+        self.statements = set() if track_duplicates else None
+        self.timings = [] if keep_timings else None
+        self.keep_light = keep_light
+        self.overhead = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            end = time.perf_counter()
+            duration = end - start
+            self.count += 1
+            self.total_time += duration
+            if self.statements is not None:
+                self.track(sql, params)
+            if self.timings is not None:
+                self.timings.append((sql, duration))
+            if self.sampled:
+                if self.detector is not None:
+                    self.detector.add(sql, duration)
+                if self.should_keep(sql, duration):
+                    self.keep(sql, params, many, context, duration)
+            elif self.keep_light:
+                self.light.append((sql, duration, context['connection'].alias))
+            self.overhead += time.perf_counter() - end
+
+    def track(self, sql, params):
+        # Parameters may be lists or dicts, which are not hashable
+        statement = (sql, repr(params))
+        if statement in self.statements:
+            self.duplicates += 1
+        else:
+            self.statements.add(statement)
+
+    def promote(self):
+        """Apply the capture rules to the queries seen in light mode"""
+        for sql, duration, alias in self.light:
+            if self.should_keep(sql, duration):
+                self.queries.append(CapturedQuery(sql, duration, alias, weight=self.weight(duration)))
+        self.light = []
+
+    def discard(self):
+        self.queries = []
+        self.light = []
+
+    def is_slow(self, duration):
+        return duration > self.slow_query_threshold
+
+    def weight(self, duration):
+        """Inverse of the probability that a query of this duration is kept"""
+        if self.is_slow(duration) or self.sample_rate >= 1.0 or duration < self.min_duration:
+            return 1.0
+        return 1.0 / self.sample_rate
+
+    def should_keep(self, sql, duration):
+        if not self.is_slow(duration):
+            if duration < self.min_duration:
+                return False
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                return False
+        return self.query_filter is None or self.query_filter(sql)
+
+    def keep(self, sql, params, many, context, duration):
+        db = context['connection']
+        self.queries.append(CapturedQuery(
+            sql=self.executed_sql(db, context['cursor'], sql, params, many),
+            duration=duration,
+            alias=db.alias,
+            frames=capture_frames() if self.should_capture_stack(duration) else None,
+            weight=self.weight(duration),
+        ))
+
+    def should_capture_stack(self, duration):
+        if not self.capture_stack:
+            return False
+        return self.is_slow(duration) or random.random() < self.stack_sample_rate
+
+    def executed_sql(self, db, cursor, sql, params, many):
+        """Return the SQL with its parameters, as the backend reports it"""
+        if many:
+            return sql
+        try:
+            return db.ops.last_executed_query(cursor.cursor, sql, params)
+        except Exception:
+            return sql
+
+
+# (collector, aliases) pairs active in the current context, innermost last
+_collectors = ContextVar('query_optimizer_collectors', default=())
+# Set while the package writes its own rows, which are never application queries
+_suppressed = ContextVar('query_optimizer_suppressed', default=False)
+
+
+def dispatch(execute, sql, params, many, context):
+    """
+    Execute wrapper installed once on every connection.
+
+    It hands the query to the collectors active in the current context, so
+    the same connection can serve several requests without mixing them up.
+    """
+    collectors = _collectors.get()
+    if not collectors or _suppressed.get():
+        return execute(sql, params, many, context)
+
+    alias = context['connection'].alias
+    for collector, aliases in reversed(collectors):
+        if aliases is None or alias in aliases:
+            execute = partial(collector, execute)
+    return execute(sql, params, many, context)
+
+
+def install(connection):
+    """Add the dispatcher to the execute wrappers of `connection`"""
+    if dispatch not in connection.execute_wrappers:
+        # Insert rather than append: execute_wrapper() blocks pop the last
+        # wrapper on exit and must not remove ours
+        connection.execute_wrappers.insert(0, dispatch)
+
+
+def on_connection_created(sender, connection, **kwargs):
+    install(connection)
+
+
+@contextmanager
+def capture_queries(collector, using=None):
+    """
+    Send the queries run in the current context to `collector` for the
+    duration of the block, on every database alias or on those in `using`.
+
+    Collectors are tracked in a context variable rather than on the
+    connection: concurrent requests served by one event loop each see their
+    own queries, and ORM calls made through sync_to_async (which copies the
+    context to its thread) are attributed to the request that awaited them.
+    """
+    for alias in (using or connections):
+        install(connections[alias])
+
+    active = (collector, frozenset(using) if using else None)
+    token = _collectors.set(_collectors.get() + (active,))
+    try:
+        yield collector
+    finally:
+        _collectors.reset(token)
+
+
+@contextmanager
+def suppress_capture():
+    """Hide the queries run in the current context from every collector for the duration of the block"""
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+def without_capture(func):
+    """Run `func` under suppress_capture()"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with suppress_capture():
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,21 +1,192 @@
-from django.db import connection
-from query_optimizer.models import QueryRecord
+from asgiref.sync import iscoroutinefunction
+from django.utils import timezone
+from query_optimizer.budgets import QueryBudgets, QueryUsage, check_budget
+from query_optimizer.capture import QueryCollector, capture_queries
+from query_optimizer.detectors import NPlusOneDetector
+from query_optimizer.metrics import get_metrics
+from query_optimizer.sinks import RequestSink, application_aliases, get_config
 from functools import wraps
 import time
-import traceback
 import logging
 
 logger = logging.getLogger(__name__)
 
-def track_queries(view_func=None, enabled=True, threshold=0.5, capture_stack=True, capture_params=True):
+def track_queries(view_func=None, enabled=True, threshold=0.5, capture_stack=True, capture_params=True,
+                  min_duration=0.0, sample_rate=1.0, stack_sample_rate=0.0, using=None, n_plus_one_threshold=10,
+                  budget=None):
     """
     Universal decorator that tracks queries with additional request/response context.
     Works with:
     - Django function views
     - Django class views (when used with @method_decorator)
     - DRF APIViews and ViewSets
+
+    Queries of every database alias (or of the aliases in `using`) are timed,
+    whether DEBUG is on or not, except those of a dedicated capture database. With `capture_stack`, stacks are kept for slow
+    queries and for `stack_sample_rate` of the others. Statements repeated at
+    least `n_plus_one_threshold` times in one request are recorded as
+    N+1 findings (pass 0 to turn detection off).
+
+    `budget` is a query budget of the view, such as {"queries": 10,
+    "duration": 0.2, "duplicates": 0}, enforced with the `budget_action` of
+    QUERY_OPTIMIZER_CONFIG.
+
+    Async views are wrapped in an async wrapper: their queries, including
+    those run through sync_to_async, are attributed to the request and
+    persistence does not block the event loop.
     """
+    def get_request(args):
+        """Find the request and the view name among the view's arguments"""
+        # Case 1: DRF class-based view (first arg is 'self')
+        if len(args) > 0 and hasattr(args[0], 'request'):
+            self = args[0]
+            return self.request, self.__class__.__name__
+        # Case 2: Django class-based view (when using @method_decorator)
+        elif len(args) > 0 and hasattr(args[0], 'request'):
+            self = args[0]
+            return args[1], self.__class__.__name__  # For Django class views, request is second arg
+        # Case 3: Regular function view (first arg is request)
+        request = args[0]
+        resolver_match = getattr(request, 'resolver_match', None)
+        return request, resolver_match.view_name if resolver_match else ''
+
+    def get_budgets():
+        if not budget:
+            return None
+        return QueryBudgets({'query_budget': budget, 'budget_action': get_config().get('budget_action', 'log')})
+
+    def check_view_budget(request, view_name, response, collector, sink, budgets):
+        """Log a breach of the view's budget, recording it in the sink with the "record" action"""
+        if budgets is None:
+            return None
+        breach = check_budget(view_name or 'default', budgets.default, QueryUsage.from_collector(collector))
+        if breach is None:
+            return None
+        logger.warning(f"{breach.describe()} in {request.method} {request.path}")
+        if budgets.action == 'record':
+            sink.add(
+                kind='budget',
+                view_name=view_name,
+                url_path=request.path,
+                request_method=request.method,
+                response_status_code=getattr(response, 'status_code', None),
+                timestamp=timezone.now(),
+                **breach.as_event(),
+            )
+        return breach
+
+    def get_databases():
+        # A dedicated capture database only holds the package's own queries
+        return using if using is not None else application_aliases()
+
+    def get_collector(budgets):
+        # Queries are only sampled per query here, never per request
+        return QueryCollector(
+            slow_query_threshold=threshold,
+            min_duration=min_duration,
+            sample_rate=sample_rate,
+            capture_stack=capture_stack,
+            stack_sample_rate=stack_sample_rate,
+            detector=NPlusOneDetector(n_plus_one_threshold, capture_stack) if n_plus_one_threshold else None,
+            track_duplicates=budgets is not None and budgets.tracks_duplicates,
+            keep_timings=get_metrics() is not None,
+        )
+
+    def collect(request, view_name, response, collector):
+        """Turn the captured queries into events of a new sink"""
+        # Get response status code
+        status_code = getattr(response, 'status_code', 200)
+        
+        # Get request content type
+        content_type = request.content_type if hasattr(request, 'content_type') else ''
+        
+        # Capture queries
+        sink = RequestSink()
+        for query in collector.queries:
+            try:
+                is_slow = collector.is_slow(query.duration)
+                
+                sink.add(
+                    query=query.sql,
+                    duration=query.duration,
+                    is_slow=is_slow,
+                    sample_weight=query.weight,
+                    db_alias=query.alias,
+                    view_name=view_name,
+                    url_path=request.path,
+                    stack_frames=query.frames,
+                    query_params=dict(request.GET) if capture_params else {},
+                    request_method=request.method,
+                    request_content_type=content_type,
+                    response_status_code=status_code,
+                    timestamp=timezone.now(),
+                )
+
+                if is_slow:
+                    logger.warning(
+                        f"Slow query ({query.duration:.3f}s) in {view_name} - "
+                        f"Status: {status_code}, Content-Type: {content_type}\n"
+                        f"Query: {query.sql[:100]}..."
+                    )
+                    
+            except Exception as e:
+                logger.error(f"Failed to capture query: {str(e)}", exc_info=True)
+                continue
+
+        # Record repeated query patterns (N+1)
+        if collector.detector is not None:
+            for finding in collector.detector.findings():
+                sink.add(kind='n_plus_one', view_name=view_name, url_path=request.path, timestamp=timezone.now(), **finding)
+                logger.warning(
+                    f"N+1 query ({finding['repeats']}x) in {view_name} at {finding['call_site']}: "
+                    f"{finding['normalized_query'][:100]}..."
+                )
+        return sink
+
+    def record_metrics(view_name, collector, sink, breach):
+        metrics = get_metrics()
+        if metrics is None or collector.timings is None:
+            return
+        n_plus_one = sum(1 for event in sink.events if event.get('kind') == 'n_plus_one')
+        metrics.observe_request(view_name, collector.timings, threshold, n_plus_one=n_plus_one, over_budget=breach is not None)
+
+    def log_summary(request, collector, start_time):
+        total_time = time.perf_counter() - start_time
+        logger.debug(
+            f"Request {request.method} {request.path} - "
+            f"{collector.count} queries ({collector.total_time:.3f}s) in {total_time:.3f}s"
+        )
+
     def decorator(func):
+        budgets = get_budgets()
+
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapped(*args, **kwargs):
+                if not enabled:
+                    return await func(*args, **kwargs)
+
+                request, view_name = get_request(args)
+                if not request:
+                    return await func(*args, **kwargs)
+
+                start_time = time.perf_counter()
+                collector = get_collector(budgets)
+                with capture_queries(collector, get_databases()):
+                    response = await func(*args, **kwargs)
+
+                # Persist without blocking the event loop
+                sink = collect(request, view_name, response, collector)
+                breach = check_view_budget(request, view_name, response, collector, sink, budgets)
+                record_metrics(view_name, collector, sink, breach)
+                await sink.aflush()
+                log_summary(request, collector, start_time)
+                if breach is not None:
+                    budgets.enforce(breach)
+                return response
+
+            return async_wrapped
+
         @wraps(func)
         def wrapped(*args, **kwargs):
             # Skip if not enabled
@@ -23,78 +194,28 @@ def track_queries(view_func=None, enabled=True, threshold=0.5, capture_stack=Tru
                 return func(*args, **kwargs)
 
             # Determine the request object and view name
-            request = None
-            view_name = ''
-            
-            # Case 1: DRF class-based view (first arg is 'self')
-            if len(args) > 0 and hasattr(args[0], 'request'):
-                self = args[0]
-                request = self.request
-                view_name = self.__class__.__name__
-            # Case 2: Django class-based view (when using @method_decorator)
-            elif len(args) > 0 and hasattr(args[0], 'request'):
-                self = args[0]
-                request = args[1]  # For Django class views, request is second arg
-                view_name = self.__class__.__name__
-            # Case 3: Regular function view (first arg is request)
-            else:
-                request = args[0]
-                resolver_match = getattr(request, 'resolver_match', None)
-                view_name = resolver_match.view_name if resolver_match else ''
-
+            request, view_name = get_request(args)
             if not request:
                 return func(*args, **kwargs)
 
             # Start tracking
-            start_time = time.time()
-            initial_query_count = len(connection.queries)
+            start_time = time.perf_counter()
+            collector = get_collector(budgets)
             
             #Execute the view
-            response = func(*args, **kwargs)
-            
-            # Get response status code
-            status_code = getattr(response, 'status_code', 200)
-            
-            # Get request content type
-            content_type = request.content_type if hasattr(request, 'content_type') else ''
-            
-            # Capture queries
-            for query in connection.queries[initial_query_count:]:
-                try:
-                    duration = float(query['time'])
-                    is_slow = duration > threshold
-                    
-                    QueryRecord.objects.create(
-                        query=query['sql'],
-                        duration=duration,
-                        is_slow=is_slow,
-                        view_name=view_name,
-                        url_path=request.path,
-                        stack_trace='\n'.join(traceback.format_stack()[:-2]) if capture_stack else "",
-                        query_params=dict(request.GET) if capture_params else {},
-                        request_method=request.method,
-                        request_content_type=content_type,
-                        response_status_code=status_code,
-                    )
+            with capture_queries(collector, get_databases()):
+                response = func(*args, **kwargs)
 
-                    if is_slow:
-                        logger.warning(
-                            f"Slow query ({duration:.3f}s) in {view_name} - "
-                            f"Status: {status_code}, Content-Type: {content_type}\n"
-                            f"Query: {query['sql'][:100]}..."
-                        )
-                        
-                except Exception as e:
-                    logger.error(f"Failed to capture query: {str(e)}", exc_info=True)
-                    continue
+            # Persist everything captured for this view at once
+            sink = collect(request, view_name, response, collector)
+            breach = check_view_budget(request, view_name, response, collector, sink, budgets)
+            record_metrics(view_name, collector, sink, breach)
+            sink.flush()
 
             # Log request summary
-            total_time = time.time() - start_time
-            query_count = len(connection.queries) - initial_query_count
-            logger.debug(
-                f"Request {request.method} {request.path} - "
-                f"{query_count} queries in {total_time:.3f}s"
-            )
+            log_summary(request, collector, start_time)
+            if breach is not None:
+                budgets.enforce(breach)
 
             return response
 
@@ -0,0 +1,116 @@
+from django.db import IntegrityError, transaction
+from query_optimizer.fingerprint import fingerprint, normalize_sql
+from query_optimizer.models import NPlusOneFinding
+from query_optimizer.stacks import call_site, capture_frames, format_call_site
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class NPlusOneDetector:
+    """
+    Groups the queries of one request by SQL and call site.
+
+    Django sends the same parameterized SQL for every execution of a
+    statement shape, so executions are only counted by raw SQL while the
+    request runs, which needs no stack walk. A statement's call site is
+    looked up once, when it reaches `threshold` executions, and all of its
+    executions are credited to that line. Its full stack is taken at the
+    same moment, unless `capture_stack` is off. Groups are only normalized
+    and fingerprinted in findings().
+    """
+
+    def __init__(self, threshold=10, capture_stack=True):
+        self.threshold = threshold
+        self.capture_stack = capture_stack
+        # sql: [count, total duration, call site, frames]
+        self.groups = {}
+
+    def add(self, sql, duration):
+        group = self.groups.get(sql)
+        if group is None:
+            self.groups[sql] = [1, duration, None, None]
+            return
+        group[0] += 1
+        group[1] += duration
+        if group[0] == self.threshold:
+            group[2] = call_site()
+            if self.capture_stack:
+                group[3] = capture_frames()
+
+    def findings(self):
+        """Return the repeated patterns of the request, most repeated first"""
+        merged = {}
+        for sql, (count, total_duration, site, frames) in self.groups.items():
+            if count < 2:
+                continue
+            normalized = normalize_sql(sql)
+            key = (fingerprint(normalized, normalized=True), site)
+            finding = merged.get(key)
+            if finding is None:
+                merged[key] = {
+                    'fingerprint': key[0],
+                    'call_site': format_call_site(site),
+                    'normalized_query': normalized,
+                    'sample_query': sql,
+                    'repeats': count,
+                    'total_duration': total_duration,
+                    'stack_frames': frames,
+                }
+            else:
+                finding['repeats'] += count
+                finding['total_duration'] += total_duration
+
+        findings = [finding for finding in merged.values() if finding['repeats'] >= self.threshold]
+        return sorted(findings, key=lambda finding: finding['repeats'], reverse=True)
+
+
+def _apply_findings(findings, stack_ids, using):
+    existing = {
+        (finding.fingerprint, finding.view_name, finding.call_site): finding
+        for finding in NPlusOneFinding.objects.using(using).select_for_update()
+        .filter(fingerprint__in={event['fingerprint'] for event in findings})
+    }
+
+    new, changed = {}, {}
+    for event in findings:
+        key = (event['fingerprint'], event.get('view_name') or '', event['call_site'])
+        finding = existing.get(key) or new.get(key)
+        if finding is None:
+            finding = new[key] = NPlusOneFinding(
+                fingerprint=event['fingerprint'],
+                view_name=key[1],
+                call_site=event['call_site'],
+                url_path=event.get('url_path') or '',
+                normalized_query=event['normalized_query'],
+                sample_query=event['sample_query'],
+                stack_id=stack_ids.get(event.get('stack_hash')),
+                first_seen=event['timestamp'],
+                last_seen=event['timestamp'],
+            )
+        elif key in existing:
+            changed[key] = finding
+
+        finding.occurrences += 1
+        finding.total_repeats += event['repeats']
+        finding.max_repeats = max(finding.max_repeats, event['repeats'])
+        finding.total_duration += event['total_duration']
+        finding.last_seen = max(finding.last_seen, event['timestamp'])
+        finding.url_path = event.get('url_path') or finding.url_path
+
+    if new:
+        NPlusOneFinding.objects.using(using).bulk_create(new.values())
+    if changed:
+        NPlusOneFinding.objects.using(using).bulk_update(changed.values(), [
+            'occurrences', 'total_repeats', 'max_repeats', 'total_duration', 'last_seen', 'url_path',
+        ])
+
+
+def record_findings(findings, stack_ids, using):
+    """Upsert N+1 findings, one row per (fingerprint, view, call site)"""
+    try:
+        with transaction.atomic(using=using):
+            _apply_findings(findings, stack_ids, using)
+    except IntegrityError:
+        with transaction.atomic(using=using):
+            _apply_findings(findings, stack_ids, using)
@@ -0,0 +1,260 @@
+from django.utils import timezone
+from query_optimizer.models import QueryRecord
+from query_optimizer.sinks import capture_alias, get_config
+from datetime import datetime, timedelta, timezone as dt_timezone
+import json
+import os
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ['parquet', 'arrow', 'binlog']
+EXTENSIONS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.qlog': 'binlog'}
+
+# Columns of every export, read from QueryRecord with values_list()
+EXPORT_FIELDS = [
+    'id', 'timestamp', 'duration', 'sample_weight', 'is_slow', 'fingerprint', 'view_name', 'url_path', 'db_alias',
+    'response_status_code', 'analysis__cached',
+]
+
+# Binary log: fixed-size little-endian records, so readers can memory-map the file as an array.
+# flags: 1 slow, 2 analyzed, 4 analysis reused from the cache; status is -1 without a response;
+# view and path index the string tables of the sidecar, where 0 is "unknown".
+BINLOG_VERSION = 1
+BINLOG_FIELDS = [
+    ('id', 'q'),
+    ('timestamp', 'q'),  # Microseconds since the epoch, UTC
+    ('duration', 'd'),
+    ('sample_weight', 'f'),
+    ('flags', 'B'),
+    ('status', 'h'),
+    ('fingerprint', '16s'),
+    ('view', 'i'),
+    ('path', 'i'),
+]
+BINLOG_STRUCT = struct.Struct('<' + ''.join(code for _, code in BINLOG_FIELDS))
+FLAG_SLOW = 1
+FLAG_ANALYZED = 2
+FLAG_CACHED = 4
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def epoch_micros(value):
+    if timezone.is_naive(value):
+        value = value.replace(tzinfo=dt_timezone.utc)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def detect_format(path):
+    export_format = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if export_format is None:
+        raise ValueError(f"Cannot tell the export format of {path}, use one of {', '.join(EXTENSIONS)} or pass the format")
+    return export_format
+
+
+def read_sidecar(path):
+    """Schema, string tables and position of a binary log, or None for a new log"""
+    try:
+        with open(f"{path}.json", encoding='utf-8') as f:
+            sidecar = json.load(f)
+    except FileNotFoundError:
+        return None
+    if sidecar.get('version') != BINLOG_VERSION or sidecar.get('record_size') != BINLOG_STRUCT.size:
+        raise ValueError(f"{path} was written by an incompatible version of the binary log")
+    return sidecar
+
+
+class Exporter:
+    """
+    Streams captured queries to a file for offline analysis.
+
+    Rows are read in id order with `QuerySet.iterator()`, which uses a
+    server-side cursor on PostgreSQL, `export_chunk_size` rows at a time,
+    from the `database` alias. Formats:
+
+    - "parquet": compressed columnar file (`export_compression`, zstd by default)
+    - "arrow": Arrow IPC file, uncompressed by default so it can be memory-mapped
+    - "binlog": append-only log of fixed-size binary records with a JSON
+      sidecar, written without extra dependencies. Each export appends the
+      queries captured since the previous one.
+
+    Parquet and Arrow need pyarrow. Strings repeated on every row are
+    dictionary encoded. The SQL text is only exported with `include_sql`,
+    in the columnar formats.
+    """
+
+    def __init__(self, path, export_format=None, chunk_size=None, include_sql=False, config=None):
+        config = config if config is not None else get_config()
+        self.path = path
+        self.format = export_format or detect_format(path)
+        if self.format not in EXPORT_FORMATS:
+            raise ValueError(f"Invalid export format: {self.format}, use one of {', '.join(EXPORT_FORMATS)}")
+        self.chunk_size = chunk_size or config.get('export_chunk_size', 2000)
+        self.compression = config.get('export_compression')
+        self.include_sql = include_sql
+        self.using = capture_alias(config)
+
+    def queryset(self, since=None, until=None, after_id=None):
+        queryset = QueryRecord.objects.using(self.using).order_by('id')
+        if since is not None:
+            queryset = queryset.filter(timestamp__gte=since)
+        if until is not None:
+            queryset = queryset.filter(timestamp__lt=until)
+        if after_id is not None:
+            queryset = queryset.filter(id__gt=after_id)
+        return queryset
+
+    def rows(self, queryset):
+        fields = EXPORT_FIELDS + (['query'] if self.include_sql and self.format != 'binlog' else [])
+        return queryset.values_list(*fields).iterator(chunk_size=self.chunk_size)
+
+    def export(self, since=None, until=None):
+        """Write the queries captured in [since, until) and return how many were written"""
+        if self.format == 'binlog':
+            count = self.write_binlog(since, until)
+        else:
+            count = self.write_columnar(self.queryset(since, until))
+        logger.info(f"Exported {count} queries to {self.path}")
+        return count
+
+    def write_columnar(self, queryset):
+        import pyarrow as pa
+
+        strings = pa.dictionary(pa.int32(), pa.string())
+        columns = [
+            ('id', pa.int64()),
+            ('timestamp', pa.timestamp('us', tz='UTC')),
+            ('duration', pa.float64()),
+            ('sample_weight', pa.float32()),
+            ('is_slow', pa.bool_()),
+            ('fingerprint', strings),
+            ('view_name', strings),
+            ('url_path', strings),
+            ('db_alias', strings),
+            ('status', pa.int16()),
+            ('analyzed', pa.bool_()),
+            ('cached', pa.bool_()),
+        ]
+        if self.include_sql:
+            columns.append(('query', pa.large_string()))
+        schema = pa.schema(columns)
+
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(self.path, schema, compression=self.compression or 'zstd')
+        else:
+            # Dictionaries only grow, which the IPC file format accepts as deltas
+            options = pa.ipc.IpcWriteOptions(compression=self.compression, emit_dictionary_deltas=True)
+            writer = pa.ipc.new_file(self.path, schema, options=options)
+
+        count = 0
+        self.dictionaries = {}
+        with writer:
+            chunk = []
+            for row in self.rows(queryset):
+                chunk.append(row)
+                if len(chunk) >= self.chunk_size:
+                    writer.write_batch(self.record_batch(pa, schema, chunk))
+                    count += len(chunk)
+                    chunk = []
+            if chunk or not count:
+                writer.write_batch(self.record_batch(pa, schema, chunk))
+                count += len(chunk)
+        return count
+
+    def record_batch(self, pa, schema, rows):
+        values = list(zip(*rows)) if rows else [()] * (len(EXPORT_FIELDS) + self.include_sql)
+        ids, timestamps, durations, weights, slow, fingerprints, views, paths, aliases, statuses, cached = values[:11]
+        arrays = [
+            ids,
+            timestamps,
+            durations,
+            weights,
+            slow,
+            fingerprints,
+            [view or '' for view in views],
+            [path or '' for path in paths],
+            aliases,
+            statuses,
+            [value is not None for value in cached],
+            [bool(value) for value in cached],
+        ]
+        if self.include_sql:
+            arrays.append(values[11])
+        return pa.RecordBatch.from_arrays(
+            [
+                self.encode(pa, field.name, array) if pa.types.is_dictionary(field.type) else pa.array(array, type=field.type)
+                for array, field in zip(arrays, schema)
+            ],
+            schema=schema,
+        )
+
+    def encode(self, pa, name, values):
+        """Dictionary-encode `values` with one dictionary per column, extended batch after batch"""
+        dictionary = self.dictionaries.setdefault(name, {})
+        indices = [dictionary.setdefault(value, len(dictionary)) for value in values]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()), pa.array(list(dictionary), type=pa.string())
+        )
+
+    def write_binlog(self, since=None, until=None):
+        sidecar = read_sidecar(self.path) or {
+            'format': 'query_optimizer.binlog',
+            'version': BINLOG_VERSION,
+            'record_size': BINLOG_STRUCT.size,
+            'fields': [name for name, _ in BINLOG_FIELDS],
+            'views': [''],
+            'paths': [''],
+            'count': 0,
+            'last_id': None,
+        }
+        views = {name: index for index, name in enumerate(sidecar['views'])}
+        paths = {name: index for index, name in enumerate(sidecar['paths'])}
+
+        def intern(table, names, value):
+            if not value:
+                return 0
+            index = table.get(value)
+            if index is None:
+                index = table[value] = len(names)
+                names.append(value)
+            return index
+
+        count = 0
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with open(self.path, mode) as f:
+            # Records written after the sidecar was last saved were never committed
+            f.truncate(sidecar['count'] * BINLOG_STRUCT.size)
+            f.seek(0, os.SEEK_END)
+            buffer = bytearray()
+            for row in self.rows(self.queryset(since, until, sidecar['last_id'])):
+                record_id, timestamp, duration, weight, slow, fp, view, path, _, status, cached = row
+                flags = (FLAG_SLOW if slow else 0) | (FLAG_ANALYZED if cached is not None else 0) | (FLAG_CACHED if cached else 0)
+                buffer += BINLOG_STRUCT.pack(
+                    record_id,
+                    epoch_micros(timestamp),
+                    duration,
+                    weight,
+                    flags,
+                    status if status is not None else -1,
+                    fp.encode('ascii', 'replace'),
+                    intern(views, sidecar['views'], view),
+                    intern(paths, sidecar['paths'], path),
+                )
+                count += 1
+                sidecar['last_id'] = record_id
+                if count % self.chunk_size == 0:
+                    f.write(buffer)
+                    buffer = bytearray()
+            f.write(buffer)
+            f.flush()
+            os.fsync(f.fileno())
+
+        sidecar['count'] += count
+        temporary = f"{self.path}.json.tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(sidecar, f)
+        os.replace(temporary, f"{self.path}.json")
+        return count
@@ -0,0 +1,35 @@
+import hashlib
+import re
+
+_COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_STRINGS = re.compile(r"[EeNn]?'(?:[^'\\]|''|\\.)*'")
+_NUMBERS = re.compile(r"(?<![\w\"`.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+_PLACEHOLDERS = re.compile(r"%s|%\(\w+\)s|\$\d+|(?<![\w:]):\w+|\?")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_VALUES_LISTS = re.compile(r"\bVALUES\s*\([^()]*\)(?:\s*,\s*\([^()]*\))*", re.I)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Reduce a SQL statement to its shape.
+
+    Comments are dropped, string and numeric literals and driver placeholders
+    become `?`, IN-lists and multi-row VALUES lists collapse to `(...)` and
+    whitespace is squeezed, so that executions that only differ by their
+    parameters normalize to the same text.
+    """
+    sql = _COMMENTS.sub(' ', sql)
+    sql = _STRINGS.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _IN_LISTS.sub('IN (...)', sql)
+    sql = _VALUES_LISTS.sub('VALUES (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def fingerprint(sql, normalized=False):
+    """Short stable hash of the shape of `sql`"""
+    if not normalized:
+        sql = normalize_sql(sql)
+    return hashlib.sha1(sql.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,329 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db import close_old_connections
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from query_optimizer.analysis_cache import AnalysisCache
+from query_optimizer.capture import without_capture
+from query_optimizer.models import AnalysisJob, QueryAnalysis, QueryPattern, QueryRecord
+from query_optimizer.services import CircuitOpenError, get_optimizer
+from query_optimizer.sinks import capture_alias, get_config
+from query_optimizer.stats import record_analyzed
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Provider errors worth another attempt: timeouts, rate limits and overloads
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {'APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError', 'OverloadedError'}
+
+PROGRESS_FIELDS = ['processed', 'succeeded', 'failed', 'failed_ids', 'last_error', 'updated_at']
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of provider calls.
+
+    Tokens are added at `rate` per second up to `capacity`, which bounds the
+    burst. acquire() blocks the calling thread until a token is available, so
+    one bucket can be shared by every worker calling the same provider.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider):
+    """
+    Return the process-wide bucket of `provider`, or None when it has no limit.
+
+    Limits come from `rate_limits` in QUERY_OPTIMIZER_CONFIG, either as
+    requests per minute or as {"requests_per_minute": ..., "burst": ...}.
+    """
+    limits = (get_config().get('rate_limits') or {}).get(provider)
+    if not limits:
+        return None
+
+    with _limiters_lock:
+        if provider not in _limiters:
+            if isinstance(limits, (int, float)):
+                limits = {'requests_per_minute': limits}
+            _limiters[provider] = TokenBucket(limits['requests_per_minute'] / 60.0, limits.get('burst'))
+        return _limiters[provider]
+
+
+def is_retryable(exc):
+    status_code = getattr(exc, 'status_code', None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return type(exc).__name__ in RETRYABLE_ERRORS or isinstance(exc, (TimeoutError, ConnectionError))
+
+
+def retry_delay(exc, attempt, backoff, max_backoff):
+    """Seconds to wait before the next attempt: the provider's Retry-After, or exponential backoff with full jitter"""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return min(float(retry_after), max_backoff)
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def call_with_retry(func, limiter=None, max_retries=3, backoff=1.0, max_backoff=30.0):
+    """Call `func`, taking a token from `limiter` before each attempt and retrying transient errors"""
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt, backoff, max_backoff)
+            logger.info(f"AI analysis attempt {attempt + 1} failed, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+@without_capture
+def record_analysis(query_record, analysis, cached=False):
+    """Store an analysis result for `query_record`, keeping any analysis it already has"""
+    query_analysis, created = QueryAnalysis.objects.using(capture_alias()).get_or_create(
+        query_record=query_record,
+        defaults={
+            'analysis': analysis,
+            'suggested_optimization': analysis.get('optimization_suggestions', ''),
+            'cached': cached,
+        },
+    )
+    if created:
+        record_analyzed(query_record)
+    return query_analysis
+
+
+def select_candidates(source, limit=None, exclude=()):
+    """
+    Ids of the unanalyzed QueryRecords to analyze, highest priority first.
+
+    The "slow" source takes unanalyzed slow queries by duration. The
+    "patterns" source takes the patterns with the most total database time
+    that have no analysis yet, and picks the slowest recorded execution of
+    each. Ids in `exclude` are skipped.
+    """
+    using = capture_alias()
+    records = QueryRecord.objects.using(using).filter(analysis__isnull=True).exclude(id__in=list(exclude))
+
+    if source == AnalysisJob.SOURCE_PATTERNS:
+        ids = (
+            QueryPattern.objects.using(using)
+            .exclude(fingerprint__in=QueryAnalysis.objects.using(using).values('query_record__fingerprint'))
+            .annotate(record_id=Subquery(
+                records.filter(fingerprint=OuterRef('fingerprint'), view_name=OuterRef('view_name'), release=OuterRef('release'))
+                .order_by('-duration')
+                .values('id')[:1]
+            ))
+            .filter(record_id__isnull=False)
+            .order_by('-estimated_total_duration')
+            .values_list('record_id', flat=True)
+        )
+    else:
+        ids = records.filter(is_slow=True).order_by('-duration', 'id').values_list('id', flat=True)
+
+    if limit is not None:
+        ids = ids[:limit]
+    return list(ids)
+
+
+class BulkAnalyzer:
+    """
+    Runs an AnalysisJob.
+
+    Provider calls run concurrently in a thread pool of `job.concurrency`
+    workers, rate limited per provider and retried with backoff. Records are
+    loaded and results written from the calling thread only, and progress
+    is saved after each chunk, so an interrupted job resumes where it
+    stopped: analyzed records and the ones that failed are not selected
+    again.
+
+    Records whose shape is in the AnalysisCache get the cached analysis
+    without a provider call, and records of a chunk that share a shape are
+    analyzed once.
+    """
+
+    def __init__(self, job, optimizer=None):
+        config = get_config()
+        self.job = job
+        self.using = capture_alias(config)
+        self.optimizer = optimizer or get_optimizer()
+        self.circuit_error = None
+        self.limiter = get_rate_limiter(self.optimizer.provider)
+        self.cache = AnalysisCache(self.optimizer.provider, self.optimizer.model, config)
+        self.max_retries = config.get('analysis_max_retries', 3)
+        self.backoff = config.get('analysis_backoff', 1.0)
+        self.max_backoff = config.get('analysis_max_backoff', 30.0)
+
+    def analyze(self, query_record):
+        return call_with_retry(
+            lambda: self.optimizer.analyze_query(query_record, raise_errors=True),
+            limiter=self.limiter,
+            max_retries=self.max_retries,
+            backoff=self.backoff,
+            max_backoff=self.max_backoff,
+        )
+
+    def is_cancelled(self):
+        return AnalysisJob.objects.using(self.using).filter(pk=self.job.pk, status=AnalysisJob.STATUS_CANCELLED).exists()
+
+    def save_result(self, records, future):
+        """Store the analysis of the first of `records` and share it with the others"""
+        job = self.job
+        query_record = records[0]
+        try:
+            analysis = future.result()
+        except CircuitOpenError as e:
+            # Not the record's fault: leave it for when the provider is back
+            self.circuit_error = str(e)
+            return
+        except Exception as e:
+            # The other records of the shape are left for a later run
+            logger.info(f"AI analysis of query {query_record.id} failed: {e}")
+            job.failed += 1
+            job.failed_ids.append(query_record.id)
+            job.last_error = f"Query {query_record.id}: {e}"
+            job.processed += 1
+            return
+
+        record_analysis(query_record, analysis)
+        self.cache.set(query_record, analysis)
+        for other in records[1:]:
+            record_analysis(other, analysis, cached=True)
+        job.succeeded += len(records)
+        job.processed += len(records)
+
+    def group_by_shape(self, records):
+        """Attach cached analyses, group the other records by cache key and collect their plans"""
+        groups = {}
+        for query_record in records:
+            analysis = self.cache.get(query_record)
+            if analysis is not None:
+                record_analysis(query_record, analysis, cached=True)
+                self.job.succeeded += 1
+                self.job.processed += 1
+                continue
+            key = self.cache.key(query_record)[1] if self.cache.enabled else query_record.id
+            groups.setdefault(key, []).append(query_record)
+
+        # Plans are collected here so that the workers never touch the database
+        for group in groups.values():
+            self.optimizer.prepare(group[0])
+        return list(groups.values())
+
+    def run(self):
+        job = self.job
+        workers = max(job.concurrency, 1)
+        chunk_size = workers * 4
+
+        # Records that already failed in this job are not retried
+        ids = select_candidates(job.source, job.remaining, job.failed_ids)
+        job.started_at = job.started_at or timezone.now()
+        job.total = job.processed + len(ids)
+        # Only start from the status the job was loaded with, so a cancellation made meanwhile stops it
+        started = AnalysisJob.objects.using(self.using).filter(pk=job.pk, status=job.status).update(
+            status=AnalysisJob.STATUS_RUNNING, started_at=job.started_at, finished_at=None, total=job.total,
+            updated_at=timezone.now(),
+        )
+        if not started:
+            job.refresh_from_db(using=self.using)
+            logger.info(f"Analysis job {job.pk} was not started, it is {job.status}")
+            return job
+        job.status = AnalysisJob.STATUS_RUNNING
+        job.finished_at = None
+
+        # Only a status set here is saved at the end, so a cancellation made meanwhile is kept
+        status = None
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query-optimizer-analysis') as executor:
+                for start in range(0, len(ids), chunk_size):
+                    if self.is_cancelled():
+                        status = AnalysisJob.STATUS_CANCELLED
+                        break
+
+                    records = (
+                        QueryRecord.objects.using(self.using).select_related('stack')
+                        .filter(id__in=ids[start:start + chunk_size], analysis__isnull=True)
+                    )
+                    futures = {executor.submit(self.analyze, group[0]): group for group in self.group_by_shape(records)}
+                    for future in as_completed(futures):
+                        self.save_result(futures[future], future)
+
+                    job.save(using=self.using, update_fields=PROGRESS_FIELDS)
+
+                    if self.circuit_error:
+                        status = AnalysisJob.STATUS_FAILED
+                        job.last_error = self.circuit_error
+                        break
+                else:
+                    # The job may have been cancelled during its last chunk
+                    status = AnalysisJob.STATUS_CANCELLED if self.is_cancelled() else AnalysisJob.STATUS_COMPLETED
+        except Exception as e:
+            logger.error(f"Analysis job {job.pk} failed: {str(e)}", exc_info=True)
+            status = AnalysisJob.STATUS_FAILED
+            job.last_error = str(e)
+        finally:
+            job.finished_at = timezone.now()
+            fields = PROGRESS_FIELDS + ['finished_at']
+            if status is not None:
+                job.status = status
+                fields.append('status')
+            job.save(using=self.using, update_fields=fields)
+
+        logger.info(
+            f"Analysis job {job.pk} {job.status}: {job.succeeded} analyzed, "
+            f"{job.failed} failed out of {job.processed} processed"
+        )
+        return job
+
+
+def run_job(job_id):
+    """Run the job with id `job_id` (target of the background thread)"""
+    try:
+        BulkAnalyzer(AnalysisJob.objects.using(capture_alias()).get(pk=job_id)).run()
+    except Exception as e:
+        logger.error(f"Analysis job {job_id} could not run: {str(e)}", exc_info=True)
+        AnalysisJob.objects.using(capture_alias()).filter(pk=job_id).update(
+            status=AnalysisJob.STATUS_FAILED, last_error=str(e), finished_at=timezone.now()
+        )
+    finally:
+        close_old_connections()
+
+
+def start_job(job):
+    """Run `job` in a background thread of the current process"""
+    thread = threading.Thread(target=run_job, args=(job.pk,), name=f'query-optimizer-job-{job.pk}', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,19 @@
+from django.db.models import Lookup
+from django.db.models.lookups import IContains
+
+
+class TrigramContains(IContains):
+    """
+    Case-insensitive substring match that PostgreSQL can answer from a pg_trgm index.
+
+    `icontains` compares UPPER("column"::text) on PostgreSQL, which a trigram
+    index on the bare column cannot serve. This lookup emits
+    `"column" ILIKE %s` there instead, and is `icontains` on other backends.
+    Registered as `trigram_contains` on the view_name fields.
+    """
+
+    def as_postgresql(self, compiler, connection):
+        # Skip the UPPER(...::text) cast BuiltinLookup adds to the column
+        lhs_sql, lhs_params = Lookup.process_lhs(self, compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs_sql} ILIKE {rhs_sql}", (*lhs_params, *rhs_params)
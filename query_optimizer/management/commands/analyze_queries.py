@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from query_optimizer.batches import submit_batches
+from query_optimizer.jobs import BulkAnalyzer
+from query_optimizer.models import AnalysisJob
+from query_optimizer.sinks import capture_alias
+
+
+class Command(BaseCommand):
+    help = "Analyze unanalyzed slow queries or top query patterns with the configured AI provider"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source', choices=[choice for choice, _ in AnalysisJob.SOURCE_CHOICES], default=AnalysisJob.SOURCE_SLOW,
+            help="Pick the slowest unanalyzed queries (slow) or the patterns with the most total time (patterns)",
+        )
+        parser.add_argument('--limit', type=int, default=None, help="Analyze at most this many queries")
+        parser.add_argument('--concurrency', type=int, default=4, help="Provider calls running at the same time")
+        parser.add_argument('--resume', type=int, metavar='JOB_ID', help="Continue an interrupted job")
+        parser.add_argument(
+            '--batch', action='store_true',
+            help="Submit the queries to the provider's batch API instead, and collect them later with collect_batches",
+        )
+
+    def handle(self, *args, **options):
+        if options['batch']:
+            return self.submit(options)
+
+        if options['resume']:
+            try:
+                job = AnalysisJob.objects.using(capture_alias()).get(pk=options['resume'])
+            except AnalysisJob.DoesNotExist:
+                raise CommandError(f"Analysis job {options['resume']} does not exist")
+            if job.status == AnalysisJob.STATUS_COMPLETED:
+                raise CommandError(f"Analysis job {job.pk} is already completed")
+        else:
+            if options['concurrency'] < 1:
+                raise CommandError("--concurrency must be at least 1")
+            job = AnalysisJob.objects.using(capture_alias()).create(
+                source=options['source'],
+                limit=options['limit'],
+                concurrency=options['concurrency'],
+            )
+
+        self.stdout.write(f"Running analysis job {job.pk} ({job.get_source_display()})")
+        try:
+            job = BulkAnalyzer(job).run()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        message = f"Job {job.pk} {job.status}: {job.succeeded} analyzed, {job.failed} failed"
+        if job.status == AnalysisJob.STATUS_COMPLETED:
+            self.stdout.write(self.style.SUCCESS(message))
+        else:
+            self.stdout.write(self.style.WARNING(f"{message}. Resume with --resume {job.pk}"))
+
+    def submit(self, options):
+        try:
+            batches = submit_batches(options['source'], options['limit'])
+        except (ValueError, NotImplementedError) as e:
+            raise CommandError(str(e))
+
+        if not batches:
+            self.stdout.write("No queries to submit")
+            return
+        for batch in batches:
+            self.stdout.write(f"Submitted batch {batch.batch_id} covering {batch.size} queries")
+        self.stdout.write(self.style.SUCCESS("Run collect_batches once the provider has processed them"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from query_optimizer.batches import collect_batches
+from query_optimizer.models import AnalysisBatch
+from query_optimizer.sinks import capture_alias
+import time
+
+
+class Command(BaseCommand):
+    help = "Collect the results of analysis batches submitted with analyze_queries --batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wait', action='store_true', help="Keep polling until every batch is collected")
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds between polls with --wait")
+
+    def handle(self, *args, **options):
+        submitted = list(AnalysisBatch.objects.using(capture_alias()).filter(status=AnalysisBatch.STATUS_SUBMITTED).values_list('pk', flat=True))
+        if not submitted:
+            self.stdout.write("No pending batches")
+            return
+
+        while True:
+            pending = collect_batches()
+            if not pending or not options['wait']:
+                break
+            self.stdout.write(f"{len(pending)} batches still in progress, checking again in {options['interval']:.0f}s")
+            time.sleep(options['interval'])
+
+        done = AnalysisBatch.objects.using(capture_alias()).filter(pk__in=submitted).exclude(status=AnalysisBatch.STATUS_SUBMITTED)
+        for batch in done:
+            message = f"Batch {batch.batch_id} {batch.status}: {batch.succeeded} analyzed, {batch.failed} failed"
+            if batch.status == AnalysisBatch.STATUS_COLLECTED:
+                self.stdout.write(self.style.SUCCESS(message))
+            else:
+                self.stdout.write(self.style.WARNING(f"{message}. {batch.last_error}"))
+        if pending:
+            self.stdout.write(self.style.WARNING(f"{len(pending)} batches are still in progress"))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from query_optimizer.regressions import RegressionDetector
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = "Find query shapes that got slower between two releases or two time windows and record them as regressions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--baseline', help="Release to compare against (defaults to the one before the candidate)")
+        parser.add_argument('--candidate', help="Release to check (defaults to the latest tagged release)")
+        parser.add_argument(
+            '--window',
+            type=float,
+            metavar='HOURS',
+            help="Compare the last HOURS hours with the HOURS hours before them instead of releases",
+        )
+        parser.add_argument('--min-count', type=int, help="Executions needed on each side (defaults to regression_min_count)")
+        parser.add_argument('--threshold', type=float, help="Relative growth of the median or p95 that counts, e.g. 0.2")
+        parser.add_argument('--alpha', type=float, help="Significance level of the Mann-Whitney test")
+
+    def handle(self, *args, **options):
+        try:
+            detector = RegressionDetector(min_count=options['min_count'], threshold=options['threshold'], alpha=options['alpha'])
+            if options['window']:
+                end = timezone.now()
+                length = timedelta(hours=options['window'])
+                regressions = detector.detect_windows(end - 2 * length, end - length, end - length, end)
+            else:
+                regressions = detector.detect_releases(options['baseline'], options['candidate'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS("No query regression found"))
+            return
+
+        self.stdout.write(f"{len(regressions)} query regressions in {regressions[0].candidate}, compared with {regressions[0].baseline}:")
+        for regression in regressions:
+            self.stdout.write(self.style.WARNING(
+                f"+{regression.added_time:.3f}s in {regression.view_name or 'unknown view'}: "
+                f"p50 {regression.baseline_p50 * 1000:.1f}ms -> {regression.candidate_p50 * 1000:.1f}ms, "
+                f"p95 {regression.baseline_p95 * 1000:.1f}ms -> {regression.candidate_p95 * 1000:.1f}ms "
+                f"(p={regression.p_value:.2g}) {regression.short_query}"
+            ))
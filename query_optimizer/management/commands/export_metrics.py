@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from query_optimizer.metrics import get_metrics
+from pathlib import Path
+import os
+
+
+class Command(BaseCommand):
+    help = "Write the query metrics of every worker to a Prometheus text file, e.g. for the node_exporter textfile collector"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write, replaced atomically")
+
+    def handle(self, *args, **options):
+        metrics = get_metrics()
+        if metrics is None or metrics.snapshot_dir is None:
+            raise CommandError("Set metrics and metrics_dir in QUERY_OPTIMIZER_CONFIG to export the workers' metrics")
+
+        output = Path(options['output'])
+        temp = output.with_name(f".{output.name}.{os.getpid()}")
+        # This process serves no request: only the workers' snapshots count
+        temp.write_text(metrics.render(include_live=False))
+        os.replace(temp, output)
+        self.stdout.write(self.style.SUCCESS(f"Wrote the query metrics to {output}"))
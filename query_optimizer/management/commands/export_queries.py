@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from query_optimizer.export import EXPORT_FORMATS, Exporter
+from datetime import datetime
+
+
+def parse_moment(value):
+    """A date (YYYY-MM-DD, midnight) or datetime in the current time zone"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f"Invalid date: {value}")
+        moment = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(moment) and timezone.is_aware(timezone.now()):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = "Export captured queries to a Parquet, Arrow or binary log file for offline analysis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write; .parquet, .arrow and .qlog select the format")
+        parser.add_argument('--format', choices=EXPORT_FORMATS, help="Format, when the extension does not tell it")
+        parser.add_argument('--since', help="Only queries captured from this date or datetime")
+        parser.add_argument('--until', help="Only queries captured before this date or datetime")
+        parser.add_argument('--chunk-size', type=int, help="Rows fetched from the database at a time")
+        parser.add_argument('--include-sql', action='store_true', help="Also export the SQL text (Parquet and Arrow)")
+
+    def handle(self, *args, **options):
+        try:
+            exporter = Exporter(
+                options['output'],
+                export_format=options['format'],
+                chunk_size=options['chunk_size'],
+                include_sql=options['include_sql'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        since = parse_moment(options['since']) if options['since'] else None
+        until = parse_moment(options['until']) if options['until'] else None
+        try:
+            count = exporter.export(since, until)
+        except ImportError as e:
+            raise CommandError(f"The {exporter.format} format needs pyarrow ({e}), or export to a .qlog binary log")
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} queries to {options['output']}"))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from query_optimizer.retention import Pruner
+
+
+class Command(BaseCommand):
+    help = "Delete or archive captured queries older than the retention period, compacting them into pattern rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Keep this many days of queries (defaults to retention_days)")
+        parser.add_argument('--batch-size', type=int, help="Queries deleted per transaction")
+        parser.add_argument('--archive-dir', help="Write the pruned queries to gzipped JSON lines files in this directory")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the queries that would be pruned")
+        parser.add_argument(
+            '--create-partitions',
+            type=int,
+            metavar='DAYS',
+            help="On a partitioned PostgreSQL table, also create the daily partitions of the next DAYS days",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            pruner = Pruner(days=options['days'], batch_size=options['batch_size'], archive_dir=options['archive_dir'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['dry_run']:
+            self.stdout.write(f"{pruner.expired().count()} queries are older than {pruner.cutoff}")
+            return
+
+        if options['create_partitions'] is not None:
+            created = pruner.create_partitions(options['create_partitions'])
+            if created:
+                self.stdout.write(f"Partitions up to {created[-1]} are in place")
+            else:
+                self.stdout.write(self.style.WARNING("The query table is not partitioned, no partition was created"))
+
+        deleted = pruner.prune()
+        self.stdout.write(self.style.SUCCESS(f"Pruned {deleted} queries older than {pruner.cutoff}"))
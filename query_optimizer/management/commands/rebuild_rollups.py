@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from query_optimizer.sinks import capture_alias
+from query_optimizer.stats import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the hourly query rollups shown on the dashboard from the stored queries"
+
+    def handle(self, *args, **options):
+        count = rebuild_rollups(capture_alias())
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} rollups"))
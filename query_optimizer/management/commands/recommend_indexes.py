@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+from query_optimizer.advisor import IndexAdvisor
+import json
+
+
+class Command(BaseCommand):
+    help = "Recommend indexes for the captured workload, ranked by the query time they would serve"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help="Database whose tables and indexes are checked")
+        parser.add_argument('--limit', type=int, default=10, help="Number of indexes to recommend")
+        parser.add_argument('--min-rows', type=int, help="Skip tables with fewer rows (defaults to advisor_min_rows)")
+        parser.add_argument(
+            '--what-if',
+            metavar='DATABASE',
+            help="Check each index with EXPLAIN on this scratch database (PostgreSQL or SQLite), inside a rolled back transaction",
+        )
+        parser.add_argument('--json', action='store_true', help="Print the recommendations as JSON")
+
+    def handle(self, *args, **options):
+        for alias in filter(None, [options['database'], options['what_if']]):
+            if alias not in connections:
+                raise CommandError(f"Unknown database alias: {alias}")
+
+        advisor = IndexAdvisor(using=options['database'], min_rows=options['min_rows'])
+        candidates = advisor.recommend(options['limit'])
+        if options['what_if']:
+            for candidate in candidates:
+                try:
+                    advisor.what_if(candidate, options['what_if'])
+                except (ValueError, DatabaseError) as e:
+                    raise CommandError(f"What-if check of {candidate.table} failed: {e}")
+
+        if options['json']:
+            self.stdout.write(json.dumps([candidate.as_dict() for candidate in candidates], indent=2))
+            return
+
+        if not candidates:
+            self.stdout.write("No index to recommend for the captured workload")
+            return
+
+        connection = connections[options['database']]
+        for rank, candidate in enumerate(candidates, 1):
+            self.stdout.write(self.style.SUCCESS(
+                f"{rank}. {candidate.table} ({', '.join(candidate.as_dict()['columns'])}): "
+                f"serves {candidate.served_time:.3f}s in {len(candidate.fingerprints)} query patterns, "
+                f"estimated benefit {candidate.benefit:.3f}s"
+            ))
+            if candidate.extends:
+                self.stdout.write(f"   Extends the existing index {candidate.extends}")
+            if candidate.model is not None:
+                self.stdout.write(f"   {candidate.model._meta.label} Meta.indexes: {candidate.meta_snippet()}")
+                self.stdout.write("   Migration operation:")
+                for line in candidate.migration_snippet().splitlines():
+                    self.stdout.write(f"     {line}")
+            else:
+                self.stdout.write(f"   SQL: {candidate.sql(connection)};")
+            for result in candidate.what_if or []:
+                change = ''
+                if result['cost_before'] is not None and result['cost_after'] is not None:
+                    change = f", cost {result['cost_before']:.1f} -> {result['cost_after']:.1f}"
+                used = 'uses the index' if result['uses_index'] else 'does not use the index'
+                self.stdout.write(f"   What-if: {used}{change}: {result['query'][:80]}")
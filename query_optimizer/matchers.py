@@ -0,0 +1,95 @@
+from django.apps import apps
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixMatcher:
+    """
+    Matches paths against a set of prefixes with one compiled regex.
+
+    Alternatives are ordered longest first, so match() returns the longest
+    prefix that applies.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = sorted(set(prefixes), key=len, reverse=True)
+        self.pattern = None
+        if self.prefixes:
+            self.pattern = re.compile('|'.join(re.escape(prefix) for prefix in self.prefixes))
+
+    def __bool__(self):
+        return self.pattern is not None
+
+    def match(self, path):
+        """Return the longest prefix of `path` in the set, or None"""
+        if self.pattern is None:
+            return None
+        found = self.pattern.match(path)
+        return found.group(0) if found else None
+
+
+def resolve_tables(names):
+    """
+    Map watched model names to the database tables they use.
+
+    A name may be "app_label.ModelName", a bare model name (every installed
+    model with that name matches, case-insensitively) or a table name. The
+    auto-created many-to-many tables of a model are watched with it. Names
+    that match no model are kept as table names.
+    """
+    models = apps.get_models()
+    tables = set()
+    for name in names:
+        if '.' in name:
+            try:
+                matched = [apps.get_model(name)]
+            except (LookupError, ValueError):
+                matched = []
+        else:
+            matched = [model for model in models if model.__name__.lower() == name.lower()]
+
+        if not matched:
+            logger.debug(f"Watched model {name} is not an installed model, matching it as a table name")
+            tables.add(name)
+            continue
+
+        for model in matched:
+            tables.add(model._meta.db_table)
+            for field in model._meta.local_many_to_many:
+                if field.remote_field.through._meta.auto_created:
+                    tables.add(field.remote_field.through._meta.db_table)
+    return tables
+
+
+class TableMatcher:
+    """
+    Tells whether a SQL statement touches one of a set of tables.
+
+    A single compiled pattern scans the statement once. String literals are
+    consumed as a whole so a table name inside a literal does not match, and
+    names must stand alone: "app_user" does not match "app_user_profile".
+    Quoting with "", `` or [] is accepted.
+    """
+
+    def __init__(self, tables):
+        self.tables = sorted(tables, key=len, reverse=True)
+        self.pattern = None
+        if self.tables:
+            names = '|'.join(re.escape(table) for table in self.tables)
+            self.pattern = re.compile(
+                r"'(?:[^']|'')*'|(?<![\w$])[\"`\[]?(" + names + r")[\"`\]]?(?![\w$])",
+                re.IGNORECASE,
+            )
+
+    def __bool__(self):
+        return self.pattern is not None
+
+    def matches(self, sql):
+        if self.pattern is None:
+            return True
+        for found in self.pattern.finditer(sql):
+            if found.group(1):
+                return True
+        return False
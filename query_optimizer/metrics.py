@@ -0,0 +1,261 @@
+from query_optimizer.fingerprint import fingerprint, normalize_sql
+from query_optimizer.sinks import get_config
+from bisect import bisect_left
+from functools import lru_cache
+from pathlib import Path
+import json
+import os
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Fingerprint label of the series beyond `metrics_max_series`
+OTHER = 'other'
+
+COUNTERS = {
+    'requests_total': ('view', "Requests whose queries were measured"),
+    'queries_total': ('view', "Queries run"),
+    'slow_queries_total': ('view', "Queries slower than slow_query_threshold"),
+    'n_plus_one_total': ('view', "N+1 patterns detected"),
+    'budget_violations_total': ('view', "Requests over their query budget"),
+    'capture_dropped_total': ('source', "Capture events dropped by the buffer or the writer"),
+}
+GAUGES = {
+    'capture_queue_depth': ('source', "Capture events waiting to be written"),
+}
+
+
+@lru_cache(maxsize=8192)
+def template_fingerprint(sql):
+    """Fingerprint of a statement as sent to the driver, cached since templates repeat"""
+    return fingerprint(normalize_sql(sql), normalized=True)
+
+
+class MetricShard:
+    """Counters and histograms of one thread, which is the only one writing to them"""
+
+    def __init__(self, size):
+        self.size = size
+        self.counters = {}
+        # (view, fingerprint): [per-bucket counts, sum, count]
+        self.histograms = {}
+
+    def inc(self, key, value=1):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, key, index, value):
+        series = self.histograms.get(key)
+        if series is None:
+            series = self.histograms[key] = [[0] * self.size, 0.0, 0]
+        series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+
+class QueryMetrics:
+    """
+    In-process query telemetry.
+
+    Each thread records into its own MetricShard without taking a lock: a
+    histogram of query duration per view and fingerprint, and counters of
+    requests, queries, slow queries, N+1 patterns and budget violations per
+    view. The shards are only merged when the metrics are scraped.
+
+    At most `max_series` (view, fingerprint) series are kept per thread;
+    later fingerprints are counted under "other".
+
+    With `snapshot_dir`, every process writes its merged metrics to
+    <pid>.json there at most every `snapshot_interval` seconds, and render()
+    sums the snapshots of every process, so any worker of a multiprocess
+    server can answer a scrape. Counters of exited workers are kept; their
+    gauges expire after three intervals.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_series=2000, snapshot_dir=None, snapshot_interval=10.0):
+        self.buckets = tuple(sorted(buckets))
+        self.max_series = max_series
+        self.snapshot_dir = Path(snapshot_dir) if snapshot_dir else None
+        self.snapshot_interval = snapshot_interval
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._next_snapshot = 0.0
+
+    def shard(self):
+        if os.getpid() != self._pid:
+            # A forked worker starts from zero rather than from its parent's counts
+            with self._lock:
+                self._shards = []
+                self._local = threading.local()
+                self._pid = os.getpid()
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = MetricShard(len(self.buckets) + 1)
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def observe_request(self, view_name, timings, slow_query_threshold, n_plus_one=0, over_budget=False):
+        """Record the (sql, duration) of every query run by a request"""
+        shard = self.shard()
+        view = view_name or ''
+        slow = 0
+        for sql, duration in timings:
+            key = (view, template_fingerprint(sql))
+            if key not in shard.histograms and len(shard.histograms) >= self.max_series:
+                key = (view, OTHER)
+            shard.observe(key, bisect_left(self.buckets, duration), duration)
+            if duration > slow_query_threshold:
+                slow += 1
+
+        shard.inc(('requests_total', view))
+        shard.inc(('queries_total', view), len(timings))
+        if slow:
+            shard.inc(('slow_queries_total', view), slow)
+        if n_plus_one:
+            shard.inc(('n_plus_one_total', view), n_plus_one)
+        if over_budget:
+            shard.inc(('budget_violations_total', view))
+
+        if self.snapshot_dir is not None and time.monotonic() >= self._next_snapshot:
+            self._next_snapshot = time.monotonic() + self.snapshot_interval
+            self.write_snapshot()
+
+    def collect(self):
+        """Merge the shards of this process with its capture queue statistics"""
+        counters, histograms = {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, total, count) in list(shard.histograms.items()):
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+
+        gauges = {}
+        for source, stats in capture_queue_stats().items():
+            counters[('capture_dropped_total', source)] = stats['dropped']
+            gauges[('capture_queue_depth', source)] = max(stats['depth'], 0)
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def write_snapshot(self):
+        """Atomically replace this process's snapshot in `snapshot_dir`"""
+        data = self.collect()
+        snapshot = {
+            'counters': [[name, label, value] for (name, label), value in data['counters'].items()],
+            'histograms': [[view, fp, *series] for (view, fp), series in data['histograms'].items()],
+            'gauges': [[name, label, value] for (name, label), value in data['gauges'].items()],
+        }
+        try:
+            self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+            handle, temp = tempfile.mkstemp(dir=self.snapshot_dir, suffix='.tmp')
+            with os.fdopen(handle, 'w') as file:
+                json.dump(snapshot, file)
+            os.replace(temp, self.snapshot_dir / f"{os.getpid()}.json")
+        except OSError as e:
+            logger.error(f"Failed to write the query metrics snapshot: {str(e)}")
+
+    def merged(self, include_live=True):
+        """Metrics of this process summed with the snapshots of the others"""
+        data = self.collect() if include_live else {'counters': {}, 'histograms': {}, 'gauges': {}}
+        if self.snapshot_dir is None or not self.snapshot_dir.is_dir():
+            return data
+
+        fresh_after = time.time() - 3 * self.snapshot_interval
+        for path in self.snapshot_dir.glob('*.json'):
+            if include_live and path.stem == str(os.getpid()):
+                continue
+            try:
+                snapshot = json.loads(path.read_text())
+                fresh = path.stat().st_mtime >= fresh_after
+            except (OSError, ValueError):
+                continue
+            for name, label, value in snapshot['counters']:
+                data['counters'][(name, label)] = data['counters'].get((name, label), 0) + value
+            for view, fp, buckets, total, count in snapshot['histograms']:
+                merged = data['histograms'].setdefault((view, fp), [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            if fresh:
+                for name, label, value in snapshot['gauges']:
+                    data['gauges'][(name, label)] = data['gauges'].get((name, label), 0) + value
+        return data
+
+    def render(self, include_live=True):
+        """The metrics in the Prometheus text exposition format"""
+        data = self.merged(include_live)
+        lines = []
+        name = 'query_optimizer_query_duration_seconds'
+        lines.append(f"# HELP {name} Duration of the queries run by each view, per query fingerprint")
+        lines.append(f"# TYPE {name} histogram")
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for (view, fp), (buckets, total, count) in sorted(data['histograms'].items()):
+            labels = f'view="{escape(view)}",fingerprint="{escape(fp)}"'
+            cumulative = 0
+            for bound, value in zip(bounds, buckets):
+                cumulative += value
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {format_value(total)}')
+            lines.append(f'{name}_count{{{labels}}} {count}')
+
+        for kind, families, values in [('counter', COUNTERS, data['counters']), ('gauge', GAUGES, data['gauges'])]:
+            for family, (label, help_text) in families.items():
+                name = f'query_optimizer_{family}'
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (sample, value_label), value in sorted(values.items()):
+                    if sample == family:
+                        lines.append(f'{name}{{{label}="{escape(value_label)}"}} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def capture_queue_stats():
+    """Statistics of the capture buffer and writer of this process, when they exist"""
+    from query_optimizer import sinks, writer
+    stats = {}
+    if sinks._buffer is not None:
+        stats['buffer'] = sinks._buffer.stats()
+    if writer._writer is not None:
+        stats['writer'] = writer._writer.stats()
+    return stats
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return the process-wide QueryMetrics, or None unless `metrics` is on in the config"""
+    global _metrics
+    if _metrics is None:
+        config = get_config()
+        if not config.get('metrics', False):
+            return None
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = QueryMetrics(
+                    buckets=config.get('metrics_buckets', DEFAULT_BUCKETS),
+                    max_series=config.get('metrics_max_series', 2000),
+                    snapshot_dir=config.get('metrics_dir'),
+                    snapshot_interval=config.get('metrics_snapshot_interval', 10.0),
+                )
+    return _metrics
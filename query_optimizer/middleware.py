@@ -1,17 +1,31 @@
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
-from django.db import connection
-from query_optimizer.models import QueryRecord
+from django.db import connections
+from django.utils import timezone
+from query_optimizer.budgets import QueryBudgets, QueryUsage, server_timing
+from query_optimizer.capture import QueryCollector, capture_queries
+from query_optimizer.detectors import NPlusOneDetector
+from query_optimizer.matchers import PrefixMatcher, TableMatcher, resolve_tables
+from query_optimizer.metrics import get_metrics
+from query_optimizer.sampling import RequestSampler
+from query_optimizer.sinks import RequestSink, CAPTURE_ISOLATION_MODES, PERSISTENCE_MODES, application_aliases, capture_alias
 import time
-import traceback
 import logging
-from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
 
 class QueryCaptureMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Django runs sync view hooks through sync_to_async on every request
+            self.process_view = self.aprocess_view
         self.config = getattr(settings, 'QUERY_OPTIMIZER_CONFIG', None)
         if not self.config:
             raise ValueError("QUERY_OPTIMIZER_CONFIG is not set in settings.py")
@@ -19,7 +33,26 @@ class QueryCaptureMiddleware:
         self.watched_models = self.config.get('watched_models', [])
         self.excluded_paths = self.config.get('excluded_paths', []) + ['/admin/', '/static/', '/media/']
         self.slow_query_threshold = self.config.get('slow_query_threshold', 0.5)
+        self.min_query_duration = self.config.get('min_query_duration', 0.0)
+        self.query_sample_rate = self.config.get('query_sample_rate', 1.0)
+        self.capture_stack = self.config.get('capture_stack', True)
+        self.stack_sample_rate = self.config.get('stack_sample_rate', 0.0)
+        self.n_plus_one_threshold = self.config.get('n_plus_one_threshold', 10)
+        self.databases = self.config.get('databases', None)
+        self.persistence = self.config.get('persistence', 'request')
+        self.capture_isolation = self.config.get('capture_isolation', 'auto')
+        self.sampler = RequestSampler(self.config)
+        self.budgets = QueryBudgets(self.config)
+        self.server_timing = self.config.get('server_timing', False)
+        self.metrics = get_metrics()
         self.check_config()
+
+        # Compile the per-request and per-query filters once
+        self.excluded_path_matcher = PrefixMatcher(self.excluded_paths)
+        self.table_matcher = TableMatcher(resolve_tables(self.watched_models))
+
+        # A dedicated capture database only holds the package's own queries
+        self.capture_databases = self.databases if self.databases is not None else application_aliases(self.config)
     
     def check_config(self):
         if self.watched_models and not isinstance(self.watched_models, list):
@@ -31,11 +64,33 @@ class QueryCaptureMiddleware:
         if self.slow_query_threshold and not any([isinstance(self.slow_query_threshold, float), isinstance(self.slow_query_threshold, int)]):
             raise ValueError("slow_query_threshold must be a float or int")
 
+        if not 0.0 <= self.query_sample_rate <= 1.0:
+            raise ValueError("query_sample_rate must be between 0.0 and 1.0")
+
+        if not 0.0 <= self.stack_sample_rate <= 1.0:
+            raise ValueError("stack_sample_rate must be between 0.0 and 1.0")
+
+        if self.databases is not None:
+            unknown = set(self.databases) - set(connections)
+            if unknown:
+                raise ValueError(f"databases contains unknown aliases: {', '.join(sorted(unknown))}")
+
+        if self.n_plus_one_threshold and not isinstance(self.n_plus_one_threshold, int):
+            raise ValueError("n_plus_one_threshold must be an int")
+
+        if self.persistence not in PERSISTENCE_MODES:
+            raise ValueError(f"persistence must be one of {', '.join(PERSISTENCE_MODES)}")
+
+        if capture_alias(self.config) not in connections:
+            raise ValueError(f"database is not an alias of DATABASES: {capture_alias(self.config)}")
+
+        if self.capture_isolation not in CAPTURE_ISOLATION_MODES:
+            raise ValueError(f"capture_isolation must be one of {', '.join(CAPTURE_ISOLATION_MODES)}")
+
     def should_capture(self, request):
         """Determine if we should capture queries for this request"""
         # Skip excluded paths
-        path = urlparse(request.path).path
-        return not any(path.startswith(excluded) for excluded in self.excluded_paths)
+        return self.excluded_path_matcher.match(request.path) is None
             
         # Check if it's an API request
         # if hasattr(request, 'accepted_renderer'):
@@ -54,64 +109,208 @@ class QueryCaptureMiddleware:
         # For Django views
         return resolver_match.view_name if resolver_match.view_name else resolver_match.url_name
 
-    def is_watched_model_query(self, query):
-        """Check if query involves watched models"""
-        if not self.watched_models:
-            return True
-            
-        sql_lower = query['sql'].lower()
-        return any(model.lower() in sql_lower for model in self.watched_models)
+    def is_watched_model_query(self, sql):
+        """Check if query involves the tables of watched models"""
+        return self.table_matcher.matches(sql)
+
+    def get_collector(self):
+        """Build the collector that times and filters the queries of one request"""
+        return QueryCollector(
+            slow_query_threshold=self.slow_query_threshold,
+            min_duration=self.min_query_duration,
+            sample_rate=self.query_sample_rate,
+            capture_stack=self.capture_stack,
+            stack_sample_rate=self.stack_sample_rate,
+            query_filter=self.is_watched_model_query if self.table_matcher else None,
+            detector=NPlusOneDetector(self.n_plus_one_threshold, self.capture_stack) if self.n_plus_one_threshold else None,
+            track_duplicates=self.budgets.tracks_duplicates,
+            keep_timings=self.metrics is not None,
+            # Unsampled requests are only worth tracking query by query when they can be promoted
+            keep_light=self.sampler.can_promote or self.budgets.is_enabled,
+        )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Apply the view's own sample rate, now that the view is resolved"""
+        collector = getattr(request, '_query_collector', None)
+        if collector is None or not self.sampler.is_enabled:
+            return None
+
+        rate = self.sampler.rate_for_view(self.get_view_name(request))
+        if rate is not None:
+            request._query_sample_rate = rate
+            collector.sampled = request._query_sample_draw < rate
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return QueryCaptureMiddleware.process_view(self, request, view_func, view_args, view_kwargs)
 
     def __call__(self, request):
-        if not self.should_capture(request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        collector = self.start_capture(request)
+        if collector is None:
             return self.get_response(request)
 
-        # Reset query tracking at the start of the request
-        request._query_start_time = time.time()
-        initial_query_count = len(connection.queries)
-        
-        response = self.get_response(request)
+        with capture_queries(collector, self.capture_databases):
+            response = self.get_response(request)
+
+        breach = self.check_budget(request, collector)
+        sink = self.finish_capture(request, response, collector, breach)
+        self.record_metrics(request, collector, sink, breach)
+        if sink is not None:
+            sink.flush()
+            self.report(request, collector)
+        self.add_server_timing(response, collector)
+        self.budgets.enforce(breach)
+        return response
+
+    async def __acall__(self, request):
+        collector = self.start_capture(request)
+        if collector is None:
+            return await self.get_response(request)
+
+        with capture_queries(collector, self.capture_databases):
+            response = await self.get_response(request)
+
+        breach = self.check_budget(request, collector)
+        sink = self.finish_capture(request, response, collector, breach)
+        self.record_metrics(request, collector, sink, breach)
+        if sink is not None:
+            await sink.aflush()
+            self.report(request, collector)
+        self.add_server_timing(response, collector)
+        self.budgets.enforce(breach)
+        return response
+
+    def start_capture(self, request):
+        """Return the collector for this request, or None when it is not captured"""
+        if not self.should_capture(request):
+            return None
+
+        request._query_start_time = time.perf_counter()
+        collector = self.get_collector()
+        request._query_collector = collector
+        if self.sampler.is_enabled:
+            request._query_sample_rate = self.sampler.rate_for_path(request.path)
+            request._query_sample_draw = self.sampler.draw()
+            collector.sampled = request._query_sample_draw < request._query_sample_rate
+        return collector
+
+    def check_budget(self, request, collector):
+        """Return the BudgetBreach of this request, or None when it is within its query budget"""
+        if not self.budgets.is_enabled:
+            return None
+        breach = self.budgets.check(QueryUsage.from_collector(collector), request.path, self.get_view_name(request))
+        if breach is not None:
+            logger.warning(f"{breach.describe()} in {request.method} {request.path}")
+        return breach
+
+    def record_metrics(self, request, collector, sink, breach):
+        """Feed every query of the request to the in-process metrics"""
+        if self.metrics is None:
+            return
+        n_plus_one = sum(1 for event in sink.events if event.get('kind') == 'n_plus_one') if sink is not None else 0
+        self.metrics.observe_request(
+            self.get_view_name(request), collector.timings, self.slow_query_threshold,
+            n_plus_one=n_plus_one, over_budget=breach is not None,
+        )
+
+    def add_server_timing(self, response, collector):
+        """Report the request's database time and query count in a Server-Timing header"""
+        if not self.server_timing:
+            return
+        value = server_timing(QueryUsage.from_collector(collector))
+        if response.has_header('Server-Timing'):
+            value = f"{response['Server-Timing']}, {value}"
+        response['Server-Timing'] = value
+
+    def finish_capture(self, request, response, collector, breach=None):
+        """
+        Turn what the collector kept into events for the sink.
+
+        Requests over their query budget are captured whatever their sample
+        rate. Returns the sink to flush, or None when the request was not
+        sampled.
+        """
+        request._query_finish_time = time.perf_counter()
+        request_time = request._query_finish_time - request._query_start_time
+        over_budget = self.sampler.is_over_budget(request_time, collector.count) or breach is not None
+        if not collector.sampled and not over_budget:
+            collector.discard()
+            return None
+
+        # Weight rows by the inverse of the probability they were captured
+        request_weight = 1.0
+        if self.sampler.is_enabled and not over_budget and request._query_sample_rate > 0:
+            request_weight = 1.0 / request._query_sample_rate
+        collector.promote()
         
         # Process captured queries
         view_name = self.get_view_name(request)
+        sink = RequestSink()
         
-        for query in connection.queries[initial_query_count:]:
-            if not self.is_watched_model_query(query):
-                continue
-                
+        for query in collector.queries:
             try:
-                duration = float(query['time'])
-                is_slow = duration > self.slow_query_threshold
+                is_slow = collector.is_slow(query.duration)
                 
-                QueryRecord.objects.create(
-                    query=query['sql'],
-                    duration=duration,
+                sink.add(
+                    query=query.sql,
+                    duration=query.duration,
                     is_slow=is_slow,
+                    sample_weight=request_weight * query.weight,
+                    db_alias=query.alias,
                     view_name=view_name,
                     url_path=request.path,
-                    stack_trace='\n'.join(traceback.format_stack()[:-2]),
+                    stack_frames=query.frames,
                     query_params=dict(request.GET),
                     request_method=request.method,
                     request_content_type=request.content_type,
                     response_status_code=response.status_code if hasattr(response, 'status_code') else 200,
+                    timestamp=timezone.now(),
                 )
                 
                 if is_slow:
                     logger.warning(
-                        f"Slow query ({duration:.3f}s) in {view_name}: "
-                        f"{query['sql'][:100]}..."
+                        f"Slow query ({query.duration:.3f}s) in {view_name}: "
+                        f"{query.sql[:100]}..."
                     )
                     
             except Exception as e:
                 logger.error(f"Failed to capture query: {str(e)}", exc_info=True)
                 continue
+
+        # Record repeated query patterns (N+1)
+        if collector.detector is not None:
+            for finding in collector.detector.findings():
+                sink.add(kind='n_plus_one', view_name=view_name, url_path=request.path, timestamp=timezone.now(), **finding)
+                logger.warning(
+                    f"N+1 query ({finding['repeats']}x) in {view_name} at {finding['call_site']}: "
+                    f"{finding['normalized_query'][:100]}..."
+                )
+
+        if breach is not None and self.budgets.action == 'record':
+            sink.add(
+                kind='budget',
+                view_name=view_name,
+                url_path=request.path,
+                request_method=request.method,
+                response_status_code=getattr(response, 'status_code', None),
+                timestamp=timezone.now(),
+                **breach.as_event(),
+            )
+
+        return sink
+
+    def report(self, request, collector):
+        """Feed the capture cost back to the sampler and log a summary, once the sink is flushed"""
+        request_time = request._query_finish_time - request._query_start_time
+        overhead = collector.overhead + time.perf_counter() - request._query_finish_time
+        self.sampler.observe(overhead, request_time + overhead)
                 
         # Log request summary
-        total_time = time.time() - request._query_start_time
-        query_count = len(connection.queries) - initial_query_count
         logger.debug(
             f"Request {request.method} {request.path} - "
-            f"{query_count} queries in {total_time:.3f}s"
+            f"{collector.count} queries ({collector.total_time:.3f}s) in {request_time:.3f}s, "
+            f"capture overhead {overhead:.3f}s"
         )
-        
-        return response
\ No newline at end of file
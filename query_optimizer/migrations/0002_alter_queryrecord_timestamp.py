@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:24
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='queryrecord',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
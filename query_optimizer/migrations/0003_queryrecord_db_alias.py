@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0002_alter_queryrecord_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryrecord',
+            name='db_alias',
+            field=models.CharField(blank=True, default='', help_text='Database alias the query ran on', max_length=100),
+        ),
+    ]
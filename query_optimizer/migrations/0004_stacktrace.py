@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0003_queryrecord_db_alias'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StackTrace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=40, unique=True)),
+                ('trace', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Stack Trace',
+                'verbose_name_plural': 'Stack Traces',
+            },
+        ),
+        migrations.AddField(
+            model_name='queryrecord',
+            name='stack',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='queries', to='query_optimizer.stacktrace'),
+        ),
+    ]
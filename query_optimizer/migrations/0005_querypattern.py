@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:28
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0004_stacktrace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryPattern',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=16)),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('normalized_query', models.TextField()),
+                ('sample_query', models.TextField(blank=True)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0.0)),
+                ('max_duration', models.FloatField(default=0.0)),
+                ('p50_duration', models.FloatField(default=0.0)),
+                ('p95_duration', models.FloatField(default=0.0)),
+                ('p99_duration', models.FloatField(default=0.0)),
+                ('sketch', models.JSONField(blank=True, default=dict)),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Query Pattern',
+                'verbose_name_plural': 'Query Patterns',
+                'ordering': ['-total_duration'],
+            },
+        ),
+        migrations.AddField(
+            model_name='queryrecord',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Hash of the normalized SQL, shared by every execution of the same statement shape', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='queryrecord',
+            index=models.Index(fields=['fingerprint'], name='query_optim_fingerp_2d873f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='querypattern',
+            index=models.Index(fields=['-total_duration'], name='query_optim_total_d_7c3f24_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='querypattern',
+            index=models.Index(fields=['-last_seen'], name='query_optim_last_se_e976bb_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='querypattern',
+            constraint=models.UniqueConstraint(fields=('fingerprint', 'view_name'), name='query_optimizer_pattern_unique'),
+        ),
+    ]
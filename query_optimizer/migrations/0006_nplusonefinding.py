@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0005_querypattern'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NPlusOneFinding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=16)),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('call_site', models.CharField(blank=True, default='', max_length=500)),
+                ('url_path', models.CharField(blank=True, default='', max_length=255)),
+                ('normalized_query', models.TextField()),
+                ('sample_query', models.TextField(blank=True)),
+                ('occurrences', models.PositiveIntegerField(default=0, help_text='Requests in which the pattern was detected')),
+                ('total_repeats', models.PositiveBigIntegerField(default=0)),
+                ('max_repeats', models.PositiveIntegerField(default=0, help_text='Most executions seen in a single request')),
+                ('total_duration', models.FloatField(default=0.0)),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('stack', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='n_plus_one_findings', to='query_optimizer.stacktrace')),
+            ],
+            options={
+                'verbose_name': 'N+1 Finding',
+                'verbose_name_plural': 'N+1 Findings',
+                'ordering': ['-last_seen'],
+                'indexes': [models.Index(fields=['-last_seen'], name='query_optim_last_se_cd8cbf_idx')],
+                'constraints': [models.UniqueConstraint(fields=('fingerprint', 'view_name', 'call_site'), name='query_optimizer_n_plus_one_unique')],
+            },
+        ),
+    ]
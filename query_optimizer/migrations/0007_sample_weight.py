@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0006_nplusonefinding'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='querypattern',
+            options={'ordering': ['-estimated_total_duration'], 'verbose_name': 'Query Pattern', 'verbose_name_plural': 'Query Patterns'},
+        ),
+        migrations.RemoveIndex(
+            model_name='querypattern',
+            name='query_optim_total_d_7c3f24_idx',
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='estimated_count',
+            field=models.FloatField(default=0.0, help_text='Run count extrapolated with the sample weights'),
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='estimated_total_duration',
+            field=models.FloatField(default=0.0, help_text='Total time extrapolated with the sample weights'),
+        ),
+        migrations.AddField(
+            model_name='queryrecord',
+            name='sample_weight',
+            field=models.FloatField(default=1.0, help_text='Number of executions this row stands for, the inverse of its sampling probability'),
+        ),
+        migrations.AddIndex(
+            model_name='querypattern',
+            index=models.Index(fields=['-estimated_total_duration'], name='query_optim_estimat_ba7406_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0007_sample_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('slow', 'Slowest unanalyzed queries'), ('patterns', 'Top query patterns')], default='slow', max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=20)),
+                ('limit', models.PositiveIntegerField(blank=True, help_text='Most queries to analyze, empty for all', null=True)),
+                ('concurrency', models.PositiveSmallIntegerField(default=4)),
+                ('total', models.PositiveIntegerField(default=0, help_text='Queries selected for the job, including those already processed')),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('failed_ids', models.JSONField(blank=True, default=list, help_text='QueryRecord ids that failed and are skipped on resume')),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Analysis Job',
+                'verbose_name_plural': 'Analysis Jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0008_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash of the fingerprint, provider, model and schema version', max_length=64, unique=True)),
+                ('fingerprint', models.CharField(db_index=True, max_length=16)),
+                ('provider', models.CharField(max_length=50)),
+                ('model', models.CharField(max_length=100)),
+                ('schema_version', models.CharField(blank=True, default='', max_length=64)),
+                ('normalized_query', models.TextField()),
+                ('analysis', models.JSONField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Analysis Cache Entry',
+                'verbose_name_plural': 'Analysis Cache Entries',
+                'ordering': ['-last_used_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='queryanalysis',
+            name='cached',
+            field=models.BooleanField(default=False, help_text='Reused from the analysis of another query with the same shape'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0009_analysis_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=20)),
+                ('model', models.CharField(max_length=100)),
+                ('batch_id', models.CharField(help_text='Id of the batch at the provider', max_length=255, unique=True)),
+                ('status', models.CharField(choices=[('submitted', 'Submitted'), ('collected', 'Collected'), ('failed', 'Failed')], db_index=True, default='submitted', max_length=20)),
+                ('provider_status', models.CharField(blank=True, default='', max_length=20)),
+                ('requests', models.JSONField(default=dict, help_text='QueryRecord ids analyzed by each request, keyed by custom id')),
+                ('size', models.PositiveIntegerField(default=0, help_text='Queries covered by the batch')),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+                ('collected_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Analysis Batch',
+                'verbose_name_plural': 'Analysis Batches',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
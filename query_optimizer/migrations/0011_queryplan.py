@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0010_analysisbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryPlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(blank=True, db_index=True, default='', max_length=16)),
+                ('db_alias', models.CharField(blank=True, default='', max_length=100)),
+                ('vendor', models.CharField(max_length=20)),
+                ('analyzed', models.BooleanField(default=False, help_text='Whether the plan has measured timings (EXPLAIN ANALYZE)')),
+                ('nodes', models.JSONField(default=list, help_text='Plan nodes in execution tree order, with their depth')),
+                ('tables', models.JSONField(default=dict, help_text='Row estimate and indexes of each table the query reads')),
+                ('plan_hash', models.CharField(db_index=True, help_text='Hash of the plan shape, to spot plan changes', max_length=40)),
+                ('total_cost', models.FloatField(blank=True, null=True)),
+                ('raw', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('query_record', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='plans', to='query_optimizer.queryrecord')),
+            ],
+            options={
+                'verbose_name': 'Query Plan',
+                'verbose_name_plural': 'Query Plans',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
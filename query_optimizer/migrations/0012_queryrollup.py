@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:52
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncHour
+
+
+def backfill_rollups(apps, schema_editor):
+    QueryRecord = apps.get_model('query_optimizer', 'QueryRecord')
+    QueryRollup = apps.get_model('query_optimizer', 'QueryRollup')
+    db = schema_editor.connection.alias
+
+    rows = (
+        QueryRecord.objects.using(db)
+        .annotate(bucket=TruncHour('timestamp'))
+        .values('bucket', 'view_name')
+        .annotate(
+            count=Count('id'),
+            slow_count=Count('id', filter=Q(is_slow=True)),
+            analyzed_count=Count('analysis'),
+            estimated_count=Sum('sample_weight'),
+            total_duration=Sum('duration'),
+        )
+        .order_by()
+    )
+    rollups = {}
+    for row in rows:
+        key = (row['bucket'], row['view_name'] or '')
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollups[key] = QueryRollup(bucket=key[0], view_name=key[1], count=0, slow_count=0, analyzed_count=0)
+            rollup = rollups[key]
+        rollup.count += row['count']
+        rollup.slow_count += row['slow_count']
+        rollup.analyzed_count += row['analyzed_count']
+        rollup.estimated_count += row['estimated_count'] or 0.0
+        rollup.total_duration += row['total_duration'] or 0.0
+    QueryRollup.objects.using(db).bulk_create(rollups.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0011_queryplan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(help_text='Start of the hour')),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.PositiveBigIntegerField(default=0, help_text='QueryRecord rows stored')),
+                ('slow_count', models.PositiveBigIntegerField(default=0)),
+                ('analyzed_count', models.PositiveBigIntegerField(default=0)),
+                ('estimated_count', models.FloatField(default=0.0, help_text='Sum of the sample weights of the stored rows')),
+                ('total_duration', models.FloatField(default=0.0)),
+            ],
+            options={
+                'verbose_name': 'Query Rollup',
+                'verbose_name_plural': 'Query Rollups',
+                'ordering': ['-bucket'],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'view_name'), name='query_optimizer_rollup_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
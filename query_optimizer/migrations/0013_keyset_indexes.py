@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:55
+
+from django.db import DatabaseError, migrations, models, transaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRIGRAM_INDEX = 'query_optimizer_view_trgm'
+# Indexes the bare column, which the ILIKE of the trigram_contains lookup compares
+CREATE_TRIGRAM_INDEX = (
+    f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} ON query_optimizer_queryrecord USING gin (view_name gin_trgm_ops)"
+)
+
+
+def create_trigram_index(apps, schema_editor):
+    """Index view_name for substring searches on PostgreSQL, when pg_trgm can be enabled"""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cursor.execute(CREATE_TRIGRAM_INDEX)
+    except DatabaseError as e:
+        logger.warning(f"Skipped the view_name trigram index, pg_trgm is not available: {e}")
+
+
+def drop_trigram_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP INDEX IF EXISTS {TRIGRAM_INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0012_queryrollup'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='queryrecord',
+            name='query_optim_timesta_b9701c_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='queryrecord',
+            name='query_optim_duratio_7bdf10_idx',
+        ),
+        migrations.AddIndex(
+            model_name='queryanalysis',
+            index=models.Index(fields=['-created_at', '-id'], name='query_optim_created_387c07_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queryrecord',
+            index=models.Index(fields=['-timestamp', '-id'], name='query_optim_timesta_a6c038_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queryrecord',
+            index=models.Index(fields=['duration', 'id'], name='query_optim_duratio_5b7048_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='queryrecord',
+            index=models.Index(fields=['view_name'], name='query_optimizer_view_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0013_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatternRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(help_text='Start of the period')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], default='hour', max_length=10)),
+                ('fingerprint', models.CharField(max_length=16)),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('slow_count', models.PositiveBigIntegerField(default=0)),
+                ('estimated_count', models.FloatField(default=0.0, help_text='Sum of the sample weights of the compacted rows')),
+                ('total_duration', models.FloatField(default=0.0)),
+                ('max_duration', models.FloatField(default=0.0)),
+            ],
+            options={
+                'verbose_name': 'Pattern Rollup',
+                'verbose_name_plural': 'Pattern Rollups',
+                'ordering': ['-bucket'],
+                'indexes': [models.Index(fields=['fingerprint', '-bucket'], name='query_optim_fingerp_1a1ce4_idx')],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'period', 'fingerprint', 'view_name'), name='query_optimizer_pattern_rollup_unique')],
+            },
+        ),
+    ]
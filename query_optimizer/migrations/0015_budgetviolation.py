@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0014_patternrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BudgetViolation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('budget', models.CharField(help_text='View name or path prefix of the budget, or "default"', max_length=255)),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('url_path', models.CharField(blank=True, default='', max_length=255)),
+                ('request_method', models.CharField(blank=True, default='', max_length=10)),
+                ('response_status_code', models.IntegerField(blank=True, null=True)),
+                ('query_count', models.PositiveIntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0.0, help_text='Database time of the request in seconds')),
+                ('duplicate_count', models.PositiveIntegerField(default=0)),
+                ('limits', models.JSONField(default=dict, help_text='Limits of the budget')),
+                ('exceeded', models.JSONField(default=list, help_text='Limits that were exceeded')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Budget Violation',
+                'verbose_name_plural': 'Budget Violations',
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['-timestamp'], name='query_optim_timesta_b6fc1e_idx'), models.Index(fields=['view_name', '-timestamp'], name='query_optim_view_na_55c7ce_idx')],
+            },
+        ),
+    ]
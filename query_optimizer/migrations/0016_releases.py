@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_optimizer', '0015_budgetviolation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryRegression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=16)),
+                ('view_name', models.CharField(blank=True, default='', max_length=255)),
+                ('normalized_query', models.TextField()),
+                ('kind', models.CharField(choices=[('release', 'Release'), ('window', 'Time window')], default='release', max_length=10)),
+                ('baseline', models.CharField(help_text='Release or time window compared against', max_length=100)),
+                ('candidate', models.CharField(help_text='Release or time window that got slower', max_length=100)),
+                ('baseline_count', models.FloatField(default=0.0)),
+                ('candidate_count', models.FloatField(default=0.0)),
+                ('baseline_mean', models.FloatField(default=0.0)),
+                ('candidate_mean', models.FloatField(default=0.0)),
+                ('baseline_p50', models.FloatField(default=0.0)),
+                ('candidate_p50', models.FloatField(default=0.0)),
+                ('baseline_p95', models.FloatField(default=0.0)),
+                ('candidate_p95', models.FloatField(default=0.0)),
+                ('added_time', models.FloatField(default=0.0, help_text="Extra database time over the candidate's executions, in seconds")),
+                ('p_value', models.FloatField(help_text='One-sided Mann-Whitney U test that the candidate is slower')),
+                ('detected_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Query Regression',
+                'verbose_name_plural': 'Query Regressions',
+                'ordering': ['-added_time'],
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='querypattern',
+            name='query_optimizer_pattern_unique',
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='release',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='queryrecord',
+            name='release',
+            field=models.CharField(blank=True, default='', help_text='Release of the code that ran the query, such as a git SHA', max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='querypattern',
+            constraint=models.UniqueConstraint(fields=('fingerprint', 'view_name', 'release'), name='query_optimizer_pattern_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='queryregression',
+            index=models.Index(fields=['-added_time'], name='query_optim_added_t_f4475b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='queryregression',
+            constraint=models.UniqueConstraint(fields=('fingerprint', 'view_name', 'baseline', 'candidate'), name='query_optimizer_regression_unique'),
+        ),
+    ]
@@ -1,15 +1,61 @@
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
+from query_optimizer.lookups import TrigramContains
+
+
+class StackTrace(models.Model):
+    """A formatted stack trace, stored once and shared by every query that ran from it"""
+    hash = models.CharField(max_length=40, unique=True)
+    trace = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Stack Trace"
+        verbose_name_plural = "Stack Traces"
+
+    def __str__(self):
+        return f"Stack {self.hash[:12]}"
+
 
 class QueryRecord(models.Model):
     query = models.TextField()  # The actual SQL query
     duration = models.FloatField()  # Execution time in seconds
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)  # Capture time, set before buffering
     is_slow = models.BooleanField(default=False)
+    sample_weight = models.FloatField(
+        default=1.0,
+        help_text="Number of executions this row stands for, the inverse of its sampling probability"
+    )
+    fingerprint = models.CharField(
+        max_length=16,
+        blank=True,
+        default='',
+        help_text="Hash of the normalized SQL, shared by every execution of the same statement shape"
+    )
+    db_alias = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        help_text="Database alias the query ran on"
+    )
+    release = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        help_text="Release of the code that ran the query, such as a git SHA"
+    )
 
     view_name = models.CharField(max_length=255, blank=True, null=True)
     url_path = models.CharField(max_length=255, blank=True, null=True)
-    stack_trace = models.TextField(blank=True)
+    stack_trace = models.TextField(blank=True)  # Only set on records captured before stacks were interned
+    stack = models.ForeignKey(
+        StackTrace,
+        on_delete=models.SET_NULL,
+        related_name='queries',
+        blank=True,
+        null=True
+    )
     query_params = models.JSONField(default=dict, blank=True)
     request_method = models.CharField(
         max_length=10,
@@ -32,12 +78,16 @@ class QueryRecord(models.Model):
         verbose_name = "Query Record"
         verbose_name_plural = "Query Records"
         indexes = [
-            models.Index(fields=['-timestamp']),
+            # Keyset pagination walks (timestamp, id) and (duration, id)
+            models.Index(fields=['-timestamp', '-id']),
             models.Index(fields=['is_slow']),
-            models.Index(fields=['duration']),
+            models.Index(fields=['duration', 'id']),
             models.Index(fields=['view_name']),
+            # Serves view_name prefix searches (LIKE 'name%') on PostgreSQL, a plain index elsewhere
+            models.Index(fields=['view_name'], name='query_optimizer_view_prefix', opclasses=['varchar_pattern_ops']),
             models.Index(fields=['is_slow', '-duration']),
             models.Index(fields=['view_name', '-timestamp']),
+            models.Index(fields=['fingerprint']),
         ]
 
     def __str__(self):
@@ -51,17 +101,25 @@ class QueryRecord(models.Model):
     def formatted_duration(self):
         return f"{self.duration:.3f}s"
 
+    @property
+    def full_stack_trace(self):
+        if self.stack_id:
+            return self.stack.trace
+        return self.stack_trace
+
     @property
     def short_query(self):
         return self.query[:100] + ('...' if len(self.query) > 100 else '')
 
     @classmethod
     def get_slow_queries(cls, threshold=0.5):
-        return cls.objects.filter(duration__gt=threshold).order_by('-duration')
+        from query_optimizer.sinks import capture_alias
+        return cls.objects.using(capture_alias()).filter(duration__gt=threshold).order_by('-duration')
 
     @classmethod
     def get_queries_by_view(cls, view_name):
-        return cls.objects.filter(view_name=view_name).order_by('-duration')
+        from query_optimizer.sinks import capture_alias
+        return cls.objects.using(capture_alias()).filter(view_name=view_name).order_by('-duration')
 
 
 class QueryAnalysis(models.Model):
@@ -75,11 +133,412 @@ class QueryAnalysis(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     applied = models.BooleanField(default=False)
     applied_at = models.DateTimeField(null=True, blank=True)
+    cached = models.BooleanField(default=False, help_text="Reused from the analysis of another query with the same shape")
     
     class Meta:
         verbose_name = "Query Analysis"
         verbose_name_plural = "Query Analyses"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+        ]
 
     def __str__(self):
-        return f"Analysis for {self.query_record}"
\ No newline at end of file
+        return f"Analysis for {self.query_record}"
+
+
+
+class AnalysisCacheEntry(models.Model):
+    """An AI analysis shared by every query with the same shape, provider and model"""
+    key = models.CharField(max_length=64, unique=True, help_text="Hash of the fingerprint, provider, model and schema version")
+    fingerprint = models.CharField(max_length=16, db_index=True)
+    provider = models.CharField(max_length=50)
+    model = models.CharField(max_length=100)
+    schema_version = models.CharField(max_length=64, blank=True, default='')
+    normalized_query = models.TextField()
+    analysis = models.JSONField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['-last_used_at']
+        verbose_name = "Analysis Cache Entry"
+        verbose_name_plural = "Analysis Cache Entries"
+
+    def __str__(self):
+        return f"Cached {self.provider}/{self.model} analysis of {self.fingerprint}"
+
+class QueryPattern(models.Model):
+    """Running aggregates of every execution of one statement shape in one view"""
+    fingerprint = models.CharField(max_length=16)
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    release = models.CharField(max_length=64, blank=True, default='')
+    normalized_query = models.TextField()
+    sample_query = models.TextField(blank=True)
+    count = models.PositiveBigIntegerField(default=0)
+    total_duration = models.FloatField(default=0.0)
+    estimated_count = models.FloatField(default=0.0, help_text="Run count extrapolated with the sample weights")
+    estimated_total_duration = models.FloatField(default=0.0, help_text="Total time extrapolated with the sample weights")
+    max_duration = models.FloatField(default=0.0)
+    p50_duration = models.FloatField(default=0.0)
+    p95_duration = models.FloatField(default=0.0)
+    p99_duration = models.FloatField(default=0.0)
+    sketch = models.JSONField(default=dict, blank=True)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-estimated_total_duration']
+        verbose_name = "Query Pattern"
+        verbose_name_plural = "Query Patterns"
+        constraints = [
+            models.UniqueConstraint(fields=['fingerprint', 'view_name', 'release'], name='query_optimizer_pattern_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['-estimated_total_duration']),
+            models.Index(fields=['-last_seen']),
+        ]
+
+    def __str__(self):
+        return f"Pattern {self.fingerprint} in {self.view_name or 'unknown view'} ({self.count} runs)"
+
+    @property
+    def mean_duration(self):
+        return self.total_duration / self.count if self.count else 0.0
+
+    @property
+    def is_sampled(self):
+        return abs(self.estimated_count - self.count) > 0.5
+
+    @property
+    def short_query(self):
+        return self.normalized_query[:100] + ('...' if len(self.normalized_query) > 100 else '')
+
+
+class QueryRollup(models.Model):
+    """Counts of the stored queries of one view in one hour, updated as queries are captured and analyzed"""
+    bucket = models.DateTimeField(help_text="Start of the hour")
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    count = models.PositiveBigIntegerField(default=0, help_text="QueryRecord rows stored")
+    slow_count = models.PositiveBigIntegerField(default=0)
+    analyzed_count = models.PositiveBigIntegerField(default=0)
+    estimated_count = models.FloatField(default=0.0, help_text="Sum of the sample weights of the stored rows")
+    total_duration = models.FloatField(default=0.0)
+
+    class Meta:
+        ordering = ['-bucket']
+        verbose_name = "Query Rollup"
+        verbose_name_plural = "Query Rollups"
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'view_name'], name='query_optimizer_rollup_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.view_name or 'unknown view'} at {self.bucket:%Y-%m-%d %H:00} ({self.count} queries)"
+
+
+class PatternRollup(models.Model):
+    """Aggregates of the executions of one statement shape in one view over an hour or a day, kept after pruning"""
+    PERIOD_HOUR = 'hour'
+    PERIOD_DAY = 'day'
+    PERIOD_CHOICES = [
+        (PERIOD_HOUR, 'Hour'),
+        (PERIOD_DAY, 'Day'),
+    ]
+
+    bucket = models.DateTimeField(help_text="Start of the period")
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES, default=PERIOD_HOUR)
+    fingerprint = models.CharField(max_length=16)
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    count = models.PositiveBigIntegerField(default=0)
+    slow_count = models.PositiveBigIntegerField(default=0)
+    estimated_count = models.FloatField(default=0.0, help_text="Sum of the sample weights of the compacted rows")
+    total_duration = models.FloatField(default=0.0)
+    max_duration = models.FloatField(default=0.0)
+
+    class Meta:
+        ordering = ['-bucket']
+        verbose_name = "Pattern Rollup"
+        verbose_name_plural = "Pattern Rollups"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['bucket', 'period', 'fingerprint', 'view_name'],
+                name='query_optimizer_pattern_rollup_unique',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['fingerprint', '-bucket']),
+        ]
+
+    def __str__(self):
+        return f"Pattern {self.fingerprint} in {self.view_name or 'unknown view'} at {self.bucket:%Y-%m-%d %H:00} ({self.count} runs)"
+
+    @property
+    def mean_duration(self):
+        return self.total_duration / self.count if self.count else 0.0
+
+
+class NPlusOneFinding(models.Model):
+    """A statement shape repeated many times from the same call site within one request"""
+    fingerprint = models.CharField(max_length=16)
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    call_site = models.CharField(max_length=500, blank=True, default='')
+    url_path = models.CharField(max_length=255, blank=True, default='')
+    normalized_query = models.TextField()
+    sample_query = models.TextField(blank=True)
+    stack = models.ForeignKey(
+        StackTrace,
+        on_delete=models.SET_NULL,
+        related_name='n_plus_one_findings',
+        blank=True,
+        null=True
+    )
+    occurrences = models.PositiveIntegerField(default=0, help_text="Requests in which the pattern was detected")
+    total_repeats = models.PositiveBigIntegerField(default=0)
+    max_repeats = models.PositiveIntegerField(default=0, help_text="Most executions seen in a single request")
+    total_duration = models.FloatField(default=0.0)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-last_seen']
+        verbose_name = "N+1 Finding"
+        verbose_name_plural = "N+1 Findings"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['fingerprint', 'view_name', 'call_site'],
+                name='query_optimizer_n_plus_one_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['-last_seen']),
+        ]
+
+    def __str__(self):
+        return f"N+1 in {self.view_name or 'unknown view'} at {self.call_site} (up to {self.max_repeats}x)"
+
+    @property
+    def short_query(self):
+        return self.normalized_query[:100] + ('...' if len(self.normalized_query) > 100 else '')
+
+    @property
+    def average_repeats(self):
+        return self.total_repeats / self.occurrences if self.occurrences else 0
+
+
+class BudgetViolation(models.Model):
+    """A request that went over its query budget"""
+    budget = models.CharField(max_length=255, help_text="View name or path prefix of the budget, or \"default\"")
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    url_path = models.CharField(max_length=255, blank=True, default='')
+    request_method = models.CharField(max_length=10, blank=True, default='')
+    response_status_code = models.IntegerField(null=True, blank=True)
+    query_count = models.PositiveIntegerField(default=0)
+    total_duration = models.FloatField(default=0.0, help_text="Database time of the request in seconds")
+    duplicate_count = models.PositiveIntegerField(default=0)
+    limits = models.JSONField(default=dict, help_text="Limits of the budget")
+    exceeded = models.JSONField(default=list, help_text="Limits that were exceeded")
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-timestamp']
+        verbose_name = "Budget Violation"
+        verbose_name_plural = "Budget Violations"
+        indexes = [
+            models.Index(fields=['-timestamp']),
+            models.Index(fields=['view_name', '-timestamp']),
+        ]
+
+    def __str__(self):
+        return f"{self.view_name or self.url_path} over the {self.budget} budget ({', '.join(self.exceeded)})"
+
+
+class QueryRegression(models.Model):
+    """A statement shape that got slower from a baseline release or time window to a later one"""
+    KIND_RELEASE = 'release'
+    KIND_WINDOW = 'window'
+    KIND_CHOICES = [
+        (KIND_RELEASE, 'Release'),
+        (KIND_WINDOW, 'Time window'),
+    ]
+
+    fingerprint = models.CharField(max_length=16)
+    view_name = models.CharField(max_length=255, blank=True, default='')
+    normalized_query = models.TextField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=KIND_RELEASE)
+    baseline = models.CharField(max_length=100, help_text="Release or time window compared against")
+    candidate = models.CharField(max_length=100, help_text="Release or time window that got slower")
+    baseline_count = models.FloatField(default=0.0)
+    candidate_count = models.FloatField(default=0.0)
+    baseline_mean = models.FloatField(default=0.0)
+    candidate_mean = models.FloatField(default=0.0)
+    baseline_p50 = models.FloatField(default=0.0)
+    candidate_p50 = models.FloatField(default=0.0)
+    baseline_p95 = models.FloatField(default=0.0)
+    candidate_p95 = models.FloatField(default=0.0)
+    added_time = models.FloatField(default=0.0, help_text="Extra database time over the candidate's executions, in seconds")
+    p_value = models.FloatField(help_text="One-sided Mann-Whitney U test that the candidate is slower")
+    detected_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-added_time']
+        verbose_name = "Query Regression"
+        verbose_name_plural = "Query Regressions"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['fingerprint', 'view_name', 'baseline', 'candidate'],
+                name='query_optimizer_regression_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['-added_time']),
+        ]
+
+    def __str__(self):
+        return f"{self.view_name or 'unknown view'} {self.fingerprint} slower in {self.candidate} than in {self.baseline}"
+
+    @property
+    def short_query(self):
+        return self.normalized_query[:100] + ('...' if len(self.normalized_query) > 100 else '')
+
+    @property
+    def slowdown(self):
+        """How many times slower the median got"""
+        return self.candidate_p50 / self.baseline_p50 if self.baseline_p50 else 0.0
+
+
+class AnalysisJob(models.Model):
+    """A bulk AI analysis run, with progress saved as it goes so it can be resumed"""
+    SOURCE_SLOW = 'slow'
+    SOURCE_PATTERNS = 'patterns'
+    SOURCE_CHOICES = [
+        (SOURCE_SLOW, 'Slowest unanalyzed queries'),
+        (SOURCE_PATTERNS, 'Top query patterns'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default=SOURCE_SLOW)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    limit = models.PositiveIntegerField(null=True, blank=True, help_text="Most queries to analyze, empty for all")
+    concurrency = models.PositiveSmallIntegerField(default=4)
+    total = models.PositiveIntegerField(default=0, help_text="Queries selected for the job, including those already processed")
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    failed_ids = models.JSONField(default=list, blank=True, help_text="QueryRecord ids that failed and are skipped on resume")
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Analysis Job"
+        verbose_name_plural = "Analysis Jobs"
+
+    def __str__(self):
+        return f"Analysis job #{self.pk} ({self.get_source_display()}, {self.status})"
+
+    @property
+    def is_active(self):
+        return self.status in (self.STATUS_PENDING, self.STATUS_RUNNING)
+
+    @property
+    def remaining(self):
+        """How many more queries this job may analyze, or None without a limit"""
+        if self.limit is None:
+            return None
+        return max(self.limit - self.processed, 0)
+
+    @property
+    def progress(self):
+        """Percentage of the selected queries processed so far"""
+        if not self.total:
+            return 100 if self.status == self.STATUS_COMPLETED else 0
+        return min(100, int(100 * self.processed / self.total))
+
+
+class QueryPlan(models.Model):
+    """Execution plan of a captured query, with the row estimates and indexes of the tables it read"""
+    query_record = models.ForeignKey(
+        QueryRecord,
+        on_delete=models.CASCADE,
+        related_name='plans',
+        blank=True,
+        null=True
+    )
+    fingerprint = models.CharField(max_length=16, blank=True, default='', db_index=True)
+    db_alias = models.CharField(max_length=100, blank=True, default='')
+    vendor = models.CharField(max_length=20)
+    analyzed = models.BooleanField(default=False, help_text="Whether the plan has measured timings (EXPLAIN ANALYZE)")
+    nodes = models.JSONField(default=list, help_text="Plan nodes in execution tree order, with their depth")
+    tables = models.JSONField(default=dict, help_text="Row estimate and indexes of each table the query reads")
+    plan_hash = models.CharField(max_length=40, db_index=True, help_text="Hash of the plan shape, to spot plan changes")
+    total_cost = models.FloatField(null=True, blank=True)
+    raw = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Query Plan"
+        verbose_name_plural = "Query Plans"
+
+    def __str__(self):
+        return f"Plan {self.plan_hash[:8]} of {self.fingerprint} ({self.vendor})"
+
+
+class AnalysisBatch(models.Model):
+    """Queries submitted for analysis in one provider batch, collected when the provider is done"""
+    STATUS_SUBMITTED = 'submitted'
+    STATUS_COLLECTED = 'collected'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_SUBMITTED, 'Submitted'),
+        (STATUS_COLLECTED, 'Collected'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    provider = models.CharField(max_length=20)
+    model = models.CharField(max_length=100)
+    batch_id = models.CharField(max_length=255, unique=True, help_text="Id of the batch at the provider")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_SUBMITTED, db_index=True)
+    provider_status = models.CharField(max_length=20, blank=True, default='')
+    requests = models.JSONField(default=dict, help_text="QueryRecord ids analyzed by each request, keyed by custom id")
+    size = models.PositiveIntegerField(default=0, help_text="Queries covered by the batch")
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    collected_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Analysis Batch"
+        verbose_name_plural = "Analysis Batches"
+
+    def __str__(self):
+        return f"Analysis batch {self.batch_id} ({self.provider}, {self.status})"
+
+    @property
+    def record_ids(self):
+        return [record_id for ids in self.requests.values() for record_id in ids]
+
+
+# "contains" view name searches (see stats.VIEW_NAME_SEARCHES)
+for model in (QueryRecord, QueryRollup):
+    model._meta.get_field('view_name').register_lookup(TrigramContains, 'trigram_contains')
@@ -0,0 +1,231 @@
+"""
+Offline analytics over query exports, with vectorized NumPy aggregates.
+
+Works on the files written by query_optimizer.export, away from the
+production database. Needs numpy, and pyarrow for Parquet and Arrow files.
+"""
+from query_optimizer.export import BINLOG_FIELDS, FLAG_ANALYZED, FLAG_SLOW, detect_format, epoch_micros, read_sidecar
+import numpy as np
+
+BINLOG_DTYPE = np.dtype([
+    (name, '<' + {'q': 'i8', 'd': 'f8', 'f': 'f4', 'B': 'u1', 'h': 'i2', 'i': 'i4'}.get(code, 'S16'))
+    for name, code in BINLOG_FIELDS
+])
+GROUP_KEYS = ['view_name', 'fingerprint']
+DEFAULT_PERCENTILES = (50, 95, 99)
+# Log-spaced duration buckets from 0.1ms to 100s
+DEFAULT_BINS = np.logspace(-4, 2, 25)
+
+
+class QueryFrame:
+    """
+    Exported queries as NumPy columns.
+
+    `timestamp` is in microseconds since the epoch. `view` and `fingerprint`
+    are codes into the `views` and `fingerprints` arrays. Columns of a
+    binary log are views of the memory-mapped file.
+    """
+
+    def __init__(self, columns, views, fingerprints):
+        self.columns = columns
+        self.views = np.asarray(views, dtype=object)
+        self.fingerprints = np.asarray(fingerprints, dtype=object)
+
+    def __len__(self):
+        return len(self.columns['duration'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def select(self, mask):
+        return QueryFrame({name: column[mask] for name, column in self.columns.items()}, self.views, self.fingerprints)
+
+    def window(self, start=None, end=None):
+        """Queries captured in [start, end), given as datetimes"""
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.timestamp >= epoch_micros(start)
+        if end is not None:
+            mask &= self.timestamp < epoch_micros(end)
+        return self.select(mask)
+
+
+def load_binlog(path):
+    sidecar = read_sidecar(path)
+    if sidecar is None:
+        raise FileNotFoundError(f"{path}.json not found, {path} is not a query binary log")
+    if sidecar['count']:
+        records = np.memmap(path, dtype=BINLOG_DTYPE, mode='r', shape=(sidecar['count'],))
+    else:
+        records = np.empty(0, dtype=BINLOG_DTYPE)
+    fingerprints, codes = np.unique(records['fingerprint'], return_inverse=True)
+    columns = {
+        'id': records['id'],
+        'timestamp': records['timestamp'],
+        'duration': records['duration'],
+        'sample_weight': records['sample_weight'],
+        'is_slow': (records['flags'] & FLAG_SLOW).astype(bool),
+        'analyzed': (records['flags'] & FLAG_ANALYZED).astype(bool),
+        'status': records['status'],
+        'view': records['view'],
+        'fingerprint': codes.reshape(-1),
+    }
+    return QueryFrame(columns, sidecar['views'], [value.decode('ascii') for value in fingerprints])
+
+
+def load_columnar(path, export_format):
+    import pyarrow as pa
+
+    names = ['id', 'timestamp', 'duration', 'sample_weight', 'is_slow', 'analyzed', 'status', 'view_name', 'fingerprint']
+    if export_format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=names, memory_map=True)
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all().select(names)
+    table = table.unify_dictionaries().combine_chunks()
+
+    def dictionary(name):
+        column = table.column(name)
+        if column.num_chunks == 0:
+            return np.empty(0, dtype=np.int32), []
+        chunk = column.chunk(0)
+        return chunk.indices.to_numpy(zero_copy_only=False), chunk.dictionary.to_pylist()
+
+    view_codes, views = dictionary('view_name')
+    fingerprint_codes, fingerprints = dictionary('fingerprint')
+    columns = {
+        name: table.column(name).to_numpy()
+        for name in ['id', 'duration', 'sample_weight', 'is_slow', 'analyzed']
+    }
+    columns['timestamp'] = table.column('timestamp').cast(pa.int64()).to_numpy()
+    columns['status'] = table.column('status').fill_null(-1).to_numpy()
+    columns['view'] = view_codes
+    columns['fingerprint'] = fingerprint_codes
+    return QueryFrame(columns, views, fingerprints)
+
+
+def load(path, export_format=None):
+    """Load an export written by query_optimizer.export as a QueryFrame"""
+    export_format = export_format or detect_format(path)
+    if export_format == 'binlog':
+        return load_binlog(path)
+    return load_columnar(path, export_format)
+
+
+def group(frame, by=GROUP_KEYS):
+    """(group keys, group index of each query) for grouping by view, fingerprint or both"""
+    if list(by) == ['view_name']:
+        codes = frame.view.astype(np.int64)
+    elif list(by) == ['fingerprint']:
+        codes = frame.fingerprint.astype(np.int64)
+    else:
+        codes = frame.view.astype(np.int64) * max(len(frame.fingerprints), 1) + frame.fingerprint
+    groups, inverse = np.unique(codes, return_inverse=True)
+
+    if list(by) == ['view_name']:
+        keys = [(frame.views[code],) for code in groups]
+    elif list(by) == ['fingerprint']:
+        keys = [(frame.fingerprints[code],) for code in groups]
+    else:
+        size = max(len(frame.fingerprints), 1)
+        keys = [(frame.views[code // size], frame.fingerprints[code % size]) for code in groups]
+    return keys, inverse.reshape(-1)
+
+
+def percentiles(frame, by=GROUP_KEYS, q=DEFAULT_PERCENTILES):
+    """
+    Duration percentiles of each group (nearest rank), with counts and totals.
+
+    Returns one dict per group, by total duration descending.
+    """
+    keys, inverse = group(frame, by)
+    if not keys:
+        return []
+    duration = frame.duration
+    # Sorting by group then duration puts each group's durations in one sorted run
+    order = np.lexsort((duration, inverse))
+    ordered = duration[order]
+    counts = np.bincount(inverse, minlength=len(keys))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    totals = np.bincount(inverse, weights=duration, minlength=len(keys))
+    estimated = np.bincount(inverse, weights=frame.sample_weight, minlength=len(keys))
+    slow = np.bincount(inverse, weights=frame.is_slow, minlength=len(keys))
+    ranks = {
+        p: ordered[starts + np.maximum(np.ceil(counts * p / 100.0).astype(np.int64) - 1, 0)]
+        for p in q
+    }
+
+    rows = []
+    for index in np.argsort(-totals):
+        row = dict(zip(by, keys[index]))
+        row.update({
+            'count': int(counts[index]),
+            'estimated_count': float(estimated[index]),
+            'slow_count': int(slow[index]),
+            'total_duration': float(totals[index]),
+            'mean_duration': float(totals[index] / counts[index]),
+        })
+        row.update({f'p{p}': float(values[index]) for p, values in ranks.items()})
+        rows.append(row)
+    return rows
+
+
+def histograms(frame, by=GROUP_KEYS, bins=DEFAULT_BINS):
+    """
+    Duration histogram of each group.
+
+    Returns (keys, edges, counts): counts[i, j] is the number of queries of
+    group keys[i] with a duration in [edges[j - 1], edges[j]), where the
+    first and last columns collect the durations below and above the edges.
+    """
+    keys, inverse = group(frame, by)
+    edges = np.asarray(bins)
+    width = len(edges) + 1
+    buckets = np.searchsorted(edges, frame.duration, side='right')
+    counts = np.bincount(inverse * width + buckets, minlength=len(keys) * width).reshape(len(keys), width)
+    return keys, edges, counts
+
+
+def diff(frame, baseline, current, by=GROUP_KEYS, q=95, min_count=10, threshold=0.2):
+    """
+    Compare the duration percentile `q` of each group between two windows.
+
+    `baseline` and `current` are (start, end) datetime pairs. Groups with at
+    least `min_count` queries in both windows are "regressed" or "improved"
+    when their percentile changed by more than `threshold` (0.2 is 20%),
+    "unchanged" otherwise. Groups seen in one window only are "new" or
+    "gone". Rows are sorted by change, largest regression first.
+    """
+    percentile = f'p{q}'
+    before = {tuple(row[key] for key in by): row for row in percentiles(frame.window(*baseline), by, (50, q))}
+    after = {tuple(row[key] for key in by): row for row in percentiles(frame.window(*current), by, (50, q))}
+
+    rows = []
+    for key in before.keys() | after.keys():
+        old, new = before.get(key), after.get(key)
+        row = dict(zip(by, key))
+        row.update({
+            'baseline_count': old['count'] if old else 0,
+            'current_count': new['count'] if new else 0,
+            f'baseline_{percentile}': old[percentile] if old else None,
+            f'current_{percentile}': new[percentile] if new else None,
+            'baseline_p50': old['p50'] if old else None,
+            'current_p50': new['p50'] if new else None,
+        })
+        if old is None:
+            row.update({'change': None, 'status': 'new'})
+        elif new is None:
+            row.update({'change': None, 'status': 'gone'})
+        else:
+            change = new[percentile] / old[percentile] - 1 if old[percentile] else 0.0
+            if min(old['count'], new['count']) < min_count or abs(change) <= threshold:
+                status = 'unchanged'
+            else:
+                status = 'regressed' if change > 0 else 'improved'
+            row.update({'change': change, 'status': status})
+        rows.append(row)
+    return sorted(rows, key=lambda row: row['change'] if row['change'] is not None else float('-inf'), reverse=True)
@@ -0,0 +1,136 @@
+from django.db.models import F, Q
+from django.http import Http404
+from datetime import datetime
+import base64
+import binascii
+import json
+
+
+class CursorPage:
+    """One page of a CursorPaginator, with the cursors of its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Keyset pagination on (`ordering` field, primary key).
+
+    A page is selected with a range condition on the last row of the
+    previous page instead of an OFFSET, so every page costs the same and
+    uses the (field, id) index whatever its depth, and no COUNT is needed.
+    Cursors are opaque URL-safe strings. NULLs sort first in ascending and
+    last in descending order on every backend.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+
+    def encode(self, obj, direction):
+        value = getattr(obj, self.field.attname)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data = json.dumps({'v': value, 'pk': obj.pk, 'd': direction}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            value = data['v'] if data['v'] is None else self.field.to_python(data['v'])
+            return value, data['pk'], data['d']
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            raise Http404("Invalid page cursor")
+
+    def order_by(self, descending):
+        field = F(self.field_name)
+        if self.field.null:
+            field = field.desc(nulls_last=True) if descending else field.asc(nulls_first=True)
+        else:
+            field = field.desc() if descending else field.asc()
+        return [field, '-pk' if descending else 'pk']
+
+    def after(self, value, pk, descending):
+        """Rows after (value, pk) in the given direction"""
+        name = self.field_name
+        later = 'lt' if descending else 'gt'
+        if value is None:
+            condition = Q(**{f'{name}__isnull': True, f'pk__{later}': pk})
+            return condition if descending else condition | Q(**{f'{name}__isnull': False})
+        condition = Q(**{f'{name}__{later}': value}) | Q(**{name: value, f'pk__{later}': pk})
+        if self.field.null and descending:
+            condition |= Q(**{f'{name}__isnull': True})
+        return condition
+
+    def page(self, cursor=None):
+        if not cursor:
+            rows = list(self.queryset.order_by(*self.order_by(self.descending))[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            return CursorPage(rows, next_cursor=self.encode(rows[-1], 'next') if more else None)
+
+        value, pk, direction = self.decode(cursor)
+        if direction == 'prev':
+            # Walk backwards from the first row of the current page, then restore the order
+            rows = list(
+                self.queryset.filter(self.after(value, pk, not self.descending))
+                .order_by(*self.order_by(not self.descending))[:self.per_page + 1]
+            )
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            return CursorPage(
+                rows,
+                next_cursor=self.encode(rows[-1], 'next') if rows else None,
+                previous_cursor=self.encode(rows[0], 'prev') if more else None,
+            )
+
+        rows = list(
+            self.queryset.filter(self.after(value, pk, self.descending))
+            .order_by(*self.order_by(self.descending))[:self.per_page + 1]
+        )
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        return CursorPage(
+            rows,
+            next_cursor=self.encode(rows[-1], 'next') if more else None,
+            previous_cursor=self.encode(rows[0], 'prev') if rows else None,
+        )
+
+
+class CursorPaginationMixin:
+    """
+    ListView pagination with a CursorPaginator instead of page numbers.
+
+    get_cursor_ordering() returns the ordering, e.g. "-timestamp". The page
+    object has has_next/has_previous and next_cursor/previous_cursor.
+    """
+    cursor_param = 'cursor'
+
+    def get_cursor_ordering(self):
+        raise NotImplementedError
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, self.get_cursor_ordering(), page_size)
+        page = paginator.page(self.request.GET.get(self.cursor_param))
+        return paginator, page, page.object_list, page.has_other_pages()
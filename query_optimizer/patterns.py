@@ -0,0 +1,144 @@
+from django.db import IntegrityError, transaction
+from query_optimizer.fingerprint import fingerprint, normalize_sql
+from query_optimizer.models import QueryPattern
+from query_optimizer.sketch import DurationSketch
+
+PATTERN_FIELDS = [
+    'count', 'total_duration', 'estimated_count', 'estimated_total_duration', 'max_duration', 'p50_duration', 'p95_duration',
+    'p99_duration', 'sketch', 'last_seen',
+]
+
+
+class PatternDelta:
+    """Aggregates of one batch of events for a single (fingerprint, view, release)"""
+
+    def __init__(self, normalized_query, sample_query):
+        self.normalized_query = normalized_query
+        self.sample_query = sample_query
+        self.count = 0
+        self.total_duration = 0.0
+        self.estimated_count = 0.0
+        self.estimated_total_duration = 0.0
+        self.max_duration = 0.0
+        self.sketch = DurationSketch()
+        self.first_seen = None
+        self.last_seen = None
+
+    def add(self, duration, timestamp, weight=1.0):
+        self.count += 1
+        self.total_duration += duration
+        self.estimated_count += weight
+        self.estimated_total_duration += duration * weight
+        self.max_duration = max(self.max_duration, duration)
+        self.sketch.add(duration, weight)
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+
+def fold(pattern, delta):
+    """Merge a PatternDelta into a QueryPattern and refresh its percentiles"""
+    sketch = DurationSketch.from_dict(pattern.sketch)
+    sketch.merge(delta.sketch)
+
+    pattern.count += delta.count
+    pattern.total_duration += delta.total_duration
+    pattern.estimated_count += delta.estimated_count
+    pattern.estimated_total_duration += delta.estimated_total_duration
+    pattern.max_duration = max(pattern.max_duration, delta.max_duration)
+    pattern.p50_duration = sketch.quantile(0.50)
+    pattern.p95_duration = sketch.quantile(0.95)
+    pattern.p99_duration = sketch.quantile(0.99)
+    pattern.sketch = sketch.to_dict()
+    if pattern.last_seen is None or delta.last_seen > pattern.last_seen:
+        pattern.last_seen = delta.last_seen
+
+
+def fingerprint_events(events):
+    """
+    Set `fingerprint` on every event and group the events by (fingerprint, view, release).
+
+    Returns {(fingerprint, view_name, release): PatternDelta}.
+    """
+    deltas = {}
+    for event in events:
+        normalized = normalize_sql(event['query'])
+        event['fingerprint'] = fingerprint(normalized, normalized=True)
+        key = (event['fingerprint'], event.get('view_name') or '', event.get('release') or '')
+        delta = deltas.get(key)
+        if delta is None:
+            delta = deltas[key] = PatternDelta(normalized, event['query'])
+        delta.add(event['duration'], event['timestamp'], event.get('sample_weight', 1.0))
+    return deltas
+
+
+def _apply_deltas(deltas, using):
+    previous = {}
+    existing = {
+        (pattern.fingerprint, pattern.view_name, pattern.release): pattern
+        for pattern in QueryPattern.objects.using(using).select_for_update()
+        .filter(fingerprint__in={key[0] for key in deltas})
+    }
+
+    new, changed = [], []
+    for key, delta in deltas.items():
+        pattern = existing.get(key)
+        if pattern is None:
+            previous[key] = None
+            pattern = QueryPattern(
+                fingerprint=key[0],
+                view_name=key[1],
+                release=key[2],
+                normalized_query=delta.normalized_query,
+                sample_query=delta.sample_query,
+                first_seen=delta.first_seen,
+                last_seen=delta.last_seen,
+            )
+            new.append(pattern)
+        else:
+            previous[key] = pattern.p99_duration
+            changed.append(pattern)
+        fold(pattern, delta)
+
+    if new:
+        QueryPattern.objects.using(using).bulk_create(new)
+    if changed:
+        QueryPattern.objects.using(using).bulk_update(changed, PATTERN_FIELDS)
+    return previous
+
+
+def update_patterns(deltas, using):
+    """
+    Fold per-batch deltas into the stored QueryPattern rows.
+
+    Returns {(fingerprint, view_name, release): p99 before the update}, with None for
+    patterns seen for the first time.
+    """
+    try:
+        with transaction.atomic(using=using):
+            return _apply_deltas(deltas, using)
+    except IntegrityError:
+        # Another process created one of the patterns first, the retry sees it
+        with transaction.atomic(using=using):
+            return _apply_deltas(deltas, using)
+
+
+def select_outliers(events, previous):
+    """
+    Keep the events worth storing as raw QueryRecord rows: slow queries,
+    queries above the pattern's p99 and the first sample of a new pattern.
+    """
+    kept = []
+    first_samples = set()
+    for event in events:
+        key = (event['fingerprint'], event.get('view_name') or '', event.get('release') or '')
+        p99 = previous.get(key)
+        if p99 is None:
+            if key in first_samples and not event['is_slow']:
+                continue
+            first_samples.add(key)
+            kept.append(event)
+        elif event['is_slow'] or event['duration'] > p99:
+            kept.append(event)
+    return kept
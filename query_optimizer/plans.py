@@ -0,0 +1,299 @@
+from django.db import DatabaseError, connections, transaction
+from query_optimizer.fingerprint import fingerprint
+from query_optimizer.models import QueryPlan
+from query_optimizer.sinks import capture_alias, get_config
+import hashlib
+import json
+import re
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPLAINABLE_RE = re.compile(r'^\s*(?:/\*.*?\*/\s*)*(select|with)\b', re.IGNORECASE | re.DOTALL)
+SQLITE_RELATION_RE = re.compile(r'^(?:SCAN|SEARCH)(?: TABLE)? ("?[\w$]+"?)')
+SQLITE_INDEX_RE = re.compile(r'USING (?:(?:COVERING )?INDEX ("?[\w$]+"?)|(INTEGER PRIMARY KEY|PRIMARY KEY))')
+WORD_RE = re.compile(r'[\w$]+')
+
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
+
+def is_explainable(sql):
+    """Only single read statements are explained, so EXPLAIN ANALYZE never runs a write"""
+    statement = sql.strip().rstrip(';')
+    return bool(EXPLAINABLE_RE.match(statement)) and ';' not in statement
+
+
+def cached(key, ttl, load):
+    """Return the value of `key` in the schema cache, loading it when missing or older than `ttl`"""
+    now = time.monotonic()
+    with _schema_lock:
+        entry = _schema_cache.get(key)
+        if entry is not None and now - entry[0] < ttl:
+            return entry[1]
+    value = load()
+    with _schema_lock:
+        _schema_cache[key] = (now, value)
+    return value
+
+
+def clear_schema_cache():
+    with _schema_lock:
+        _schema_cache.clear()
+
+
+def estimate_rows(connection, cursor, table):
+    """Row count estimate from the database statistics, without counting the table"""
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute(
+            "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+            [table],
+        )
+    elif connection.vendor == 'sqlite':
+        # The highest rowid is a cheap upper bound when ANALYZE never ran
+        cursor.execute(f"SELECT MAX(_rowid_) FROM {connection.ops.quote_name(table)}")
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return max(int(row[0]), 0)
+
+
+def flatten_postgresql(node, nodes, depth=0):
+    nodes.append({
+        'depth': depth,
+        'operation': node.get('Node Type', ''),
+        'relation': node.get('Relation Name', ''),
+        'index': node.get('Index Name', ''),
+        'rows': node.get('Plan Rows'),
+        'cost': node.get('Total Cost'),
+        'actual_rows': node.get('Actual Rows'),
+        'actual_time': node.get('Actual Total Time'),
+    })
+    for child in node.get('Plans', []):
+        flatten_postgresql(child, nodes, depth + 1)
+
+
+def flatten_mysql(block, nodes, depth=0):
+    """Collect the table accesses of a MySQL JSON plan"""
+    if isinstance(block, dict):
+        table = block.get('table')
+        if isinstance(table, dict) and 'table_name' in table:
+            cost = (table.get('cost_info') or {}).get('prefix_cost')
+            nodes.append({
+                'depth': depth,
+                'operation': table.get('access_type', ''),
+                'relation': table.get('table_name', ''),
+                'index': table.get('key') or '',
+                'rows': table.get('rows_examined_per_scan'),
+                'cost': float(cost) if cost is not None else None,
+            })
+        for value in block.values():
+            flatten_mysql(value, nodes, depth + 1)
+    elif isinstance(block, list):
+        for value in block:
+            flatten_mysql(value, nodes, depth)
+
+
+def flatten_sqlite(rows):
+    """Nodes of an EXPLAIN QUERY PLAN result: (id, parent, notused, detail) rows"""
+    depths = {0: -1}
+    nodes = []
+    for node_id, parent, _, detail in rows:
+        depth = depths[node_id] = depths.get(parent, -1) + 1
+        relation = SQLITE_RELATION_RE.match(detail)
+        index = SQLITE_INDEX_RE.search(detail)
+        nodes.append({
+            'depth': depth,
+            'operation': detail,
+            'relation': relation.group(1).strip('"') if relation else '',
+            'index': (index.group(1) or index.group(2)).strip('"') if index else '',
+        })
+    return nodes
+
+
+def plan_hash(nodes):
+    """Hash of the plan's shape, which changes when the database picks a different plan"""
+    shape = '\n'.join(f"{node['depth']}:{node['operation']}:{node['relation']}:{node['index']}" for node in nodes)
+    return hashlib.sha1(shape.encode('utf-8')).hexdigest()
+
+
+class PlanCollector:
+    """
+    Collects execution plans and schema facts for captured queries.
+
+    Queries are explained on the database they ran on, with the EXPLAIN
+    syntax Django's `QuerySet.explain()` uses for the backend, inside a
+    transaction that is always rolled back. `explain_analyze` runs the query
+    for real timings on the backends that support it. Plans are flattened
+    into a list of nodes and stored as QueryPlan rows.
+
+    Row estimates and indexes of the tables a query reads come from
+    `connection.introspection` and the database statistics, and are cached
+    per table for `schema_cache_ttl` seconds.
+    """
+
+    def __init__(self, config=None):
+        config = config if config is not None else get_config()
+        self.enabled = config.get('explain', True)
+        self.analyze = config.get('explain_analyze', False)
+        self.ttl = config.get('schema_cache_ttl', 300)
+        self.max_tables = config.get('plan_max_tables', 8)
+        self.max_lines = config.get('plan_max_lines', 40)
+
+    def explain(self, connection, sql):
+        """Run EXPLAIN for `sql` and return (analyzed, nodes, raw plan text)"""
+        analyze = self.analyze and connection.vendor in ('postgresql', 'mysql')
+        formats = connection.features.supported_explain_formats
+        explain_format = 'JSON' if 'JSON' in formats else None
+        options = {'analyze': True} if analyze else {}
+        prefix = connection.ops.explain_query_prefix(explain_format, **options)
+
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(f"{prefix} {sql.strip().rstrip(';')}")
+                rows = cursor.fetchall()
+            # EXPLAIN ANALYZE executes the statement: never keep its effects
+            transaction.set_rollback(True, using=connection.alias)
+
+        if connection.vendor == 'sqlite':
+            return analyze, flatten_sqlite(rows), '\n'.join(row[3] for row in rows)
+
+        raw = '\n'.join(str(row[0]) for row in rows)
+        nodes = []
+        try:
+            document = rows[0][0] if len(rows) == 1 and not isinstance(rows[0][0], str) else json.loads(raw)
+            if connection.vendor == 'postgresql':
+                flatten_postgresql(document[0]['Plan'], nodes)
+            else:
+                flatten_mysql(document, nodes)
+        except (ValueError, KeyError, IndexError, TypeError):
+            nodes = []
+        if not nodes:
+            # Text plans, such as MySQL's EXPLAIN ANALYZE tree, are kept line by line
+            nodes = [{'depth': 0, 'operation': line.strip(), 'relation': '', 'index': ''} for line in raw.splitlines()]
+        return analyze, nodes, raw
+
+    def table_names(self, connection):
+        return cached(
+            (connection.alias, None),
+            self.ttl,
+            lambda: set(connection.introspection.table_names()),
+        )
+
+    def table_stats(self, connection, table):
+        """Row estimate and indexes of `table`: {"rows": ..., "indexes": [...]}"""
+        def load():
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, table)
+                try:
+                    rows = estimate_rows(connection, cursor, table)
+                except DatabaseError:
+                    rows = None
+            indexes = [
+                {
+                    'name': name,
+                    'columns': info['columns'],
+                    'unique': bool(info['unique']),
+                    'primary_key': bool(info['primary_key']),
+                }
+                for name, info in sorted(constraints.items())
+                if info['index'] or info['primary_key'] or info['unique']
+            ]
+            return {'rows': rows, 'indexes': indexes}
+
+        return cached((connection.alias, table), self.ttl, load)
+
+    def referenced_tables(self, connection, sql, nodes):
+        tables = [node['relation'] for node in nodes if node.get('relation')]
+        known = self.table_names(connection)
+        tables += [word for word in WORD_RE.findall(sql) if word in known]
+        return list(dict.fromkeys(tables))[:self.max_tables]
+
+    def collect(self, query_record):
+        """
+        Explain `query_record` and store the plan.
+
+        Returns the QueryPlan, or None when plans are disabled, the query is
+        not a read statement or the database cannot explain it. The last
+        plan of the record is reused rather than explaining it again.
+        """
+        if not self.enabled or not is_explainable(query_record.query):
+            return None
+        if query_record.pk:
+            existing = query_record.plans.first()
+            if existing is not None:
+                return existing
+
+        alias = query_record.db_alias or 'default'
+        if alias not in connections:
+            return None
+        connection = connections[alias]
+        if not connection.features.supports_explaining_query_execution:
+            return None
+
+        try:
+            analyzed, nodes, raw = self.explain(connection, query_record.query)
+            tables = {
+                table: self.table_stats(connection, table)
+                for table in self.referenced_tables(connection, query_record.query, nodes)
+            }
+        except Exception as e:
+            logger.debug(f"Could not explain query {query_record.pk}: {e}")
+            return None
+
+        costs = [node['cost'] for node in nodes if node.get('cost') is not None]
+        plan = QueryPlan(
+            query_record=query_record if query_record.pk else None,
+            fingerprint=query_record.fingerprint or fingerprint(query_record.query),
+            db_alias=alias,
+            vendor=connection.vendor,
+            analyzed=analyzed,
+            nodes=nodes,
+            tables=tables,
+            plan_hash=plan_hash(nodes),
+            total_cost=max(costs) if costs else None,
+            raw=raw,
+        )
+        if query_record.pk:
+            plan.save(using=capture_alias())
+        return plan
+
+    def describe(self, plan):
+        """The plan and table facts in compact text form, for the AI prompt"""
+        lines = [f"Query plan ({plan.vendor}, {'measured' if plan.analyzed else 'estimated'}):"]
+        for node in plan.nodes[:self.max_lines]:
+            line = '  ' * node['depth'] + node['operation']
+            if node.get('relation') and node['relation'] not in node['operation']:
+                line += f" on {node['relation']}"
+            if node.get('index') and node['index'] not in node['operation']:
+                line += f" using {node['index']}"
+            details = []
+            if node.get('rows') is not None:
+                details.append(f"rows={node['rows']}")
+            if node.get('actual_rows') is not None:
+                details.append(f"actual rows={node['actual_rows']}")
+            if node.get('cost') is not None:
+                details.append(f"cost={node['cost']}")
+            if details:
+                line += f" ({', '.join(details)})"
+            lines.append(line)
+        if len(plan.nodes) > self.max_lines:
+            lines.append(f"... {len(plan.nodes) - self.max_lines} more plan nodes")
+
+        if plan.tables:
+            lines.append("Tables:")
+        for table, stats in plan.tables.items():
+            rows = f"~{stats['rows']} rows" if stats.get('rows') is not None else "unknown size"
+            indexes = ', '.join(
+                f"{index['name']}({', '.join(index['columns'])})"
+                + (' primary' if index['primary_key'] else ' unique' if index['unique'] else '')
+                for index in stats['indexes']
+            ) or 'none'
+            lines.append(f"- {table}: {rows}; indexes: {indexes}")
+        return '\n'.join(lines)
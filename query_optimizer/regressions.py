@@ -0,0 +1,219 @@
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+from query_optimizer.fingerprint import normalize_sql
+from query_optimizer.models import QueryPattern, QueryRecord, QueryRegression
+from query_optimizer.sinks import capture_alias, get_config
+from query_optimizer.sketch import DurationSketch
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Distribution:
+    """Sample-weighted durations of one statement shape in one view: a sketch, with the count and total for the mean"""
+
+    def __init__(self, normalized_query):
+        self.normalized_query = normalized_query
+        self.sketch = DurationSketch()
+        self.count = 0.0
+        self.total = 0.0
+
+    def add(self, duration, weight=1.0):
+        self.sketch.add(duration, weight)
+        self.count += weight
+        self.total += duration * weight
+
+    def add_pattern(self, pattern):
+        self.sketch.merge(DurationSketch.from_dict(pattern.sketch))
+        self.count += pattern.estimated_count
+        self.total += pattern.estimated_total_duration
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+def mann_whitney(baseline, candidate):
+    """
+    One-sided p-value of a Mann-Whitney U test that `candidate` durations are
+    larger than `baseline` ones, computed from the bins of two sketches.
+
+    Values in the same bin count as ties. The normal approximation with tie
+    correction is used, which needs a few dozen values on each side: see
+    `regression_min_count`. Sample weights count as observations, so heavily
+    sampled patterns look more certain than they are.
+    """
+    first, second = baseline.sketch, candidate.sketch
+    first_bins = dict(first.bins, zero=first.zero_count)
+    second_bins = dict(second.bins, zero=second.zero_count)
+    keys = sorted(set(first.bins) | set(second.bins))
+
+    n1, n2 = first.count, second.count
+    total = n1 + n2
+    if n1 <= 0 or n2 <= 0 or total < 2:
+        return 1.0
+
+    u = 0.0
+    below = 0.0
+    ties = 0.0
+    for key in ['zero'] + keys:
+        x = first_bins.get(key, 0.0)
+        y = second_bins.get(key, 0.0)
+        u += y * (below + x / 2)
+        below += x
+        ties += (x + y) ** 3 - (x + y)
+
+    variance = n1 * n2 / 12 * ((total + 1) - ties / (total * (total - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+class RegressionDetector:
+    """
+    Finds statement shapes that got slower between two releases or two time windows.
+
+    Releases are compared with the sketches stored on QueryPattern, which
+    are kept per release, so no raw row is read. Time windows are rebuilt
+    from QueryRecord and are only as complete as the stored rows.
+
+    A (fingerprint, view) pair regresses when both sides have at least
+    `min_count` executions, its median or p95 grew by more than `threshold`
+    (0.2 for 20%), and the Mann-Whitney test gives a p-value below `alpha`.
+    Regressions are ranked by the database time they added: the growth of
+    the mean duration times the candidate's executions.
+    """
+
+    def __init__(self, config=None, min_count=None, threshold=None, alpha=None):
+        config = config if config is not None else get_config()
+        self.using = capture_alias(config)
+        self.min_count = min_count if min_count is not None else config.get('regression_min_count', 30)
+        self.threshold = threshold if threshold is not None else config.get('regression_threshold', 0.2)
+        self.alpha = alpha if alpha is not None else config.get('regression_alpha', 0.01)
+        if self.min_count < 2:
+            raise ValueError("regression_min_count must be at least 2")
+        if not 0 < self.alpha < 1:
+            raise ValueError("regression_alpha must be between 0 and 1")
+
+    def releases(self):
+        """Tagged releases, oldest first"""
+        return list(
+            QueryPattern.objects.using(self.using)
+            .exclude(release='')
+            .values('release')
+            .annotate(first_seen=Min('first_seen'))
+            .order_by('first_seen')
+            .values_list('release', flat=True)
+        )
+
+    def release_distributions(self, release):
+        distributions = {}
+        patterns = QueryPattern.objects.using(self.using).filter(release=release).only(
+            'fingerprint', 'view_name', 'normalized_query', 'sketch', 'estimated_count', 'estimated_total_duration',
+        )
+        for pattern in patterns.iterator():
+            key = (pattern.fingerprint, pattern.view_name)
+            if key not in distributions:
+                distributions[key] = Distribution(pattern.normalized_query)
+            distributions[key].add_pattern(pattern)
+        return distributions
+
+    def window_distributions(self, start, end):
+        distributions = {}
+        rows = (
+            QueryRecord.objects.using(self.using)
+            .filter(timestamp__gte=start, timestamp__lt=end)
+            .exclude(fingerprint='')
+            .values_list('fingerprint', 'view_name', 'duration', 'sample_weight', 'query')
+        )
+        for fingerprint, view_name, duration, weight, query in rows.iterator(chunk_size=2000):
+            key = (fingerprint, view_name or '')
+            if key not in distributions:
+                distributions[key] = Distribution(normalize_sql(query))
+            distributions[key].add(duration, weight)
+        return distributions
+
+    def compare(self, baseline, candidate):
+        """Regressions from the `baseline` to the `candidate` distributions, as QueryRegression field dicts"""
+        found = []
+        for key, after in candidate.items():
+            before = baseline.get(key)
+            if before is None or before.count < self.min_count or after.count < self.min_count:
+                continue
+
+            p50 = before.sketch.quantile(0.50), after.sketch.quantile(0.50)
+            p95 = before.sketch.quantile(0.95), after.sketch.quantile(0.95)
+            grew = any(old > 0 and new / old - 1 > self.threshold for old, new in [p50, p95])
+            if not grew:
+                continue
+
+            p_value = mann_whitney(before, after)
+            added_time = (after.mean - before.mean) * after.count
+            if p_value >= self.alpha or added_time <= 0:
+                continue
+
+            found.append({
+                'fingerprint': key[0],
+                'view_name': key[1],
+                'normalized_query': after.normalized_query,
+                'baseline_count': before.count,
+                'candidate_count': after.count,
+                'baseline_mean': before.mean,
+                'candidate_mean': after.mean,
+                'baseline_p50': p50[0],
+                'candidate_p50': p50[1],
+                'baseline_p95': p95[0],
+                'candidate_p95': p95[1],
+                'added_time': added_time,
+                'p_value': p_value,
+            })
+        found.sort(key=lambda regression: regression['added_time'], reverse=True)
+        return found
+
+    def detect_releases(self, baseline=None, candidate=None):
+        """Compare two releases, the last two tagged ones by default"""
+        if baseline is None or candidate is None:
+            releases = self.releases()
+            candidate = candidate or (releases[-1] if releases else None)
+            previous = [release for release in releases if release != candidate]
+            baseline = baseline or (previous[-1] if previous else None)
+            if baseline is None or candidate is None:
+                raise ValueError("Two tagged releases are needed, set release in QUERY_OPTIMIZER_CONFIG")
+
+        found = self.compare(self.release_distributions(baseline), self.release_distributions(candidate))
+        return self.record(QueryRegression.KIND_RELEASE, baseline, candidate, found)
+
+    def detect_windows(self, baseline_start, baseline_end, candidate_start, candidate_end):
+        """Compare the queries captured in two time windows"""
+        found = self.compare(
+            self.window_distributions(baseline_start, baseline_end),
+            self.window_distributions(candidate_start, candidate_end),
+        )
+        return self.record(
+            QueryRegression.KIND_WINDOW,
+            window_label(baseline_start, baseline_end),
+            window_label(candidate_start, candidate_end),
+            found,
+        )
+
+    def record(self, kind, baseline, candidate, found):
+        """Replace the regressions stored for this comparison, so fixed ones disappear on the next run"""
+        now = timezone.now()
+        regressions = [
+            QueryRegression(kind=kind, baseline=baseline, candidate=candidate, detected_at=now, **fields)
+            for fields in found
+        ]
+        with transaction.atomic(using=self.using):
+            QueryRegression.objects.using(self.using).filter(baseline=baseline, candidate=candidate).delete()
+            QueryRegression.objects.using(self.using).bulk_create(regressions)
+        logger.info(f"Found {len(regressions)} query regressions from {baseline} to {candidate}")
+        return regressions
+
+
+def window_label(start, end):
+    if timezone.is_aware(start):
+        start, end = timezone.localtime(start), timezone.localtime(end)
+    return f"{start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}"
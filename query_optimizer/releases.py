@@ -0,0 +1,47 @@
+from query_optimizer.sinks import get_config
+import os
+import subprocess
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+_release = None
+_release_lock = threading.Lock()
+
+
+def resolve_release(config):
+    """
+    Release identifier of the running code.
+
+    `release` in QUERY_OPTIMIZER_CONFIG wins, then the environment variable
+    named by `release_env` (QUERY_OPTIMIZER_RELEASE by default), then the
+    short commit SHA of the git checkout at `release_git_dir`, when set.
+    """
+    release = config.get('release')
+    if release:
+        return str(release)
+
+    release = os.environ.get(config.get('release_env', 'QUERY_OPTIMIZER_RELEASE'))
+    if release:
+        return release
+
+    git_dir = config.get('release_git_dir')
+    if git_dir:
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=git_dir, capture_output=True, text=True, check=True, timeout=5,
+            ).stdout.strip()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Could not read the release from git in {git_dir}: {str(e)}")
+    return ''
+
+
+def current_release():
+    """The release captured queries are tagged with, resolved once per process"""
+    global _release
+    if _release is None:
+        with _release_lock:
+            if _release is None:
+                _release = resolve_release(get_config())[:64]
+    return _release
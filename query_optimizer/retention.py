@@ -0,0 +1,238 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import Count, F, Max, Q, Sum, Value
+from django.db.models.functions import Greatest, TruncDay, TruncHour
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from query_optimizer.models import BudgetViolation, PatternRollup, QueryAnalysis, QueryPlan, QueryRecord, QueryRollup, StackTrace
+from query_optimizer.sinks import capture_alias, get_config
+from query_optimizer.stacks import interner
+from query_optimizer.stats import hour, increment_row, rollup_deltas
+from datetime import timedelta
+from functools import partial
+import gzip
+import json
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERIOD_FUNCTIONS = {PatternRollup.PERIOD_HOUR: TruncHour, PatternRollup.PERIOD_DAY: TruncDay}
+PARTITION_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+ROLLUP_FIELDS = ['count', 'slow_count', 'estimated_count', 'total_duration', 'max_duration']
+ARCHIVE_FIELDS = [
+    'id', 'query', 'duration', 'timestamp', 'is_slow', 'sample_weight', 'fingerprint', 'db_alias', 'view_name',
+    'url_path', 'query_params', 'request_method', 'request_content_type', 'response_status_code',
+]
+
+
+class Pruner:
+    """
+    Deletes the captured queries older than `retention_days`.
+
+    Rows are removed oldest first in transactions of `retention_batch_size`
+    rows. Each batch is first compacted into PatternRollup rows per
+    fingerprint and view over `retention_rollup_period` ("hour" or "day"),
+    removed from the dashboard's hourly QueryRollups and, when
+    `retention_archive_dir` is set, appended to a gzipped JSON lines file
+    once its deletion has committed. Analyses and plans of the deleted
+    queries go with them.
+
+    On PostgreSQL, when the QueryRecord table is partitioned by range of
+    timestamp, whole expired partitions are compacted and dropped instead,
+    and create_partitions() adds the daily partitions of the coming days.
+    """
+
+    def __init__(self, days=None, batch_size=None, archive_dir=None, config=None):
+        config = config if config is not None else get_config()
+        self.days = days if days is not None else config.get('retention_days')
+        if self.days is None or self.days < 1:
+            raise ValueError("Set retention_days in QUERY_OPTIMIZER_CONFIG, or pass a number of days of at least 1")
+        self.batch_size = batch_size or config.get('retention_batch_size', 5000)
+        self.archive_dir = archive_dir or config.get('retention_archive_dir')
+        self.period = config.get('retention_rollup_period', PatternRollup.PERIOD_HOUR)
+        if self.period not in PERIOD_FUNCTIONS:
+            raise ValueError(f"Invalid retention_rollup_period: {self.period}, use one of {', '.join(PERIOD_FUNCTIONS)}")
+        self.using = capture_alias(config)
+        # Whole hours are pruned, so a QueryRollup never covers both deleted and kept rows
+        self.cutoff = hour(timezone.now() - timedelta(days=self.days))
+        self._archive_path = None
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def expired(self):
+        return QueryRecord.objects.using(self.using).filter(timestamp__lt=self.cutoff)
+
+    def compact(self, queryset):
+        """Add the executions of `queryset` to the PatternRollups"""
+        rows = (
+            queryset
+            .annotate(bucket=PERIOD_FUNCTIONS[self.period]('timestamp'))
+            .values('bucket', 'fingerprint', 'view_name')
+            .annotate(
+                count=Count('id'),
+                slow_count=Count('id', filter=Q(is_slow=True)),
+                estimated_count=Sum('sample_weight'),
+                total_duration=Sum('duration'),
+                max_duration=Max('duration'),
+            )
+            .order_by()
+        )
+        rollups = PatternRollup.objects.using(self.using)
+        for row in rows:
+            lookup = {
+                'bucket': row['bucket'],
+                'period': self.period,
+                'fingerprint': row['fingerprint'],
+                'view_name': row['view_name'] or '',
+            }
+            delta = {field: row[field] or 0 for field in ROLLUP_FIELDS}
+            increment_row(rollups, lookup, delta, maxima=['max_duration'])
+
+    def release(self, queryset):
+        """Remove the QueryRecords of `queryset` from the dashboard counts"""
+        rollups = QueryRollup.objects.using(self.using)
+        for (bucket, view_name), delta in rollup_deltas(queryset).items():
+            rollups.filter(bucket=bucket, view_name=view_name).update(
+                **{field: Greatest(F(field) - Value(value), Value(0)) for field, value in delta.items()}
+            )
+
+    def archive(self, queryset):
+        """The rows of `queryset` as JSON lines for the archive, read in the transaction that deletes them"""
+        if not self.archive_dir:
+            return []
+        rows = queryset.values(*ARCHIVE_FIELDS, 'stack__trace', 'stack_trace', 'analysis__analysis').order_by('id')
+        lines = []
+        for row in rows.iterator():
+            row['stack_trace'] = row.pop('stack__trace') or row['stack_trace']
+            row['analysis'] = row.pop('analysis__analysis')
+            lines.append(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+        return lines
+
+    def write_archive(self, lines):
+        """
+        Append archived rows to this run's file.
+
+        Called once the deletion of the rows has committed, so a batch that
+        is rolled back and retried is not archived twice. Every call appends
+        a gzip member, which gzip readers see as one stream.
+        """
+        if not lines:
+            return
+        if self._archive_path is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self._archive_path = os.path.join(self.archive_dir, f"queries-{timezone.now():%Y%m%d-%H%M%S}.jsonl.gz")
+            logger.info(f"Archiving pruned queries to {os.path.basename(self._archive_path)}")
+        with gzip.open(self._archive_path, 'at', encoding='utf-8') as archive:
+            archive.writelines(lines)
+
+    def prune_batch(self, ids):
+        queryset = QueryRecord.objects.using(self.using).filter(id__in=ids)
+        with transaction.atomic(using=self.using):
+            lines = self.archive(queryset)
+            self.compact(queryset)
+            self.release(queryset)
+            # Analyses and plans are deleted with their query
+            deleted = queryset.delete()[1].get(QueryRecord._meta.label, 0)
+            transaction.on_commit(partial(self.write_archive, lines), using=self.using)
+        return deleted
+
+    def prune(self):
+        """Delete the expired queries batch by batch and return how many were deleted"""
+        deleted = 0
+        if self.is_partitioned():
+            deleted += self.drop_partitions()
+        while True:
+            ids = list(self.expired().order_by('timestamp', 'id').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                break
+            deleted += self.prune_batch(ids)
+            logger.debug(f"Pruned {deleted} queries older than {self.cutoff}")
+
+        with transaction.atomic(using=self.using):
+            QueryRollup.objects.using(self.using).filter(count__lte=0).delete()
+            # Recent stacks may belong to queries still being written
+            stacks = StackTrace.objects.using(self.using).filter(
+                created_at__lt=self.cutoff, queries__isnull=True, n_plus_one_findings__isnull=True,
+            )
+            stack_hashes = list(stacks.values_list('hash', flat=True))
+            stacks.delete()
+            BudgetViolation.objects.using(self.using).filter(timestamp__lt=self.cutoff).delete()
+        interner.forget(self.using, stack_hashes)
+        logger.info(f"Pruned {deleted} queries older than {self.cutoff}")
+        return deleted
+
+    # PostgreSQL partitions
+
+    def is_partitioned(self):
+        if self.connection.vendor != 'postgresql':
+            return False
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+                [QueryRecord._meta.db_table],
+            )
+            return cursor.fetchone() is not None
+
+    def partitions(self):
+        """(name, lower bound, upper bound) of the range partitions of the QueryRecord table"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+                [QueryRecord._meta.db_table],
+            )
+            rows = cursor.fetchall()
+        partitions = []
+        for name, bound in rows:
+            match = PARTITION_BOUND_RE.search(bound or '')
+            if match is not None:
+                partitions.append((name, parse_datetime(match.group(1)), parse_datetime(match.group(2))))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    def drop_partitions(self):
+        """Compact and drop the partitions that only hold expired rows, returning the number of rows dropped"""
+        dropped = 0
+        quote = self.connection.ops.quote_name
+        for name, lower, upper in self.partitions():
+            if upper is None or upper > self.cutoff:
+                continue
+            queryset = QueryRecord.objects.using(self.using).filter(timestamp__gte=lower, timestamp__lt=upper)
+            with transaction.atomic(using=self.using):
+                lines = self.archive(queryset)
+                self.compact(queryset)
+                self.release(queryset)
+                count = queryset.count()
+                # A partitioned table cannot be referenced by foreign keys, so dependents are removed here
+                QueryAnalysis.objects.using(self.using).filter(query_record__in=queryset).delete()
+                QueryPlan.objects.using(self.using).filter(query_record__in=queryset).delete()
+                with self.connection.cursor() as cursor:
+                    cursor.execute(f"ALTER TABLE {quote(QueryRecord._meta.db_table)} DETACH PARTITION {quote(name)}")
+                    cursor.execute(f"DROP TABLE {quote(name)}")
+                transaction.on_commit(partial(self.write_archive, lines), using=self.using)
+            dropped += count
+            logger.info(f"Dropped partition {name} with {count} queries")
+        return dropped
+
+    def create_partitions(self, days_ahead=7):
+        """Create the daily partitions from today to `days_ahead` days from now, returning their names"""
+        if not self.is_partitioned():
+            return []
+        quote = self.connection.ops.quote_name
+        table = QueryRecord._meta.db_table
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        created = []
+        for offset in range(days_ahead + 1):
+            start = today + timedelta(days=offset)
+            name = f"{table}_p{start:%Y%m%d}"
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {quote(name)} PARTITION OF {quote(table)} "
+                    "FOR VALUES FROM (%s) TO (%s)",
+                    [start, start + timedelta(days=1)],
+                )
+            created.append(name)
+        return created
@@ -0,0 +1,67 @@
+from query_optimizer.sinks import capture_alias, get_config
+import logging
+
+logger = logging.getLogger(__name__)
+
+APP_LABEL = 'query_optimizer'
+
+
+class QueryOptimizerRouter:
+    """
+    Sends every query_optimizer model to the `database` alias of QUERY_OPTIMIZER_CONFIG.
+
+    Add it to DATABASE_ROUTERS to keep the captured queries, analyses and
+    rollups in their own database, such as a local SQLite file or a separate
+    PostgreSQL server, away from the application's primary. The package's
+    tables are only migrated on that alias, and no other app is migrated
+    there. Without a `database` option, the router leaves every decision to
+    the other routers.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return capture_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return capture_alias()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        labels = {obj1._meta.app_label, obj2._meta.app_label}
+        if APP_LABEL in labels:
+            return labels == {APP_LABEL}
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = capture_alias()
+        if alias == 'default':
+            return None
+        if app_label == APP_LABEL:
+            return db == alias
+        if db == alias:
+            return False
+        return None
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Tune new connections to the capture database.
+
+    SQLite capture databases are switched to WAL journaling, so the
+    dashboard can read while captures are written, with `sqlite_wal`
+    (on by default when `database` is not "default"). `sqlite_busy_timeout`
+    is how many milliseconds a write waits for a lock.
+    """
+    config = get_config()
+    alias = capture_alias(config)
+    if connection.alias != alias or connection.vendor != 'sqlite':
+        return
+    if not config.get('sqlite_wal', alias != 'default'):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(config.get('sqlite_busy_timeout', 5000))}")
+    logger.debug(f"Enabled WAL journaling on the {alias} capture database")
@@ -0,0 +1,311 @@
+from django.utils.module_loading import import_string
+from query_optimizer.sinks import get_config
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Value of the "source" key of analyses made by the rules instead of a provider
+LOCAL_SOURCE = 'rules'
+LOCAL_ANALYSIS_MODES = ['before', 'only', 'off']
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+STRING_RE = re.compile(r"[EeNn]?'(?:[^'\\]|''|\\.)*'")
+SELECT_STAR_RE = re.compile(r'^\s*SELECT\s+(?:DISTINCT\s+)?(?:[\w$"`\[\]]+\.)?\*', re.I)
+LIMIT_RE = re.compile(r'\bLIMIT\b|\bFETCH\s+(?:FIRST|NEXT)\b|^\s*SELECT\s+TOP\b', re.I)
+OFFSET_RE = re.compile(r'\bOFFSET\s+(\d+)|\bLIMIT\s+(\d+)\s*,\s*\d+', re.I)
+LEADING_WILDCARD_RE = re.compile(
+    r'((?:"?[\w$]+"?\.)?"?[\w$]+"?)(?:::\w+)?\)?\s+I?LIKE\s+(?:UPPER\(|LOWER\()?\s*[EeNn]?\'%',
+    re.I,
+)
+COUNT_RE = re.compile(r'^\s*SELECT\s+COUNT\(\s*(?:\*|1)\s*\)(?:\s+AS\s+\S+)?\s+FROM\s+"?([\w$]+)"?', re.I)
+WHERE_RE = re.compile(r'\bWHERE\b', re.I)
+
+
+class QueryContext:
+    """What the rules look at: the SQL without comments and literals, the plan nodes and the table facts"""
+
+    def __init__(self, query_record, plan=None):
+        self.query_record = query_record
+        self.sql = query_record.query
+        self.stripped = STRING_RE.sub("''", COMMENT_RE.sub(' ', self.sql))
+        self.nodes = plan.nodes if plan is not None else []
+        self.tables = plan.tables if plan is not None else {}
+
+    def rows(self, table):
+        return (self.tables.get(table) or {}).get('rows')
+
+    def indexed_columns(self, table):
+        """First columns of the existing indexes of `table`"""
+        return {index['columns'][0] for index in (self.tables.get(table) or {}).get('indexes', []) if index['columns']}
+
+    def has_where(self):
+        return bool(WHERE_RE.search(self.stripped))
+
+    def filtered_columns(self, table):
+        """Columns of `table` compared in the query's conditions"""
+        pattern = re.compile(
+            rf'"?{re.escape(table)}"?\."?([\w$]+)"?\s*(?:=|<>|!=|<=|>=|<|>|\bIN\b|\bBETWEEN\b|\bIS\b)',
+            re.I,
+        )
+        return list(dict.fromkeys(pattern.findall(self.stripped)))
+
+
+class Finding:
+    """A problem found by a rule, with how sure the rule is about it (0 to 1)"""
+
+    def __init__(self, rule, confidence, analysis, suggestion, optimized_query='', index_suggestion='', orm_improvement=''):
+        self.rule = rule
+        self.confidence = confidence
+        self.analysis = analysis
+        self.suggestion = suggestion
+        self.optimized_query = optimized_query
+        self.index_suggestion = index_suggestion
+        self.orm_improvement = orm_improvement
+
+
+class Rule:
+    """
+    Base class of the local analysis rules.
+
+    check() gets a QueryContext and returns a Finding, or None when the rule
+    does not apply. Rules must not access the database.
+    """
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+        self.large_table_rows = config.get('large_table_rows', 100000)
+
+    def check(self, context):
+        raise NotImplementedError
+
+    def finding(self, confidence, analysis, suggestion, **kwargs):
+        return Finding(self.name, confidence, analysis, suggestion, **kwargs)
+
+
+class SelectStarRule(Rule):
+    name = 'select_star'
+
+    def check(self, context):
+        if not SELECT_STAR_RE.match(context.stripped):
+            return None
+        return self.finding(
+            0.8,
+            "The query selects every column with SELECT *, reading and transferring columns that may not be used "
+            "and preventing index-only scans.",
+            "List only the columns the code needs.",
+            orm_improvement="Use .only(), .defer() or .values() to load only the needed fields.",
+        )
+
+
+class LeadingWildcardLikeRule(Rule):
+    name = 'leading_wildcard_like'
+
+    def check(self, context):
+        match = LEADING_WILDCARD_RE.search(context.sql)
+        if match is None:
+            return None
+        parts = [part.strip('"') for part in match.group(1).split('.')]
+        table = parts[0] if len(parts) == 2 else '<table>'
+        return self.finding(
+            0.85,
+            f"{'.'.join(parts)} is matched with a LIKE pattern that starts with a wildcard, so no B-tree index can "
+            "be used and every row is scanned.",
+            "Match on a prefix when possible, or use full-text search for word lookups.",
+            index_suggestion=(
+                f"On PostgreSQL, a trigram index supports these patterns: CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+                f"CREATE INDEX ON {table} USING gin ({parts[-1]} gin_trgm_ops);"
+            ),
+            orm_improvement="Prefer __startswith/__istartswith over __contains/__icontains, or django.contrib.postgres "
+                            "SearchVector/TrigramSimilarity for searches.",
+        )
+
+
+class DeepOffsetRule(Rule):
+    name = 'deep_offset'
+
+    def check(self, context):
+        match = OFFSET_RE.search(context.stripped)
+        if match is None:
+            return None
+        offset = int(match.group(1) or match.group(2))
+        if offset < self.config.get('deep_offset', 1000):
+            return None
+        return self.finding(
+            0.9,
+            f"The query skips {offset} rows with OFFSET: the database still reads and discards all of them, so "
+            "every page is slower than the previous one.",
+            "Use keyset pagination: filter on the last value of the ordering column seen (WHERE id > last_id "
+            "ORDER BY id LIMIT n) instead of an offset.",
+            orm_improvement="Paginate with a filter on the ordering field (e.g. .filter(id__gt=last_id)[:n]) or a "
+                            "cursor paginator instead of slicing deep into the queryset.",
+        )
+
+
+class CountOnLargeTableRule(Rule):
+    name = 'count_large_table'
+
+    def check(self, context):
+        match = COUNT_RE.match(context.stripped)
+        if match is None or context.has_where():
+            return None
+        table = match.group(1)
+        rows = context.rows(table)
+        if rows is None or rows < self.large_table_rows:
+            return None
+        return self.finding(
+            0.8,
+            f"The query counts every row of {table} (about {rows} rows), which scans the whole table or index.",
+            "Cache the count, maintain it in a counter, or use the planner's estimate when an exact number is not needed.",
+            orm_improvement="Avoid .count() on every page view of a large table: cache it, or give the Paginator an "
+                            "estimated count.",
+        )
+
+
+class MissingLimitRule(Rule):
+    name = 'missing_limit'
+
+    def check(self, context):
+        if not context.stripped.lstrip().upper().startswith('SELECT') or COUNT_RE.match(context.stripped):
+            return None
+        if LIMIT_RE.search(context.stripped) or context.has_where():
+            return None
+        large = [table for table in context.tables if (context.rows(table) or 0) >= self.large_table_rows]
+        if not large:
+            return None
+        return self.finding(
+            0.75,
+            f"The query reads {', '.join(large)} without a WHERE clause or LIMIT, loading every row of a large table.",
+            "Filter the rows or paginate the results.",
+            orm_improvement="Slice the queryset ([:n]), paginate it, or iterate with .iterator() when every row "
+                            "really has to be processed.",
+        )
+
+
+class SequentialScanRule(Rule):
+    name = 'sequential_scan'
+
+    def scanned_tables(self, context):
+        for node in context.nodes:
+            operation = node.get('operation', '')
+            relation = node.get('relation')
+            if not relation:
+                continue
+            if (
+                operation == 'Seq Scan'
+                or operation == 'ALL'
+                or (operation.startswith('SCAN ') and ' USING ' not in operation)
+            ):
+                yield relation
+
+    def check(self, context):
+        for table in self.scanned_tables(context):
+            rows = context.rows(table)
+            if rows is None or rows < self.large_table_rows:
+                continue
+            indexed = context.indexed_columns(table)
+            columns = [column for column in context.filtered_columns(table) if column not in indexed]
+            if not columns:
+                return self.finding(
+                    0.6,
+                    f"The plan scans all of {table} (about {rows} rows).",
+                    "Check whether the query can filter on an indexed column.",
+                )
+            return self.finding(
+                0.85,
+                f"The plan scans all of {table} (about {rows} rows) although the query filters on "
+                f"{', '.join(columns)}, which no index starts with.",
+                f"Add an index on {table} ({', '.join(columns)}).",
+                index_suggestion=f"CREATE INDEX {table}_{'_'.join(columns)}_idx ON {table} ({', '.join(columns)});",
+                orm_improvement=f"Add models.Index(fields={columns!r}) to the model's Meta.indexes, or db_index=True "
+                                "on the field.",
+            )
+        return None
+
+
+DEFAULT_RULES = [
+    SelectStarRule,
+    LeadingWildcardLikeRule,
+    DeepOffsetRule,
+    CountOnLargeTableRule,
+    MissingLimitRule,
+    SequentialScanRule,
+]
+
+
+class LocalAnalyzer:
+    """
+    Analyzes queries with a catalog of rules, without calling a provider.
+
+    In the "before" mode the provider is only called when no rule matches
+    with at least `local_analysis_min_confidence`; in the "only" mode it is
+    never called. Extra rules are Rule subclasses listed by dotted path in
+    `analysis_rules`, and `disabled_analysis_rules` turns rules off by name.
+    Results have the same keys as a provider analysis, plus "source",
+    "rules" and "confidence".
+    """
+
+    def __init__(self, config=None):
+        config = config if config is not None else get_config()
+        self.mode = config.get('local_analysis', 'before')
+        if self.mode not in LOCAL_ANALYSIS_MODES:
+            raise ValueError(f"Invalid local_analysis: {self.mode}, use one of {', '.join(LOCAL_ANALYSIS_MODES)}")
+        self.min_confidence = config.get('local_analysis_min_confidence', 0.7)
+
+        disabled = set(config.get('disabled_analysis_rules', []))
+        rule_classes = DEFAULT_RULES + [import_string(path) for path in config.get('analysis_rules', [])]
+        self.rules = [rule_class(config) for rule_class in rule_classes if rule_class.name not in disabled]
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def findings(self, query_record, plan=None):
+        """Findings of every matching rule, most confident first"""
+        context = QueryContext(query_record, plan)
+        findings = []
+        for rule in self.rules:
+            try:
+                finding = rule.check(context)
+            except Exception as e:
+                logger.debug(f"Analysis rule {rule.name} failed on query {query_record.pk}: {e}")
+                continue
+            if finding is not None:
+                findings.append(finding)
+        return sorted(findings, key=lambda finding: finding.confidence, reverse=True)
+
+    def analyze(self, query_record, plan=None):
+        """Return the local analysis of `query_record`, or None when the provider should be asked"""
+        if not self.enabled:
+            return None
+
+        findings = self.findings(query_record, plan)
+        if self.mode == 'before' and (not findings or findings[0].confidence < self.min_confidence):
+            return None
+
+        if not findings:
+            return {
+                "analysis": "No known performance problem pattern matched this query.",
+                "optimization_suggestions": "",
+                "optimized_query": "",
+                "index_suggestions": "",
+                "django_orm_improvements": "",
+                "source": LOCAL_SOURCE,
+                "rules": [],
+                "confidence": 0.0,
+            }
+
+        def join(values):
+            return '\n'.join(value for value in values if value)
+
+        return {
+            "analysis": join(finding.analysis for finding in findings),
+            "optimization_suggestions": join(finding.suggestion for finding in findings),
+            "optimized_query": next((finding.optimized_query for finding in findings if finding.optimized_query), ''),
+            "index_suggestions": join(finding.index_suggestion for finding in findings),
+            "django_orm_improvements": join(finding.orm_improvement for finding in findings),
+            "source": LOCAL_SOURCE,
+            "rules": [finding.rule for finding in findings],
+            "confidence": findings[0].confidence,
+        }
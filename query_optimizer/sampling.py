@@ -0,0 +1,121 @@
+from query_optimizer.matchers import PrefixMatcher
+import random
+
+
+class AdaptiveRate:
+    """
+    Scales sample rates down when capture costs more than its budget.
+
+    Each observation is the capture overhead of one sampled request and the
+    request's duration. The overhead share is smoothed with an exponentially
+    weighted moving average; while it is above `overhead_budget` (a fraction
+    of request time) or the smoothed overhead is above `max_overhead`
+    seconds, the scale shrinks by 10% per request down to `min_scale`. Once
+    the cost is back under half the budget it grows again by 5% per request.
+    """
+
+    def __init__(self, overhead_budget=0.05, max_overhead=None, min_scale=0.01, smoothing=0.1):
+        self.overhead_budget = overhead_budget
+        self.max_overhead = max_overhead
+        self.min_scale = min_scale
+        self.smoothing = smoothing
+        self.scale = 1.0
+        self.overhead_share = 0.0
+        self.overhead = 0.0
+
+    def observe(self, overhead, duration):
+        share = overhead / duration if duration > 0 else 0.0
+        self.overhead_share += self.smoothing * (share - self.overhead_share)
+        self.overhead += self.smoothing * (overhead - self.overhead)
+
+        over = self.overhead_share > self.overhead_budget
+        under = self.overhead_share < self.overhead_budget / 2
+        if self.max_overhead is not None:
+            over = over or self.overhead > self.max_overhead
+            under = under and self.overhead < self.max_overhead / 2
+
+        if over:
+            self.scale = max(self.min_scale, self.scale * 0.9)
+        elif under:
+            self.scale = min(1.0, self.scale * 1.05)
+
+
+class RequestSampler:
+    """
+    Decides which requests get full query capture.
+
+    Rates come from `sample_rate` and `sample_rates` in QUERY_OPTIMIZER_CONFIG.
+    Keys of `sample_rates` starting with "/" are path prefixes (the longest
+    match wins); other keys are view names and take precedence once the view
+    is resolved. Requests over the `always_capture` budgets ("duration" in
+    seconds, "queries" as a count) are captured whatever their rate.
+
+    Each request draws one random number, so a rate that changes when the
+    view is resolved keeps the decision consistent. Captured rows carry a
+    sample weight of 1 / rate so totals can be extrapolated; requests over
+    budget would have been captured anyway and get a weight of 1.
+    """
+
+    def __init__(self, config):
+        self.default_rate = config.get('sample_rate', 1.0)
+
+        rates = config.get('sample_rates', {}) or {}
+        self.path_rates = {prefix: rate for prefix, rate in rates.items() if prefix.startswith('/')}
+        self.path_matcher = PrefixMatcher(self.path_rates)
+        self.view_rates = {name: rate for name, rate in rates.items() if not name.startswith('/')}
+
+        always = config.get('always_capture', {}) or {}
+        self.max_duration = always.get('duration')
+        self.max_queries = always.get('queries')
+
+        adaptive = config.get('adaptive_sampling', {}) or {}
+        self.adaptive = None
+        if adaptive.get('enabled', bool(adaptive)):
+            self.adaptive = AdaptiveRate(
+                overhead_budget=adaptive.get('overhead_budget', 0.05),
+                max_overhead=adaptive.get('max_overhead'),
+                min_scale=adaptive.get('min_scale', 0.01),
+            )
+
+        self.check_config()
+
+    def check_config(self):
+        for rate in [self.default_rate] + list(self.path_rates.values()) + list(self.view_rates.values()):
+            if not isinstance(rate, (int, float)) or not 0.0 <= rate <= 1.0:
+                raise ValueError("sample rates must be numbers between 0.0 and 1.0")
+
+    @property
+    def is_enabled(self):
+        """False when every request is captured in full, so sampling can be skipped"""
+        return bool(self.adaptive or self.default_rate < 1.0 or self.path_rates or self.view_rates)
+
+    def scaled(self, rate):
+        if self.adaptive is not None:
+            return rate * self.adaptive.scale
+        return rate
+
+    def rate_for_path(self, path):
+        prefix = self.path_matcher.match(path)
+        return self.scaled(self.path_rates[prefix] if prefix is not None else self.default_rate)
+
+    def rate_for_view(self, view_name):
+        """Rate configured for `view_name`, or None when the view has no rate of its own"""
+        rate = self.view_rates.get(view_name)
+        return None if rate is None else self.scaled(rate)
+
+    def draw(self):
+        return random.random()
+
+    @property
+    def can_promote(self):
+        """True when an `always_capture` budget can capture a request that was not sampled"""
+        return self.max_duration is not None or self.max_queries is not None
+
+    def is_over_budget(self, duration, query_count):
+        if self.max_duration is not None and duration > self.max_duration:
+            return True
+        return self.max_queries is not None and query_count > self.max_queries
+
+    def observe(self, overhead, duration):
+        if self.adaptive is not None:
+            self.adaptive.observe(overhead, duration)
@@ -1,11 +1,27 @@
 from abc import ABC, abstractmethod
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from .models import QueryRecord
+from .plans import PlanCollector
+from .rules import LocalAnalyzer
 import json
+import os
+import tempfile
+import threading
+import uuid
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+PROVIDERS = ['mistral', 'openai', 'anthropic', 'stub']
+
+# Provider batch states, as returned by AIProviderClient.batch_status()
+BATCH_IN_PROGRESS = 'in_progress'
+BATCH_ENDED = 'ended'
+BATCH_FAILED = 'failed'
+
 
 class AIProviderClient(ABC):
     """Abstract base class for AI provider clients"""
@@ -14,12 +30,51 @@ class AIProviderClient(ABC):
     def analyze_query(self, prompt: str, model: str) -> str:
         pass
 
-class MistralClient(AIProviderClient):
-    def __init__(self, api_key: str):
+    def stream_query(self, prompt: str, model: str):
+        """Yield the completion in chunks as they arrive (in one chunk unless the provider streams)"""
+        yield self.analyze_query(prompt, model)
+
+    supports_batch = False
+
+    def submit_batch(self, requests, model: str) -> str:
+        """Submit (custom_id, prompt) pairs as one provider batch and return its id"""
+        raise NotImplementedError(f"{type(self).__name__} does not support batch analysis")
+
+    def batch_status(self, batch_id: str) -> str:
+        """BATCH_IN_PROGRESS, BATCH_ENDED once results can be fetched, or BATCH_FAILED"""
+        raise NotImplementedError(f"{type(self).__name__} does not support batch analysis")
+
+    def batch_results(self, batch_id: str):
+        """Yield (custom_id, completion, error) for every request of an ended batch"""
+        raise NotImplementedError(f"{type(self).__name__} does not support batch analysis")
+
+    def close(self):
+        """Release the client's HTTP connections"""
+        client = getattr(self, 'client', None)
+        if client is not None and hasattr(client, 'close'):
+            client.close()
+
+
+def build_http_client(connect_timeout=5.0, read_timeout=60.0, max_connections=10, keepalive_expiry=30.0):
+    """HTTP client shared by every call of one provider client: pooled keep-alive connections and timeouts"""
+    import httpx
+    return httpx.Client(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+    )
+
+
+class OpenAIClient(AIProviderClient):
+    def __init__(self, api_key: str, max_retries: int = 2, **http_options):
         from openai import OpenAI
         self.client = OpenAI(
-            base_url="https://api.mistral.ai/v1/",
-            api_key=api_key
+            api_key=api_key,
+            max_retries=max_retries,
+            http_client=build_http_client(**http_options),
         )
     
     def analyze_query(self, prompt: str, model: str) -> str:
@@ -29,22 +84,85 @@ class MistralClient(AIProviderClient):
         )
         return response.choices[0].message.content
 
-class OpenAIClient(AIProviderClient):
-    def __init__(self, api_key: str):
-        from openai import OpenAI
-        self.client = OpenAI(api_key=api_key)
-    
-    def analyze_query(self, prompt: str, model: str) -> str:
-        response = self.client.chat.completions.create(
+    def stream_query(self, prompt: str, model: str):
+        stream = self.client.chat.completions.create(
             model=model,
-            messages=[{"role": "user", "content": prompt}]
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    supports_batch = True
+
+    def submit_batch(self, requests, model: str) -> str:
+        lines = [
+            json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": [{"role": "user", "content": prompt}]},
+            })
+            for custom_id, prompt in requests
+        ]
+        batch_file = self.client.files.create(
+            file=("query_optimizer_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def batch_status(self, batch_id: str) -> str:
+        status = self.client.batches.retrieve(batch_id).status
+        if status == 'failed':
+            return BATCH_FAILED
+        # Expired and cancelled batches keep the results of their finished requests
+        if status in ('completed', 'expired', 'cancelled'):
+            return BATCH_ENDED
+        return BATCH_IN_PROGRESS
+
+    def batch_results(self, batch_id: str):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    yield item["custom_id"], None, str(item.get("error") or response.get("body"))
+                else:
+                    yield item["custom_id"], response["body"]["choices"][0]["message"]["content"], None
+
+class MistralClient(OpenAIClient):
+    """Mistral serves an OpenAI compatible API, but not its batch endpoints"""
+
+    supports_batch = False
+
+    def __init__(self, api_key: str, max_retries: int = 2, **http_options):
+        from openai import OpenAI
+        self.client = OpenAI(
+            base_url="https://api.mistral.ai/v1/",
+            api_key=api_key,
+            max_retries=max_retries,
+            http_client=build_http_client(**http_options),
         )
-        return response.choices[0].message.content
 
 class AnthropicClient(AIProviderClient):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_retries: int = 2, **http_options):
         from anthropic import Anthropic
-        self.client = Anthropic(api_key=api_key)
+        self.client = Anthropic(
+            api_key=api_key,
+            max_retries=max_retries,
+            http_client=build_http_client(**http_options),
+        )
     
     def analyze_query(self, prompt: str, model: str) -> str:
         response = self.client.messages.create(
@@ -54,6 +172,273 @@ class AnthropicClient(AIProviderClient):
         )
         return response.content[0].text
 
+    def stream_query(self, prompt: str, model: str):
+        with self.client.messages.stream(
+            model=model,
+            max_tokens=2000,
+            messages=[{"role": "user", "content": prompt}]
+        ) as stream:
+            yield from stream.text_stream
+
+    supports_batch = True
+
+    def submit_batch(self, requests, model: str) -> str:
+        batch = self.client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": {
+                    "model": model,
+                    "max_tokens": 2000,
+                    "messages": [{"role": "user", "content": prompt}],
+                },
+            }
+            for custom_id, prompt in requests
+        ])
+        return batch.id
+
+    def batch_status(self, batch_id: str) -> str:
+        status = self.client.messages.batches.retrieve(batch_id).processing_status
+        return BATCH_ENDED if status == 'ended' else BATCH_IN_PROGRESS
+
+    def batch_results(self, batch_id: str):
+        for item in self.client.messages.batches.results(batch_id):
+            if item.result.type == 'succeeded':
+                yield item.custom_id, item.result.message.content[0].text, None
+            else:
+                error = getattr(item.result, 'error', None)
+                yield item.custom_id, None, str(error or item.result.type)
+
+class StubClient(AIProviderClient):
+    """
+    Offline provider for tests and local development.
+
+    It answers every prompt with the same well-formed analysis, streamed in
+    small chunks `delay` seconds apart, without any network access. Its
+    batch endpoint writes each batch to a JSONL file in `batch_dir`, which
+    is reported as ended `batch_delay` seconds later, so batches can be
+    collected by another process.
+    """
+
+    supports_batch = True
+
+    def __init__(self, api_key: str = None, delay: float = 0.0, batch_dir: str = None,
+                 batch_delay: float = 0.0, **options):
+        self.delay = delay
+        self.batch_dir = batch_dir or os.path.join(tempfile.gettempdir(), 'query_optimizer_batches')
+        self.batch_delay = batch_delay
+
+    def analyze_query(self, prompt: str, model: str) -> str:
+        return ''.join(self.stream_query(prompt, model))
+
+    def stream_query(self, prompt: str, model: str):
+        text = json.dumps({
+            "analysis": f"Stub analysis from {model}: no provider was called.",
+            "optimization_suggestions": "Check that the filtered columns are indexed and only the needed columns are selected.",
+            "optimized_query": "",
+            "index_suggestions": "",
+            "django_orm_improvements": "Use select_related() or prefetch_related() for related objects read in loops.",
+        }, indent=2)
+        for start in range(0, len(text), 32):
+            if self.delay:
+                time.sleep(self.delay)
+            yield text[start:start + 32]
+
+    def _batch_path(self, batch_id):
+        return os.path.join(self.batch_dir, f"{batch_id}.jsonl")
+
+    def submit_batch(self, requests, model: str) -> str:
+        os.makedirs(self.batch_dir, exist_ok=True)
+        batch_id = f"stub-batch-{uuid.uuid4().hex}"
+        with open(self._batch_path(batch_id), 'w', encoding='utf-8') as batch_file:
+            for custom_id, prompt in requests:
+                batch_file.write(json.dumps({"custom_id": custom_id, "model": model, "prompt": prompt}) + "\n")
+        return batch_id
+
+    def batch_status(self, batch_id: str) -> str:
+        path = self._batch_path(batch_id)
+        if not os.path.exists(path):
+            return BATCH_FAILED
+        if time.time() - os.path.getmtime(path) < self.batch_delay:
+            return BATCH_IN_PROGRESS
+        return BATCH_ENDED
+
+    def batch_results(self, batch_id: str):
+        with open(self._batch_path(batch_id), encoding='utf-8') as batch_file:
+            for line in batch_file:
+                item = json.loads(line)
+                yield item["custom_id"], self.analyze_query(item["prompt"], item["model"]), None
+
+
+CLIENT_CLASSES = {
+    'mistral': MistralClient,
+    'openai': OpenAIClient,
+    'anthropic': AnthropicClient,
+    'stub': StubClient,
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls fail fast with CircuitOpenError for `reset_timeout` seconds. Then a
+    single trial call is let through: its success closes the circuit, its
+    failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name} is failing, calls are suspended for up to {self.reset_timeout:.0f}s")
+            self.trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self):
+        """End a call whose outcome is unknown, such as a stream abandoned by its consumer"""
+        with self._lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    logger.warning(f"Circuit opened for {self.name} after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+_clients = {}
+_breakers = {}
+_optimizer = None
+_registry_lock = threading.Lock()
+
+
+def client_options(provider, config):
+    """Constructor options of the `provider` client, from QUERY_OPTIMIZER_CONFIG"""
+    if provider == 'stub':
+        return {
+            'delay': config.get('stub_delay', 0.0),
+            'batch_dir': config.get('stub_batch_dir'),
+            'batch_delay': config.get('stub_batch_delay', 0.0),
+        }
+
+    timeout = config.get('timeout', {})
+    if isinstance(timeout, (int, float)):
+        timeout = {'read': timeout}
+    return {
+        'connect_timeout': timeout.get('connect', 5.0),
+        'read_timeout': timeout.get('read', 60.0),
+        'max_connections': config.get('max_connections', 10),
+        'keepalive_expiry': config.get('keepalive_expiry', 30.0),
+        'max_retries': config.get('client_max_retries', 2),
+    }
+
+
+def get_client(provider, api_key, config=None):
+    """
+    Return the process-wide client of `provider`.
+
+    Clients are built once per provider, key and options and then shared, so
+    their HTTP connections are kept alive and reused across requests and
+    threads.
+    """
+    config = config if config is not None else (getattr(settings, 'QUERY_OPTIMIZER_CONFIG', None) or {})
+    options = client_options(provider, config)
+    key = (provider, api_key, tuple(sorted(options.items())))
+    with _registry_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = CLIENT_CLASSES[provider](api_key, **options)
+        return client
+
+
+def get_circuit_breaker(provider, config=None):
+    """Return the process-wide circuit breaker of `provider`"""
+    config = config if config is not None else (getattr(settings, 'QUERY_OPTIMIZER_CONFIG', None) or {})
+    options = config.get('circuit_breaker', {})
+    with _registry_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(
+                provider,
+                failure_threshold=options.get('failure_threshold', 5),
+                reset_timeout=options.get('reset_timeout', 30.0),
+            )
+        return breaker
+
+
+def get_optimizer():
+    """Return a QueryOptimizerAI shared by the whole process"""
+    global _optimizer
+    if _optimizer is None:
+        optimizer = QueryOptimizerAI()
+        with _registry_lock:
+            if _optimizer is None:
+                _optimizer = optimizer
+    return _optimizer
+
+
+def reset_clients():
+    """Close and forget the shared clients, breakers and optimizer"""
+    global _optimizer
+    with _registry_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _breakers.clear()
+        _optimizer = None
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"Failed to close AI client: {e}")
+
+
+@receiver(setting_changed)
+def _reset_on_config_change(setting, **kwargs):
+    if setting == 'QUERY_OPTIMIZER_CONFIG':
+        reset_clients()
+
+
 class QueryOptimizerAI:
     def __init__(self):
         """
@@ -67,53 +452,131 @@ class QueryOptimizerAI:
         self.model = self.config.get('model', None)
         self.api_key = self.config.get('api_key', None)
         self.client = None
+        self.local = LocalAnalyzer(self.config)
         self._check_config()
         self._setup_client()
+        self.plans = PlanCollector(self.config)
     
     def _check_config(self):
         """Check if the config is valid"""
-        if not self.provider in ['mistral', 'openai', 'anthropic']:
-            raise ValueError("Invalid provider: {self.provider} we only support mistral, openai, and anthropic")
+        if not self.provider in PROVIDERS:
+            raise ValueError(f"Invalid provider: {self.provider} we only support mistral, openai, anthropic and stub")
         
         if not self.model:
             raise ValueError("model is not set in QUERY_OPTIMIZER_CONFIG, please set the model in the QUERY_OPTIMIZER_CONFIG in settings.py")
         
-        if not self.api_key:
+        if not self.api_key and self.provider != 'stub' and self.local.mode != 'only':
             raise ValueError("api_key is not set in QUERY_OPTIMIZER_CONFIG, please set the api_key in the QUERY_OPTIMIZER_CONFIG in settings.py")
 
         
     def _setup_client(self):
-        """Initialize the client based on the provider"""
-        if self.provider == "mistral":
-            self.client = MistralClient(self.api_key)
-        elif self.provider == "openai":
-            self.client = OpenAIClient(self.api_key)
-        elif self.provider == "anthropic":
-            self.client = AnthropicClient(self.api_key)
+        """Get the shared client and circuit breaker of the provider"""
+        if self.local.mode == 'only':
+            # Every query is analyzed by the local rules, no provider is needed
+            self.client = StubClient()
+            self.breaker = CircuitBreaker(self.provider)
+            return
+
+        self.client = get_client(self.provider, self.api_key, self.config)
+        self.breaker = get_circuit_breaker(self.provider, self.config)
         
         if not self.client:
             raise ValueError(f"Failed to initialize client for provider: {self.provider}, please check the provider in the QUERY_OPTIMIZER_CONFIG in settings.py")
     
-    def analyze_query(self, query_record: QueryRecord) -> dict:
-        """Analyze a query record and return optimization suggestions"""           
+    def analyze_query(self, query_record: QueryRecord, raise_errors: bool = False) -> dict:
+        """
+        Analyze a query record and return optimization suggestions.
+
+        Provider errors are logged and None is returned, unless `raise_errors`
+        is set, in which case they propagate so the caller can retry. The
+        local rules answer first when they are confident enough.
+        """
+        analysis = self.analyze_locally(query_record)
+        if analysis is not None:
+            return analysis
+
         prompt = self._build_optimization_prompt(query_record)
 
         try:
-            analysis = self.client.analyze_query(prompt, self.model)
+            analysis = self.breaker.call(self.client.analyze_query, prompt, self.model)
             return self._parse_ai_response(analysis)
         except Exception as e:
+            if raise_errors:
+                raise
             logger.info(f"AI analysis failed with {self.provider}: {e}")
             return None
     
+    def analyze_query_stream(self, query_record: QueryRecord):
+        """
+        Yield the provider's completion in chunks as it arrives.
+
+        Errors propagate. Pass the joined chunks to parse_response() to get
+        the same dict as analyze_query().
+        """
+        analysis = self.analyze_locally(query_record)
+        if analysis is not None:
+            yield json.dumps(analysis, indent=2)
+            return
+
+        prompt = self._build_optimization_prompt(query_record)
+        self.breaker.before_call()
+        settled = False
+        try:
+            for chunk in self.client.stream_query(prompt, self.model):
+                yield chunk
+        except Exception:
+            settled = True
+            self.breaker.record_failure()
+            raise
+        else:
+            settled = True
+            self.breaker.record_success()
+        finally:
+            # GeneratorExit when the client disconnects: the provider was neither
+            # right nor wrong, but a half-open circuit must let its next trial through
+            if not settled:
+                self.breaker.release()
+
+    def parse_response(self, response_text: str) -> dict:
+        return self._parse_ai_response(response_text)
+
+    def build_prompt(self, query_record: QueryRecord) -> str:
+        return self._build_optimization_prompt(query_record)
+
+    def prepare(self, query_record: QueryRecord):
+        """Collect the plan of `query_record` now, so building its prompt later needs no database access"""
+        query_record._query_plan = self.plans.collect(query_record)
+
+    def plan_for(self, query_record: QueryRecord):
+        if not hasattr(query_record, '_query_plan'):
+            self.prepare(query_record)
+        return query_record._query_plan
+
+    def analyze_locally(self, query_record: QueryRecord):
+        """The analysis of the local rules, or None when the provider has to be asked"""
+        if not self.local.enabled:
+            return None
+        return self.local.analyze(query_record, self.plan_for(query_record))
+
+    def _plan_context(self, query_record: QueryRecord) -> str:
+        plan = self.plan_for(query_record)
+        if plan is None:
+            return ''
+        return self.plans.describe(plan)
+    
     def _build_optimization_prompt(self, query_record: QueryRecord) -> str:
-        """Build the optimization prompt for the AI"""
+        """Build the optimization prompt for the AI, with the query plan and table indexes when available"""
+        plan_context = self._plan_context(query_record)
+        if plan_context:
+            plan_context = f"{plan_context}\n\nBase index suggestions on this plan, and do not suggest indexes that already exist.\n"
         return f"""
         Analyze this SQL query for potential optimizations:
         
         Query: {query_record.query}
         Execution Time: {query_record.duration} seconds
-        Context: {query_record.stack_trace[-500:] if query_record.stack_trace else 'No context'}
+        Context: {query_record.full_stack_trace[-500:] if query_record.full_stack_trace else 'No context'}
         
+{plan_context}
         Please provide:
         1. A detailed analysis of the query performance issues
         2. Specific optimization suggestions
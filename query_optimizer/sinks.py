@@ -0,0 +1,344 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+from query_optimizer.capture import without_capture
+from query_optimizer.detectors import record_findings
+from query_optimizer.models import BudgetViolation, QueryRecord
+from query_optimizer.patterns import fingerprint_events, select_outliers, update_patterns
+from query_optimizer.stacks import interner, stack_hash
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_MODES = ['request', 'buffered', 'thread', 'process']
+QUEUED_PERSISTENCE_MODES = ['thread', 'process']
+RAW_QUERY_POLICIES = ['all', 'outliers']
+CAPTURE_ISOLATION_MODES = ['auto', 'always', 'off']
+
+
+def get_config():
+    """Return QUERY_OPTIMIZER_CONFIG, or an empty dict when it is not set"""
+    return getattr(settings, 'QUERY_OPTIMIZER_CONFIG', None) or {}
+
+
+def capture_alias(config=None):
+    """Database alias the package stores its rows in, from the `database` option"""
+    config = config if config is not None else get_config()
+    return config.get('database') or 'default'
+
+
+def application_aliases(config=None):
+    """Aliases whose queries are captured by default: every one but a dedicated capture database, or None for all"""
+    alias = capture_alias(config)
+    if alias == 'default':
+        return None
+    return [other for other in connections if other != alias]
+
+
+@without_capture
+def persist_events(events, batch_size=None, using=None):
+    """
+    Write a batch of capture events to QueryRecord with a single bulk_create.
+
+    A capture event is a plain dict of QueryRecord field values, built by the
+    middleware or the decorator while the request runs. `using` selects the
+    database alias, defaulting to the `database` config option.
+
+    Events may carry raw `stack_frames` instead of a formatted stack trace:
+    they are hashed, formatted once per distinct stack and stored in
+    StackTrace, here rather than on the request path.
+
+    Events with `kind` set to "n_plus_one" are N+1 findings and are upserted
+    into NPlusOneFinding instead; those with `kind` set to "budget" are
+    inserted into BudgetViolation.
+
+    Query events are tagged with the current release, then fingerprinted and
+    folded into the QueryPattern of their release. With
+    `store_raw_queries` set to "outliers", only slow queries, queries above
+    their pattern's p99 and the first sample of a new pattern are also kept
+    as QueryRecord rows.
+
+    The stored rows are also counted in the hourly QueryRollup of their view.
+    The writes are never captured as application queries.
+    """
+    if not events:
+        return 0
+
+    config = get_config()
+    if batch_size is None:
+        batch_size = config.get('bulk_batch_size', 500)
+    if using is None:
+        using = capture_alias(config)
+
+    queries, findings, violations = [], [], []
+    for event in events:
+        event = dict(event)
+        kind = event.pop('kind', 'query')
+        if kind == 'n_plus_one':
+            findings.append(event)
+        elif kind == 'budget':
+            violations.append(BudgetViolation(**event))
+        else:
+            queries.append(event)
+    events = queries
+    if events:
+        from query_optimizer.releases import current_release
+        release = current_release()
+        for event in events:
+            event.setdefault('release', release)
+
+    if violations:
+        BudgetViolation.objects.using(using).bulk_create(violations, batch_size=batch_size)
+
+    if events and config.get('track_patterns', True):
+        previous = update_patterns(fingerprint_events(events), using)
+        if config.get('store_raw_queries', 'all') == 'outliers':
+            events = select_outliers(events, previous)
+
+    stacks = {}
+    for event in events + findings:
+        frames = event.pop('stack_frames', None)
+        if frames:
+            event['stack_hash'] = stack_hash(frames)
+            stacks[event['stack_hash']] = frames
+
+    stack_ids = interner.intern(stacks, using) if stacks else {}
+    if findings:
+        record_findings(findings, stack_ids, using)
+
+    for event in events:
+        if 'stack_hash' in event:
+            event['stack_id'] = stack_ids.get(event.pop('stack_hash'))
+
+    records = [QueryRecord(**event) for event in events]
+    QueryRecord.objects.using(using).bulk_create(records, batch_size=batch_size)
+
+    if records and config.get('track_rollups', True):
+        from query_optimizer.stats import rollup_events, update_rollups
+        update_rollups(rollup_events(events), using)
+    return len(records) + len(findings) + len(violations)
+
+
+_capture_executor = None
+_capture_executor_lock = threading.Lock()
+
+
+def get_capture_executor():
+    """Single thread that writes captures with its own, persistent database connection"""
+    global _capture_executor
+    if _capture_executor is None:
+        with _capture_executor_lock:
+            if _capture_executor is None:
+                _capture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-optimizer-capture')
+    return _capture_executor
+
+
+def _persist_in_capture_thread(events):
+    try:
+        return persist_events(events)
+    except Exception:
+        # Drop a broken connection so the next batch reconnects
+        close_old_connections()
+        raise
+
+
+def persist_isolated(events):
+    """
+    Persist events outside any transaction of the calling thread.
+
+    With `capture_isolation` set to "auto", events are handed to the capture
+    thread when the capture database's connection of this thread is inside
+    an atomic block, such as a view under ATOMIC_REQUESTS: they are then
+    neither slowed down by nor rolled back with the request's transaction.
+    SQLite only allows one writer, so "auto" writes there in place.
+    "always" uses the capture thread for every write, "off" never does.
+    """
+    config = get_config()
+    isolation = config.get('capture_isolation', 'auto')
+    connection = connections[capture_alias(config)]
+    # A second SQLite writer would wait for the lock of the open transaction
+    if isolation == 'always' or (isolation == 'auto' and connection.in_atomic_block and connection.vendor != 'sqlite'):
+        return get_capture_executor().submit(_persist_in_capture_thread, events).result()
+    return persist_events(events)
+
+
+class QueryEventBuffer:
+    """
+    Process-wide buffer of capture events.
+
+    Events are flushed with bulk_create once `max_size` events are waiting or
+    the oldest one is older than `max_age` seconds. A timer thread flushes an
+    aged batch when no new event comes to do it, such as on a process that
+    went idle. The buffer never holds
+    more than `max_queue` events: anything beyond that is dropped and counted
+    so that a slow database cannot make the application run out of memory.
+    """
+
+    def __init__(self, max_size=500, max_age=5.0, max_queue=10000):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.flushed = 0
+        self._events = deque()
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, events):
+        """Add events to the buffer and flush it if it is due"""
+        with self._lock:
+            free = self.max_queue - len(self._events)
+            if len(events) > free:
+                self.dropped += len(events) - max(free, 0)
+                events = events[:max(free, 0)]
+
+            if events:
+                self._events.extend(events)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+
+            due = self._is_due()
+            if not due and self._events:
+                self._schedule()
+
+        if due:
+            self.flush()
+
+    def _schedule(self):
+        """Start the timer flushing the buffer `max_age` seconds from now, unless it is already waiting"""
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(self.max_age, self._flush_in_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_in_timer(self):
+        with self._lock:
+            # Events put during the flush schedule a new timer
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            # The timer thread's connection is not closed by the request_finished signal
+            close_old_connections()
+
+    def _is_due(self):
+        if not self._events:
+            return False
+        if len(self._events) >= self.max_size:
+            return True
+        return time.monotonic() - self._oldest >= self.max_age
+
+    def flush(self):
+        """Persist every buffered event"""
+        with self._lock:
+            batch = list(self._events)
+            self._events.clear()
+            self._oldest = None
+
+        if not batch:
+            return 0
+
+        try:
+            persist_isolated(batch)
+        except Exception as e:
+            with self._lock:
+                self.dropped += len(batch)
+            logger.error(f"Failed to flush {len(batch)} captured queries: {str(e)}", exc_info=True)
+            return 0
+
+        with self._lock:
+            self.flushed += len(batch)
+        return len(batch)
+
+    def stats(self):
+        return {
+            'depth': len(self._events),
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+        }
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Return the process-wide event buffer, creating it from the config on first use"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                config = get_config()
+                _buffer = QueryEventBuffer(
+                    max_size=config.get('buffer_max_size', 500),
+                    max_age=config.get('buffer_max_age', 5.0),
+                    max_queue=config.get('buffer_max_queue', 10000),
+                )
+                atexit.register(_buffer.flush)
+    return _buffer
+
+
+def dispatch_events(events):
+    """Hand captured events to the configured persistence backend"""
+    if not events:
+        return
+
+    persistence = get_config().get('persistence', 'request')
+    if persistence == 'buffered':
+        get_buffer().put(events)
+    elif persistence in QUEUED_PERSISTENCE_MODES:
+        from query_optimizer.writer import get_writer
+        get_writer().put(events)
+    else:
+        persist_isolated(events)
+
+
+class RequestSink:
+    """Collects the capture events of a single request and writes them in one go"""
+
+    def __init__(self):
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, **fields):
+        self.events.append(fields)
+
+    def flush(self):
+        events, self.events = self.events, []
+        try:
+            dispatch_events(events)
+        except Exception as e:
+            logger.error(f"Failed to persist {len(events)} captured queries: {str(e)}", exc_info=True)
+
+    async def aflush(self):
+        """
+        Flush from async code without blocking the event loop.
+
+        Queued modes only put the events on the writer's queue and are
+        flushed in place; the others write to the database from a worker
+        thread.
+        """
+        if get_config().get('persistence', 'request') in QUEUED_PERSISTENCE_MODES:
+            self.flush()
+        else:
+            await sync_to_async(self._flush_in_thread, thread_sensitive=False)()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # Worker threads outlive the request, so their connections are
+            # not closed by the request_finished signal
+            close_old_connections()
@@ -0,0 +1,76 @@
+import math
+
+
+class DurationSketch:
+    """
+    Mergeable quantile sketch for query durations.
+
+    Values are counted in logarithmically spaced buckets, so every quantile
+    is returned within `relative_accuracy` of the true value while the sketch
+    stays a few hundred buckets at most. Two sketches built with the same
+    accuracy merge by adding their bucket counts, which is what lets
+    per-request deltas be folded into stored aggregates.
+    """
+
+    def __init__(self, relative_accuracy=0.02, min_value=1e-6):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+
+    def add(self, value, weight=1.0):
+        if value <= self.min_value:
+            self.zero_count += weight
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.count += weight
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with a different relative accuracy")
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Return the value at quantile `q` (0 <= q <= 1), or 0.0 for an empty sketch"""
+        if self.count <= 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = self.zero_count
+        if seen >= rank and self.zero_count:
+            return 0.0
+
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen >= rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def buckets(self):
+        """(upper bound, weight) pairs in increasing order, zero bucket first"""
+        pairs = [(self.min_value, self.zero_count)] if self.zero_count else []
+        pairs.extend((self.gamma ** key, self.bins[key]) for key in sorted(self.bins))
+        return pairs
+
+    def to_dict(self):
+        return {
+            'accuracy': self.relative_accuracy,
+            'zero': self.zero_count,
+            'bins': {str(key): weight for key, weight in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(relative_accuracy=data.get('accuracy', 0.02)) if data else cls()
+        if data:
+            sketch.bins = {int(key): weight for key, weight in data.get('bins', {}).items()}
+            sketch.zero_count = data.get('zero', 0.0)
+            sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import linecache
+import os
+import site
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+
+import django
+
+
+def _excluded_prefixes():
+    """Directories whose frames are never interesting in a query stack"""
+    paths = {
+        os.path.dirname(django.__file__),
+        os.path.dirname(os.path.abspath(__file__)),
+        sysconfig.get_paths()['stdlib'],
+        sysconfig.get_paths()['purelib'],
+        sysconfig.get_paths()['platlib'],
+    }
+    try:
+        paths.update(site.getsitepackages())
+    except AttributeError:
+        # virtualenv's old site module has no getsitepackages()
+        pass
+    paths.add(site.getusersitepackages())
+    return tuple(os.path.join(os.path.realpath(path), '') for path in paths if path)
+
+
+EXCLUDED_PREFIXES = _excluded_prefixes()
+
+
+@lru_cache(maxsize=4096)
+def is_application_file(filename):
+    """Return False for files from Django, site-packages, the stdlib and query_optimizer"""
+    if filename.startswith('<'):
+        return False
+    return not os.path.realpath(filename).startswith(EXCLUDED_PREFIXES)
+
+
+def capture_frames():
+    """
+    Return the application frames of the current stack, innermost first.
+
+    Each frame is a (filename, lineno, function name) tuple. Nothing is
+    formatted and no source line is read here, so this is cheap enough to
+    run while a query executes.
+    """
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if is_application_file(code.co_filename):
+            frames.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return frames
+
+
+def call_site():
+    """Return the innermost application frame as a (filename, lineno, name) tuple, or None"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if is_application_file(code.co_filename):
+            return (code.co_filename, frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def format_call_site(site):
+    if site is None:
+        return ''
+    filename, lineno, name = site
+    return f"{filename}:{lineno} in {name}"
+
+
+def stack_hash(frames):
+    """Stable hash identifying a captured stack"""
+    key = '\n'.join(f"{filename}:{lineno}:{name}" for filename, lineno, name in frames)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def format_frames(frames):
+    """Format captured frames like traceback.format_stack(), outermost first"""
+    summary = traceback.StackSummary.from_list([
+        (filename, lineno, name, linecache.getline(filename, lineno).strip())
+        for filename, lineno, name in reversed(frames)
+    ])
+    return ''.join(summary.format())
+
+
+class StackInterner:
+    """
+    Maps captured stacks to StackTrace rows, creating the missing ones.
+
+    Identical stacks are stored once: every QueryRecord only references the
+    StackTrace by id. Ids that are already known are kept in a bounded LRU
+    cache so that a hot stack costs no query at all.
+
+    The retention pruner deletes stacks no query references anymore, from
+    any process. Cached ids are looked up again once they were last read
+    from the database more than `max_age` seconds ago, so an id is never
+    trusted longer than that, and the pruner forgets the stacks it deletes
+    in its own process right away.
+    """
+
+    def __init__(self, max_size=2048, max_age=300.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        # (using, hash): (id, time it was read from the database)
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, using, hashes):
+        found = {}
+        oldest = time.monotonic() - self.max_age
+        with self._lock:
+            for value in hashes:
+                key = (using, value)
+                if key in self._ids and self._ids[key][1] >= oldest:
+                    self._ids.move_to_end(key)
+                    found[value] = self._ids[key][0]
+        return found
+
+    def _remember(self, using, ids):
+        now = time.monotonic()
+        with self._lock:
+            for value, pk in ids.items():
+                self._ids[(using, value)] = (pk, now)
+                self._ids.move_to_end((using, value))
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def intern(self, stacks, using):
+        """Return {hash: StackTrace id} for `stacks`, a {hash: frames} dict"""
+        from query_optimizer.models import StackTrace
+
+        ids = self._cached(using, stacks)
+        missing = [value for value in stacks if value not in ids]
+        if not missing:
+            return ids
+
+        found = dict(
+            StackTrace.objects.using(using)
+            .filter(hash__in=missing)
+            .values_list('hash', 'id')
+        )
+        new = [
+            StackTrace(hash=value, trace=format_frames(stacks[value]))
+            for value in missing if value not in found
+        ]
+        if new:
+            StackTrace.objects.using(using).bulk_create(new, ignore_conflicts=True)
+            found.update(
+                StackTrace.objects.using(using)
+                .filter(hash__in=[stack.hash for stack in new])
+                .values_list('hash', 'id')
+            )
+
+        self._remember(using, found)
+        ids.update(found)
+        return ids
+
+    def forget(self, using, hashes):
+        """Drop the cached ids of deleted stacks"""
+        with self._lock:
+            for value in hashes:
+                self._ids.pop((using, value), None)
+
+
+interner = StackInterner()
@@ -0,0 +1,177 @@
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Greatest, TruncHour
+from query_optimizer.models import QueryRecord, QueryRollup
+from query_optimizer.sinks import capture_alias, get_config
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATS_KEYS = ['total', 'estimated_total', 'slow', 'analyzed']
+# Lookup of each `view_name_search` mode: "prefix" uses the view_name pattern index,
+# "contains" the trigram index on PostgreSQL (as ILIKE, see lookups.TrigramContains) and a full scan elsewhere
+VIEW_NAME_SEARCHES = {'exact': 'exact', 'prefix': 'startswith', 'contains': 'trigram_contains'}
+
+
+def hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_events(events):
+    """
+    Group capture events by hour and view.
+
+    Returns {(bucket, view_name): {field: increment}} for update_rollups().
+    """
+    deltas = {}
+    for event in events:
+        key = (hour(event['timestamp']), event.get('view_name') or '')
+        delta = deltas.get(key)
+        if delta is None:
+            delta = deltas[key] = {'count': 0, 'slow_count': 0, 'estimated_count': 0.0, 'total_duration': 0.0}
+        delta['count'] += 1
+        delta['slow_count'] += 1 if event.get('is_slow') else 0
+        delta['estimated_count'] += event.get('sample_weight', 1.0)
+        delta['total_duration'] += event['duration']
+    return deltas
+
+
+def increment_row(queryset, lookup, delta, maxima=()):
+    """
+    Add the values of `delta` to the row of `queryset` matching `lookup`, creating it when missing.
+
+    Fields listed in `maxima` keep the largest value instead of a sum.
+    """
+    values = {
+        field: Greatest(F(field), Value(value)) if field in maxima else F(field) + value
+        for field, value in delta.items()
+    }
+    if queryset.filter(**lookup).update(**values):
+        return
+    try:
+        with transaction.atomic(using=queryset.db):
+            queryset.create(**lookup, **delta)
+    except IntegrityError:
+        # Another writer created the row first
+        queryset.filter(**lookup).update(**values)
+
+
+def update_rollups(deltas, using=None):
+    """Add the increments of `deltas` to the QueryRollup rows, creating the missing ones"""
+    rollups = QueryRollup.objects.using(using or capture_alias())
+    for (bucket, view_name), delta in deltas.items():
+        increment_row(rollups, {'bucket': bucket, 'view_name': view_name}, delta)
+
+
+def record_analyzed(query_record):
+    """Count a new analysis in the rollup of its query"""
+    key = (hour(query_record.timestamp), query_record.view_name or '')
+    update_rollups({key: {'analyzed_count': 1}}, query_record._state.db)
+
+
+def rollup_deltas(queryset):
+    """Counts of the QueryRecords of `queryset` by hour and view, as {(bucket, view_name): {field: value}}"""
+    rows = (
+        queryset
+        .annotate(bucket=TruncHour('timestamp'))
+        .values('bucket', 'view_name')
+        .annotate(
+            count=Count('id'),
+            slow_count=Count('id', filter=Q(is_slow=True)),
+            analyzed_count=Count('analysis'),
+            estimated_count=Sum('sample_weight'),
+            total_duration=Sum('duration'),
+        )
+        .order_by()
+    )
+    deltas = {}
+    for row in rows:
+        # Rows without a view name and with an empty one share a rollup
+        delta = deltas.setdefault((row['bucket'], row['view_name'] or ''), {
+            'count': 0, 'slow_count': 0, 'analyzed_count': 0, 'estimated_count': 0.0, 'total_duration': 0.0,
+        })
+        for field in delta:
+            delta[field] += row[field] or 0
+    return deltas
+
+
+def rebuild_rollups(using=None):
+    """Recompute every QueryRollup from the stored QueryRecord rows"""
+    using = using or capture_alias()
+    deltas = rollup_deltas(QueryRecord.objects.using(using))
+
+    with transaction.atomic(using=using):
+        QueryRollup.objects.using(using).all().delete()
+        QueryRollup.objects.using(using).bulk_create(
+            [QueryRollup(bucket=bucket, view_name=view_name, **delta) for (bucket, view_name), delta in deltas.items()],
+            batch_size=500,
+        )
+    return len(deltas)
+
+
+def query_stats(queryset):
+    """Total, estimated total, slow and analyzed counts of `queryset`, in one query"""
+    stats = queryset.order_by().aggregate(
+        total=Count('id'),
+        estimated_total=Sum('sample_weight'),
+        slow=Count('id', filter=Q(is_slow=True)),
+        analyzed=Count('analysis'),
+    )
+    return {key: stats[key] or 0 for key in STATS_KEYS}
+
+
+def view_name_filter(view_name, field='view_name'):
+    """Filter kwargs matching `view_name` with the configured `view_name_search` mode"""
+    search = get_config().get('view_name_search', 'prefix')
+    if search not in VIEW_NAME_SEARCHES:
+        raise ValueError(f"Invalid view_name_search: {search}, use one of {', '.join(VIEW_NAME_SEARCHES)}")
+    return {f'{field}__{VIEW_NAME_SEARCHES[search]}': view_name}
+
+
+def rollup_stats(start=None, end=None, view_name=None):
+    """The same counts as query_stats(), summed from the rollups of [start, end) and views matching `view_name`"""
+    rollups = QueryRollup.objects.using(capture_alias())
+    if start is not None:
+        rollups = rollups.filter(bucket__gte=start)
+    if end is not None:
+        rollups = rollups.filter(bucket__lt=end)
+    if view_name:
+        rollups = rollups.filter(**view_name_filter(view_name))
+    stats = rollups.aggregate(
+        total=Sum('count'),
+        estimated_total=Sum('estimated_count'),
+        slow=Sum('slow_count'),
+        analyzed=Sum('analyzed_count'),
+    )
+    return {key: stats[key] or 0 for key in STATS_KEYS}
+
+
+def view_names():
+    """Names of the views with captured queries"""
+    return list(
+        QueryRollup.objects.using(capture_alias()).exclude(view_name='').order_by('view_name').values_list('view_name', flat=True).distinct()
+    )
+
+
+def cached_stats(name, params, compute):
+    """
+    Return compute(), cached for `stats_cache_timeout` seconds under `name` and `params`.
+
+    The dashboard tolerates counts a few seconds old, so a short timeout
+    keeps them off the database on every page load.
+    """
+    config = get_config()
+    timeout = config.get('stats_cache_timeout', 30)
+    if not timeout:
+        return compute()
+
+    cache = caches[config.get('stats_cache_backend', 'default')]
+    key = hashlib.sha1(repr(sorted(params.items())).encode('utf-8')).hexdigest()
+    cache_key = f"query_optimizer:stats:{name}:{key}"
+    value = cache.get(cache_key)
+    if value is None:
+        value = compute()
+        cache.set(cache_key, value, timeout)
+    return value
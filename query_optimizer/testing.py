@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from query_optimizer.budgets import QueryBudgetExceeded, QueryBudgets, QueryUsage, check_budget
+from query_optimizer.capture import QueryCollector, capture_queries
+from query_optimizer.sinks import get_config
+
+
+@contextmanager
+def query_budget(queries=None, duration=None, duplicates=None, using=None, name='block'):
+    """
+    Fail with QueryBudgetExceeded when the block goes over a query budget.
+
+    `queries` is the most queries the block may run, `duration` its total
+    database time in seconds and `duplicates` how many times it may repeat a
+    statement with the same parameters. Only the database aliases in `using`
+    are counted, every alias by default. The block gets a QueryUsage that is
+    filled in when it exits:
+
+        with query_budget(queries=3) as usage:
+            client.get('/books/')
+        assert usage.duplicates == 0
+
+    QueryBudgetExceeded is an AssertionError, so pytest and unittest report
+    it as a failure, with the statements that were run.
+    """
+    limits = {limit: value for limit, value in [('queries', queries), ('duration', duration), ('duplicates', duplicates)]
+              if value is not None}
+    if not limits:
+        raise ValueError("query_budget needs at least one of queries, duration or duplicates")
+
+    # Light mode keeps the statements for the failure message and nothing else
+    collector = QueryCollector(capture_stack=False, track_duplicates='duplicates' in limits)
+    collector.sampled = False
+    usage = QueryUsage()
+    with capture_queries(collector, using):
+        yield usage
+
+    usage.count, usage.duration, usage.duplicates = collector.count, collector.total_time, collector.duplicates
+    breach = check_budget(name, limits, usage)
+    if breach is not None:
+        raise QueryBudgetExceeded(breach, [sql for sql, duration, alias in collector.light])
+
+
+@contextmanager
+def configured_query_budget(path=None, view_name=None, using=None):
+    """
+    Hold the block to the budget QUERY_OPTIMIZER_CONFIG sets for `path` or
+    `view_name`, so tests and production share one set of numbers.
+    """
+    name, limits = QueryBudgets(get_config()).budget_for(path, view_name)
+    if not limits:
+        raise ValueError(f"No query budget is configured for {view_name or path}")
+    with query_budget(using=using, name=name, **limits) as usage:
+        yield usage
+
+
+class QueryBudgetTestMixin:
+    """unittest assertions for query budgets, for TestCase subclasses"""
+
+    def assertQueryBudget(self, queries=None, duration=None, duplicates=None, using=None):
+        return query_budget(queries, duration, duplicates, using)
+
+    def assertConfiguredQueryBudget(self, path=None, view_name=None, using=None):
+        return configured_query_budget(path, view_name, using)
@@ -1 +1,808 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import F
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import include, path
+from django.utils import timezone
+from query_optimizer.advisor import IndexAdvisor, IndexCandidate, QueryShape
+from query_optimizer.analysis_cache import AnalysisCache
+from query_optimizer.batches import collect_batch
+from query_optimizer.budgets import QueryBudgetExceeded, QueryBudgets, QueryUsage, check_budget, server_timing
+from query_optimizer.decorators import track_queries
+from query_optimizer.detectors import NPlusOneDetector
+from query_optimizer.fingerprint import fingerprint, normalize_sql
+from query_optimizer.jobs import BulkAnalyzer
+from query_optimizer.pagination import CursorPaginator
+from query_optimizer.regressions import Distribution, RegressionDetector, mann_whitney
+from query_optimizer.retention import Pruner
+from query_optimizer.models import (
+    AnalysisBatch, AnalysisCacheEntry, AnalysisJob, BudgetViolation, NPlusOneFinding, PatternRollup, QueryAnalysis,
+    QueryPattern, QueryRecord, QueryRegression, StackTrace,
+)
+from query_optimizer.services import CircuitBreaker, CircuitOpenError, QueryOptimizerAI, StubClient
+from query_optimizer.sinks import QueryEventBuffer, RequestSink, persist_events
+from query_optimizer.sketch import DurationSketch
+from query_optimizer.stacks import StackInterner, stack_hash
+from query_optimizer.stats import view_name_filter
+from query_optimizer.testing import QueryBudgetTestMixin, configured_query_budget, query_budget
+from datetime import timedelta
+from unittest import mock
+import gzip
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+keyset_migration = importlib.import_module('query_optimizer.migrations.0013_keyset_indexes')
+
+MIDDLEWARE = ['query_optimizer.middleware.QueryCaptureMiddleware']
+CONFIG = {'provider': 'openai', 'model': 'gpt-4o-mini', 'api_key': 'tests', 'n_plus_one_threshold': 0}
+
+
+def run_queries(count):
+    for number in range(count):
+        AnalysisJob.objects.filter(pk=number).exists()
+
+
+def queries_view(request, count):
+    run_queries(count)
+    return HttpResponse('ok')
+
+
+urlpatterns = [
+    path('queries/<int:count>/', queries_view, name='queries'),
+    path('qo/', include('query_optimizer.urls')),
+]
+
+
+def config(**options):
+    return dict(CONFIG, **options)
+
+
+def application_code(source):
+    """Compile `source` as if it came from an application module, which the stack helpers keep"""
+    namespace = {}
+    exec(compile(source, '/app/views.py', 'exec'), namespace)
+    return namespace
+
+
+class QueryBudgetTests(TestCase):
+    def test_check_budget_lists_the_exceeded_limits(self):
+        usage = QueryUsage(count=12, duration=0.05, duplicates=3)
+        breach = check_budget('default', {'queries': 10, 'duration': 0.1, 'duplicates': 0}, usage)
+        self.assertEqual(breach.exceeded, ['queries', 'duplicates'])
+        self.assertIn('12 queries (budget 10)', breach.describe())
+        self.assertIsNone(check_budget('default', {'queries': 12}, usage))
+
+    def test_view_budgets_win_over_path_prefixes_and_the_default(self):
+        budgets = QueryBudgets({
+            'query_budget': {'queries': 50},
+            'query_budgets': {'/api/': {'queries': 20}, '/api/books/': {'queries': 10}, 'book_list': {'queries': 5}},
+        })
+        self.assertEqual(budgets.budget_for('/api/books/1/', 'book_list'), ('book_list', {'queries': 5}))
+        self.assertEqual(budgets.budget_for('/api/books/1/', 'book_detail'), ('/api/books/', {'queries': 10}))
+        self.assertEqual(budgets.budget_for('/api/authors/'), ('/api/', {'queries': 20}))
+        self.assertEqual(budgets.budget_for('/home/'), ('default', {'queries': 50}))
+        self.assertEqual(QueryBudgets({}).budget_for('/home/'), (None, {}))
+
+    def test_invalid_budgets_are_rejected(self):
+        with self.assertRaises(ValueError):
+            QueryBudgets({'query_budget': {'queries': 1}, 'budget_action': 'fail'})
+        with self.assertRaises(ValueError):
+            QueryBudgets({'query_budget': {'rows': 1}})
+
+    def test_server_timing_reports_duplicates(self):
+        self.assertEqual(server_timing(QueryUsage(3, 0.0125)), 'db;dur=12.50;desc="3 queries"')
+        self.assertIn('db-duplicates;desc="2 duplicate queries"', server_timing(QueryUsage(3, 0.0125, 2)))
+
+
+class QueryBudgetHelperTests(QueryBudgetTestMixin, TestCase):
+    def test_usage_is_filled_in_on_exit(self):
+        with query_budget(queries=5, duplicates=1) as usage:
+            run_queries(3)
+            AnalysisJob.objects.filter(pk=0).exists()
+        self.assertEqual(usage.count, 4)
+        self.assertEqual(usage.duplicates, 1)
+
+    def test_breach_lists_the_statements(self):
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with query_budget(queries=2):
+                run_queries(3)
+        message = str(context.exception)
+        self.assertIn('Query budget block exceeded: 3 queries (budget 2)', message)
+        self.assertIn('3. SELECT', message)
+
+    def test_a_budget_needs_a_limit(self):
+        with self.assertRaises(ValueError):
+            with query_budget():
+                pass
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(query_budgets={'/api/': {'queries': 1}}))
+    def test_configured_budget(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with configured_query_budget(path='/api/books/'):
+                run_queries(2)
+        with self.assertRaises(ValueError):
+            with configured_query_budget(path='/home/'):
+                pass
+
+    def test_mixin_assertions(self):
+        with self.assertQueryBudget(queries=1):
+            run_queries(1)
+        with self.assertRaises(QueryBudgetExceeded):
+            with self.assertQueryBudget(queries=0):
+                run_queries(1)
+
+
+@override_settings(ROOT_URLCONF=__name__, MIDDLEWARE=MIDDLEWARE)
+class MiddlewareBudgetTests(TestCase):
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(query_budget={'queries': 2}, budget_action='record'))
+    def test_record_action_stores_a_violation(self):
+        response = self.client.get('/queries/3/')
+        self.assertEqual(response.status_code, 200)
+        violation = BudgetViolation.objects.get()
+        self.assertEqual((violation.budget, violation.view_name, violation.query_count), ('default', 'queries_view', 3))
+        self.assertEqual(violation.exceeded, ['queries'])
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(query_budget={'queries': 2}, budget_action='log'))
+    def test_log_action_stores_nothing(self):
+        self.assertEqual(self.client.get('/queries/3/').status_code, 200)
+        self.assertFalse(BudgetViolation.objects.exists())
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(query_budgets={'/queries/': {'queries': 2}}, budget_action='raise'))
+    def test_raise_action_fails_the_request(self):
+        self.assertEqual(self.client.get('/queries/2/').status_code, 200)
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/queries/3/')
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(server_timing=True))
+    def test_server_timing_header(self):
+        response = self.client.get('/queries/2/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=\d+\.\d\d;desc="2 queries"$')
+
+
+@override_settings(ROOT_URLCONF=__name__, MIDDLEWARE=MIDDLEWARE)
+class RequestSamplingTests(TestCase):
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(sample_rate=0.0))
+    def test_unsampled_request_only_counts_its_queries(self):
+        collector = self.client.get('/queries/5/').wsgi_request._query_collector
+        self.assertEqual((collector.count, collector.keep_light, collector.light), (5, False, []))
+        self.assertFalse(QueryRecord.objects.exists())
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(sample_rate=0.0, always_capture={'queries': 3}))
+    def test_unsampled_request_over_budget_is_promoted(self):
+        self.client.get('/queries/2/')
+        self.assertFalse(QueryRecord.objects.exists())
+        self.client.get('/queries/5/')
+        self.assertEqual(list(QueryRecord.objects.values_list('sample_weight', flat=True)), [1.0] * 5)
+
+
+class DecoratorBudgetTests(TestCase):
+    def get(self, view, count):
+        return view(RequestFactory().get(f'/queries/{count}/'), count)
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(budget_action='raise'))
+    def test_raise_action(self):
+        view = track_queries(budget={'queries': 2})(queries_view)
+        self.assertEqual(self.get(view, 2).status_code, 200)
+        with self.assertRaises(QueryBudgetExceeded):
+            self.get(view, 3)
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(budget_action='record'))
+    def test_record_action(self):
+        view = track_queries(budget={'queries': 2})(queries_view)
+        self.get(view, 4)
+        self.assertEqual(BudgetViolation.objects.get().query_count, 4)
+
+
+def query_event(number, **fields):
+    return {
+        'query': f"SELECT * FROM book WHERE id = {number}", 'duration': 0.01, 'is_slow': False, 'timestamp': timezone.now(),
+        **fields,
+    }
+
+
+class RequestSinkTests(TestCase):
+    def test_flush_persists_every_event(self):
+        sink = RequestSink()
+        for number in range(3):
+            sink.add(**query_event(number, view_name='books'))
+        sink.add(kind='budget', view_name='books', budget='default', query_count=3, limits={'queries': 2}, exceeded=['queries'])
+        sink.flush()
+        self.assertEqual(len(sink), 0)
+        self.assertEqual(QueryRecord.objects.filter(view_name='books').count(), 3)
+        self.assertEqual(BudgetViolation.objects.get().query_count, 3)
+
+    def test_flush_errors_are_logged(self):
+        sink = RequestSink()
+        sink.add(**query_event(1))
+        with mock.patch('query_optimizer.sinks.persist_isolated', side_effect=DatabaseError("gone")):
+            sink.flush()
+        self.assertEqual(len(sink), 0)
+        self.assertFalse(QueryRecord.objects.exists())
+
+
+class QueryEventBufferTests(TestCase):
+    def test_flushes_at_max_size(self):
+        buffer = QueryEventBuffer(max_size=3, max_age=60)
+        buffer.put([query_event(1), query_event(2)])
+        self.assertEqual((len(buffer), QueryRecord.objects.count()), (2, 0))
+        buffer.put([query_event(3)])
+        self.assertEqual((len(buffer), QueryRecord.objects.count()), (0, 3))
+        self.assertEqual(buffer.stats(), {'depth': 0, 'dropped': 0, 'flushed': 3})
+
+    def test_flushes_at_max_age(self):
+        buffer = QueryEventBuffer(max_size=100, max_age=0)
+        buffer.put([query_event(1)])
+        self.assertEqual((len(buffer), QueryRecord.objects.count()), (0, 1))
+
+    def test_idle_buffer_is_flushed_by_its_timer(self):
+        flushed = threading.Event()
+        buffer = QueryEventBuffer(max_size=100, max_age=0.05)
+        with mock.patch('query_optimizer.sinks.persist_isolated', side_effect=lambda batch: flushed.set()) as persist:
+            buffer.put([query_event(1)])
+            self.assertEqual(len(buffer), 1)
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(len(persist.call_args.args[0]), 1)
+        self.assertEqual(len(buffer), 0)
+
+    def test_drops_events_beyond_max_queue(self):
+        buffer = QueryEventBuffer(max_size=100, max_age=60, max_queue=2)
+        buffer.put([query_event(number) for number in range(5)])
+        self.assertEqual(buffer.stats(), {'depth': 2, 'dropped': 3, 'flushed': 0})
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(QueryRecord.objects.count(), 2)
+
+    def test_failed_flush_counts_the_batch_as_dropped(self):
+        buffer = QueryEventBuffer(max_size=100, max_age=60)
+        buffer.put([query_event(1), query_event(2)])
+        with mock.patch('query_optimizer.sinks.persist_isolated', side_effect=DatabaseError("gone")):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.stats(), {'depth': 0, 'dropped': 2, 'flushed': 0})
+
+
+class NormalizeSqlTests(SimpleTestCase):
+    def test_literals_and_placeholders_become_markers(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM book WHERE id = 5 AND title = 'It''s' AND price > -1.5e3 AND author_id = %s"),
+            "SELECT * FROM book WHERE id = ? AND title = ? AND price > ? AND author_id = ?",
+        )
+
+    def test_identifiers_with_digits_are_kept(self):
+        self.assertEqual(normalize_sql('SELECT "t1"."col2" FROM t1'), 'SELECT "t1"."col2" FROM t1')
+
+    def test_lists_collapse(self):
+        self.assertEqual(normalize_sql("SELECT * FROM book WHERE id IN (1, 2, 3)"), "SELECT * FROM book WHERE id IN (...)")
+        self.assertEqual(normalize_sql("INSERT INTO book (id, title) VALUES (1, 'a'), (2, 'b')"), "INSERT INTO book (id, title) VALUES (...)")
+
+    def test_comments_and_whitespace_are_dropped(self):
+        self.assertEqual(normalize_sql("SELECT  *\n  FROM book /* list */ -- trailing"), "SELECT * FROM book")
+
+    def test_executions_of_a_shape_share_a_fingerprint(self):
+        shapes = {
+            fingerprint("SELECT * FROM book WHERE id IN (1, 2)"),
+            fingerprint("SELECT * FROM book WHERE id IN (%s, %s, %s)"),
+            fingerprint("SELECT * FROM book  WHERE id IN ($1)"),
+        }
+        self.assertEqual(len(shapes), 1)
+        self.assertNotEqual(fingerprint("SELECT * FROM author WHERE id IN (1)"), shapes.pop())
+        self.assertEqual(fingerprint(normalize_sql("SELECT 1"), normalized=True), fingerprint("SELECT 1"))
+
+
+class DurationSketchTests(SimpleTestCase):
+    def sketch(self, values):
+        sketch = DurationSketch()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def test_quantiles_within_relative_accuracy(self):
+        values = [number / 1000 for number in range(1, 1001)]
+        sketch = self.sketch(values)
+        for q in (0.5, 0.9, 0.99):
+            with self.subTest(q=q):
+                expected = values[int(q * len(values)) - 1]
+                self.assertLessEqual(abs(sketch.quantile(q) - expected), expected * sketch.relative_accuracy)
+
+    def test_empty_and_zero_durations(self):
+        self.assertEqual(DurationSketch().quantile(0.5), 0.0)
+        sketch = self.sketch([0.0, 0.0, 0.0, 1.0])
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertAlmostEqual(sketch.quantile(1.0), 1.0, places=1)
+
+    def test_weights_count_as_repeated_values(self):
+        sketch = DurationSketch()
+        sketch.add(0.001, weight=9)
+        sketch.add(1.0)
+        self.assertEqual(sketch.count, 10)
+        self.assertAlmostEqual(sketch.quantile(0.9), 0.001, delta=0.00002)
+
+    def test_merge_matches_a_single_sketch(self):
+        first = self.sketch([number / 100 for number in range(1, 50)])
+        second = self.sketch([number / 100 for number in range(50, 101)])
+        first.merge(second)
+        whole = self.sketch([number / 100 for number in range(1, 101)])
+        self.assertEqual((first.bins, first.count), (whole.bins, whole.count))
+        self.assertEqual(first.quantile(0.95), whole.quantile(0.95))
+
+    def test_merge_refuses_another_accuracy(self):
+        with self.assertRaises(ValueError):
+            DurationSketch().merge(DurationSketch(relative_accuracy=0.01))
+
+    def test_round_trip(self):
+        sketch = self.sketch([0.0, 0.01, 0.2, 0.2])
+        restored = DurationSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        self.assertEqual((restored.bins, restored.zero_count, restored.count), (sketch.bins, 1, 4))
+
+
+class NPlusOneDetectorTests(TestCase):
+    def setUp(self):
+        self.app = application_code(
+            "def run(detector, sql, count):\n"
+            "    for _ in range(count):\n"
+            "        detector.add(sql, 0.001)\n"
+        )
+
+    def test_statements_below_the_threshold_are_not_reported(self):
+        detector = NPlusOneDetector(threshold=5)
+        self.app['run'](detector, 'SELECT * FROM book WHERE author_id = %s', 4)
+        self.assertEqual(detector.findings(), [])
+        # The stack is never walked for them
+        self.assertEqual(detector.groups['SELECT * FROM book WHERE author_id = %s'][2:], [None, None])
+
+    def test_finding_at_the_threshold(self):
+        detector = NPlusOneDetector(threshold=5)
+        self.app['run'](detector, 'SELECT * FROM book WHERE author_id = %s', 7)
+        self.app['run'](detector, 'SELECT * FROM author', 1)
+        [finding] = detector.findings()
+        self.assertEqual(finding['repeats'], 7)
+        self.assertAlmostEqual(finding['total_duration'], 0.007)
+        self.assertEqual(finding['call_site'], '/app/views.py:3 in run')
+        self.assertEqual(finding['stack_frames'][0], ('/app/views.py', 3, 'run'))
+        self.assertIn('author_id = ?', finding['normalized_query'])
+
+    def test_no_frames_without_capture_stack(self):
+        detector = NPlusOneDetector(threshold=2, capture_stack=False)
+        self.app['run'](detector, 'SELECT 1', 3)
+        [finding] = detector.findings()
+        self.assertEqual(finding['call_site'], '/app/views.py:3 in run')
+        self.assertIsNone(finding['stack_frames'])
+
+    @override_settings(ROOT_URLCONF=__name__, MIDDLEWARE=MIDDLEWARE, QUERY_OPTIMIZER_CONFIG=config(n_plus_one_threshold=5))
+    def test_middleware_records_findings(self):
+        self.client.get('/queries/4/')
+        self.assertFalse(NPlusOneFinding.objects.exists())
+        self.client.get('/queries/6/')
+        finding = NPlusOneFinding.objects.get()
+        self.assertEqual((finding.view_name, finding.max_repeats, finding.occurrences), ('queries_view', 6, 1))
+
+
+class FakeOptimizer:
+    """Stands in for QueryOptimizerAI in analysis jobs, without a provider"""
+    provider = 'openai'
+    model = 'fake'
+
+    def __init__(self, on_prepare=None):
+        self.on_prepare = on_prepare
+
+    def prepare(self, query_record):
+        if self.on_prepare is not None:
+            self.on_prepare()
+
+    def analyze_query(self, query_record, raise_errors=False):
+        return {'optimization_suggestions': f"Index {query_record.id}"}
+
+
+@override_settings(QUERY_OPTIMIZER_CONFIG=config(analysis_cache=False))
+class BulkAnalyzerTests(TestCase):
+    def setUp(self):
+        QueryRecord.objects.bulk_create([
+            QueryRecord(query=f"SELECT * FROM book WHERE id = {number}", duration=1.0, is_slow=True)
+            for number in range(3)
+        ])
+        self.job = AnalysisJob.objects.create(concurrency=1)
+
+    def test_job_completes(self):
+        job = BulkAnalyzer(self.job, FakeOptimizer()).run()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.succeeded, job.processed), (AnalysisJob.STATUS_COMPLETED, 3, 3))
+        self.assertEqual(QueryAnalysis.objects.count(), 3)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_cancellation_during_the_last_chunk_is_kept(self):
+        def cancel():
+            AnalysisJob.objects.filter(pk=self.job.pk).update(status=AnalysisJob.STATUS_CANCELLED)
+
+        job = BulkAnalyzer(self.job, FakeOptimizer(on_prepare=cancel)).run()
+        self.assertEqual(job.status, AnalysisJob.STATUS_CANCELLED)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_CANCELLED)
+        self.assertEqual(job.processed, 3)
+
+    def test_cancellation_before_start_is_kept(self):
+        AnalysisJob.objects.filter(pk=self.job.pk).update(status=AnalysisJob.STATUS_CANCELLED)
+        job = BulkAnalyzer(self.job, FakeOptimizer()).run()
+        self.assertEqual(job.status, AnalysisJob.STATUS_CANCELLED)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.started_at), (AnalysisJob.STATUS_CANCELLED, 0, None))
+        self.assertFalse(QueryAnalysis.objects.exists())
+
+
+@override_settings(QUERY_OPTIMIZER_CONFIG=config(database='capture'))
+class CaptureDatabaseTests(TestCase):
+    """The `database` alias is used without QueryOptimizerRouter in DATABASE_ROUTERS"""
+    databases = {'default', 'capture'}
+
+    def setUp(self):
+        cache.clear()
+        QueryRecord.objects.using('capture').bulk_create([
+            QueryRecord(query=f"SELECT * FROM book WHERE id = {number}", duration=1.0, is_slow=True)
+            for number in range(3)
+        ])
+        self.job = AnalysisJob.objects.using('capture').create(concurrency=1)
+
+    def test_job_reads_and_writes_the_capture_database(self):
+        job = BulkAnalyzer(self.job, FakeOptimizer()).run()
+        self.assertEqual((job.status, job.succeeded), (AnalysisJob.STATUS_COMPLETED, 3))
+        self.assertEqual(AnalysisJob.objects.using('capture').get().status, AnalysisJob.STATUS_COMPLETED)
+        self.assertEqual(QueryAnalysis.objects.using('capture').count(), 3)
+        self.assertEqual(AnalysisCacheEntry.objects.using('capture').count(), 1)
+        for model in (AnalysisJob, QueryAnalysis, AnalysisCacheEntry):
+            self.assertFalse(model.objects.using('default').exists())
+
+    def test_analysis_cache_uses_the_capture_database(self):
+        query_record = QueryRecord.objects.using('capture').first()
+        AnalysisCache('openai', 'fake').set(query_record, {'optimization_suggestions': 'Add an index'})
+        # Read the entry back from the database rather than the front cache
+        cache.clear()
+        self.assertEqual(AnalysisCache('openai', 'fake').get(query_record), {'optimization_suggestions': 'Add an index'})
+        self.assertFalse(AnalysisCacheEntry.objects.using('default').exists())
+
+    def test_decorator_skips_the_capture_database(self):
+        @track_queries(n_plus_one_threshold=0)
+        def view(request):
+            AnalysisJob.objects.using('default').exists()
+            AnalysisJob.objects.using('capture').exists()
+            return HttpResponse()
+
+        view(RequestFactory().get('/books/'))
+        aliases = QueryRecord.objects.using('capture').filter(url_path='/books/').values_list('db_alias', flat=True)
+        self.assertEqual(list(aliases), ['default'])
+
+
+@override_settings(QUERY_OPTIMIZER_CONFIG=config(provider='stub', model='stub', local_analysis='off'))
+class StreamingBreakerTests(TestCase):
+    def setUp(self):
+        self.optimizer = QueryOptimizerAI()
+        self.optimizer.breaker = CircuitBreaker('stub', failure_threshold=1, reset_timeout=0.0)
+        self.optimizer.breaker.record_failure()
+        self.query_record = QueryRecord(query='SELECT 1', duration=1.0)
+
+    def test_abandoned_stream_releases_the_trial(self):
+        stream = self.optimizer.analyze_query_stream(self.query_record)
+        next(stream)
+        self.assertTrue(self.optimizer.breaker.trial_running)
+        # What StreamingHttpResponse does when the client disconnects
+        stream.close()
+        self.assertFalse(self.optimizer.breaker.trial_running)
+        self.assertEqual(self.optimizer.breaker.state, 'half-open')
+        self.optimizer.breaker.before_call()
+
+    def test_finished_stream_closes_the_circuit(self):
+        text = ''.join(self.optimizer.analyze_query_stream(self.query_record))
+        self.assertIn('optimization_suggestions', self.optimizer.parse_response(text))
+        self.assertEqual(self.optimizer.breaker.state, 'closed')
+
+    def test_open_circuit_fails_fast(self):
+        self.optimizer.breaker.reset_timeout = 60.0
+        self.optimizer.breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            next(self.optimizer.analyze_query_stream(self.query_record))
+
+
+class CollectBatchTests(TestCase):
+    def setUp(self):
+        self.batch_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.batch_dir)
+        self.query_record = QueryRecord.objects.create(query='SELECT * FROM book', duration=2.0, is_slow=True)
+        custom_id = f"query-{self.query_record.id}"
+        batch_id = StubClient(batch_dir=self.batch_dir).submit_batch([(custom_id, 'prompt')], 'stub')
+        self.batch = AnalysisBatch.objects.create(
+            provider='stub', model='stub', batch_id=batch_id, requests={custom_id: [self.query_record.id]}, size=1,
+        )
+
+    def test_batch_is_collected_from_its_own_provider(self):
+        # The provider was changed since the batch was submitted
+        with override_settings(QUERY_OPTIMIZER_CONFIG=config(
+            provider='anthropic', local_analysis='only', stub_batch_dir=self.batch_dir,
+        )):
+            self.assertTrue(collect_batch(self.batch))
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.status, self.batch.succeeded), (AnalysisBatch.STATUS_COLLECTED, 1))
+        self.assertIn('Stub analysis from stub', QueryAnalysis.objects.get(query_record=self.query_record).analysis['analysis'])
+
+    def test_other_providers_need_a_key(self):
+        self.batch.provider = 'openai'
+        with override_settings(QUERY_OPTIMIZER_CONFIG=config(provider='anthropic', local_analysis='only')):
+            with self.assertRaises(ValueError):
+                collect_batch(self.batch)
+
+
+class ViewNameSearchTests(TestCase):
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(view_name_search='contains'))
+    def test_contains_search_matches_the_trigram_index(self):
+        queryset = QueryRecord.objects.filter(**view_name_filter('Book_'))
+        compiler = queryset.query.get_compiler('default')
+        sql, params = queryset.query.where.children[0].as_postgresql(compiler, compiler.connection)
+        # The ILIKE compares the bare column the GIN index is built on, not UPPER(view_name)
+        self.assertEqual(sql, '"query_optimizer_queryrecord"."view_name" ILIKE %s')
+        self.assertEqual(list(params), ['%Book\\_%'])
+        self.assertIn('gin (view_name gin_trgm_ops)', keyset_migration.CREATE_TRIGRAM_INDEX)
+
+    @override_settings(QUERY_OPTIMIZER_CONFIG=config(view_name_search='contains'))
+    def test_contains_search_elsewhere(self):
+        QueryRecord.objects.bulk_create([
+            QueryRecord(query="SELECT 1", duration=0.1, view_name=name) for name in ['book_list', 'BookDetail', 'author_list']
+        ])
+        names = QueryRecord.objects.filter(**view_name_filter('book')).values_list('view_name', flat=True)
+        self.assertEqual(sorted(names), ['BookDetail', 'book_list'])
+
+
+class CursorPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        names = ['books', None, 'authors', None, 'books', 'shelves', None]
+        QueryRecord.objects.bulk_create([QueryRecord(query='SELECT 1', duration=0.1, view_name=name) for name in names])
+
+    def walk(self, ordering):
+        """Ids of every page, forwards then backwards from the last page"""
+        paginator = CursorPaginator(QueryRecord.objects.all(), ordering, 2)
+        page = paginator.page()
+        forwards = [[row.id for row in page]]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            forwards.append([row.id for row in page])
+
+        backwards = [[row.id for row in page]]
+        while page.has_previous():
+            page = paginator.page(page.previous_cursor)
+            backwards.append([row.id for row in page])
+        return forwards, backwards[::-1]
+
+    def test_pages_cover_every_row_once_with_nulls(self):
+        orderings = {
+            'view_name': [F('view_name').asc(nulls_first=True), 'pk'],
+            '-view_name': [F('view_name').desc(nulls_last=True), '-pk'],
+        }
+        for ordering, expected in orderings.items():
+            with self.subTest(ordering=ordering):
+                forwards, backwards = self.walk(ordering)
+                self.assertEqual(
+                    [pk for page in forwards for pk in page],
+                    list(QueryRecord.objects.order_by(*expected).values_list('id', flat=True)),
+                )
+                self.assertEqual(backwards, forwards)
+
+    def test_invalid_cursor_is_a_404(self):
+        with self.assertRaises(Http404):
+            CursorPaginator(QueryRecord.objects.all(), '-timestamp', 2).page('not-a-cursor')
+
+
+class FailingPruner(Pruner):
+    def release(self, queryset):
+        raise DatabaseError("release failed")
+
+
+class PrunerTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        old = (timezone.now() - timedelta(days=10)).replace(minute=10)
+        QueryRecord.objects.bulk_create([
+            QueryRecord(query='SELECT 1', duration=duration, is_slow=duration > 0.5, timestamp=old + timedelta(minutes=number),
+                        fingerprint='f1', view_name='books', sample_weight=2.0)
+            for number, duration in enumerate([0.1, 0.2, 0.9])
+        ] + [QueryRecord(query='SELECT 2', duration=0.1, fingerprint='f2', view_name='books')])
+
+    def archived(self):
+        lines = []
+        for name in os.listdir(self.archive_dir):
+            with gzip.open(os.path.join(self.archive_dir, name), 'rt', encoding='utf-8') as archive:
+                lines.extend(json.loads(line) for line in archive)
+        return lines
+
+    def test_expired_queries_are_compacted_archived_and_deleted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted = Pruner(days=1, batch_size=2, archive_dir=self.archive_dir).prune()
+        self.assertEqual(deleted, 3)
+        self.assertEqual(list(QueryRecord.objects.values_list('fingerprint', flat=True)), ['f2'])
+
+        rollup = PatternRollup.objects.get()
+        self.assertEqual((rollup.fingerprint, rollup.view_name, rollup.period), ('f1', 'books', PatternRollup.PERIOD_HOUR))
+        self.assertEqual((rollup.count, rollup.slow_count, rollup.estimated_count), (3, 1, 6.0))
+        self.assertAlmostEqual(rollup.total_duration, 1.2)
+        self.assertEqual(rollup.max_duration, 0.9)
+        self.assertEqual(sorted(row['duration'] for row in self.archived()), [0.1, 0.2, 0.9])
+
+    def test_rolled_back_batch_is_not_archived(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(DatabaseError):
+                FailingPruner(days=1, archive_dir=self.archive_dir).prune()
+        self.assertEqual(QueryRecord.objects.count(), 4)
+        self.assertFalse(PatternRollup.objects.exists())
+        self.assertEqual(self.archived(), [])
+
+    def test_pruned_stack_is_captured_again(self):
+        frames = [('/app/views.py', 12, 'book_list')]
+        persist_events([query_event(1, stack_frames=frames, timestamp=timezone.now() - timedelta(days=10))])
+        StackTrace.objects.update(created_at=timezone.now() - timedelta(days=10))
+        Pruner(days=1).prune()
+        self.assertFalse(StackTrace.objects.exists())
+
+        # The id the interner cached for the stack is gone with it
+        persist_events([query_event(2, stack_frames=frames)])
+        record = QueryRecord.objects.get(query__endswith='= 2')
+        self.assertEqual(record.stack.trace, StackTrace.objects.get().trace)
+
+    def test_stacks_of_n_plus_one_findings_are_kept(self):
+        stack = StackTrace.objects.create(hash='a' * 40, trace='File "/app/views.py", line 12')
+        StackTrace.objects.filter(pk=stack.pk).update(created_at=timezone.now() - timedelta(days=10))
+        NPlusOneFinding.objects.create(fingerprint='f1', normalized_query='SELECT ?', stack=stack)
+        Pruner(days=1).prune()
+        self.assertEqual(NPlusOneFinding.objects.get().stack, stack)
+
+
+class StackInternerTests(TestCase):
+    def test_cached_ids_are_checked_again_after_max_age(self):
+        stacks = {stack_hash([('/app/views.py', 12, 'book_list')]): [('/app/views.py', 12, 'book_list')]}
+        interner = StackInterner(max_age=60)
+        first = interner.intern(stacks, 'default')
+        # Deleted by the pruner of another process
+        StackTrace.objects.all().delete()
+        self.assertEqual(interner.intern(stacks, 'default'), first)
+
+        with mock.patch('query_optimizer.stacks.time.monotonic', return_value=time.monotonic() + 61):
+            second = interner.intern(stacks, 'default')
+        self.assertNotEqual(second, first)
+        self.assertTrue(StackTrace.objects.filter(pk__in=second.values()).exists())
+
+
+class QueryShapeTests(SimpleTestCase):
+    def shape(self, sql):
+        return QueryShape(normalize_sql(sql))
+
+    def test_filters_and_sort_order(self):
+        shape = self.shape(
+            'SELECT "book"."id" FROM "book" WHERE ("book"."author_id" = 3 AND "book"."published" >= 5) '
+            'ORDER BY "book"."title" DESC'
+        )
+        self.assertEqual((shape.equality, shape.range), ({'book': ['author_id']}, {'book': ['published']}))
+        self.assertEqual((shape.order, shape.has_limit), ({'book': [('title', True)]}, False))
+        # The range filter comes last and the sort cannot use the index after it
+        self.assertEqual(shape.candidates(), [('book', (('author_id', False), ('published', False)))])
+
+    def test_sort_columns_follow_equality_filters(self):
+        shape = self.shape('SELECT "book"."id" FROM "book" WHERE "book"."author_id" = 3 ORDER BY "book"."published" DESC LIMIT 10')
+        self.assertEqual(shape.candidates(), [('book', (('author_id', False), ('published', True)))])
+
+    def test_sort_only_index_needs_a_limit(self):
+        self.assertEqual(
+            self.shape('SELECT "book"."id" FROM "book" ORDER BY "book"."published" DESC LIMIT 10').candidates(),
+            [('book', (('published', True),))],
+        )
+        self.assertEqual(self.shape('SELECT "book"."id" FROM "book" ORDER BY "book"."published" DESC').candidates(), [])
+
+    def test_aliases_and_join_keys(self):
+        shape = self.shape('SELECT b.id FROM "book" b INNER JOIN "author" a ON (b."author_id" = a."id") WHERE a."name" IN (1, 2)')
+        self.assertEqual(shape.joins, {'book': ['author_id'], 'author': ['id']})
+        self.assertEqual(shape.candidates(), [
+            ('author', (('name', False),)), ('author', (('id', False),)), ('book', (('author_id', False),)),
+        ])
+
+    def test_max_columns(self):
+        shape = self.shape('SELECT * FROM "book" WHERE "book"."a" = 1 AND "book"."b" = 2 AND "book"."c" = 3')
+        self.assertEqual(shape.candidates(max_columns=2), [('book', (('a', False), ('b', False)))])
+
+
+class IndexAdvisorTests(TestCase):
+    def test_merge_folds_prefixes_into_the_wider_candidate(self):
+        found = {}
+        for fingerprint, table, columns in [('f1', 'book', ('a',)), ('f2', 'book', ('a', 'b')), ('f3', 'book', ('b',)), ('f4', 'author', ('a',))]:
+            candidate = found[(table, columns)] = IndexCandidate(table, tuple((column, False) for column in columns))
+            candidate.serve(fingerprint, f"SELECT {fingerprint}", 1.0)
+
+        merged = {(candidate.table, tuple(candidate.column_names)): candidate for candidate in IndexAdvisor(config=CONFIG).merge(found)}
+        self.assertEqual(set(merged), {('book', ('a', 'b')), ('book', ('b',)), ('author', ('a',))})
+        self.assertEqual(list(merged[('book', ('a', 'b'))].fingerprints), ['f2', 'f1'])
+        self.assertEqual(merged[('book', ('a', 'b'))].served_time, 2.0)
+
+    def test_recommend_skips_columns_that_are_already_indexed(self):
+        QueryPattern.objects.bulk_create([
+            QueryPattern(
+                fingerprint=fingerprint(sql), normalized_query=normalize_sql(sql), sample_query=sql,
+                estimated_total_duration=duration,
+            )
+            for sql, duration in [
+                ('SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."email" = \'a@example.com\'', 3.0),
+                ('SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."username" = \'a\'', 5.0),
+            ]
+        ])
+        [candidate] = IndexAdvisor(config=CONFIG, min_rows=0).recommend()
+        self.assertEqual((candidate.table, candidate.column_names, candidate.benefit), ('auth_user', ['email'], 3.0))
+        self.assertEqual(candidate.model._meta.label, 'auth.User')
+        self.assertEqual(candidate.index.fields, ['email'])
+
+
+def distribution(durations):
+    result = Distribution('SELECT * FROM book WHERE id = ?')
+    for duration in durations:
+        result.add(duration)
+    return result
+
+
+def spread(base, count=40):
+    return [base * (1 + number / 100) for number in range(count)]
+
+
+class MannWhitneyTests(SimpleTestCase):
+    def test_slower_candidate_is_significant(self):
+        self.assertLess(mann_whitney(distribution(spread(0.01)), distribution(spread(0.02))), 0.001)
+
+    def test_same_or_faster_candidate_is_not(self):
+        self.assertAlmostEqual(mann_whitney(distribution(spread(0.01)), distribution(spread(0.01))), 0.5, places=2)
+        self.assertGreater(mann_whitney(distribution(spread(0.02)), distribution(spread(0.01))), 0.999)
+
+    def test_empty_side(self):
+        self.assertEqual(mann_whitney(distribution([]), distribution(spread(0.01))), 1.0)
+
+
+class RegressionDetectorTests(TestCase):
+    def compare(self, baseline, candidate, **options):
+        detector = RegressionDetector(config=CONFIG, **options)
+        return detector.compare({('f', 'books'): distribution(baseline)}, {('f', 'books'): distribution(candidate)})
+
+    def test_slower_shape_is_reported(self):
+        [regression] = self.compare(spread(0.01), spread(0.02))
+        self.assertEqual((regression['fingerprint'], regression['view_name'], regression['candidate_count']), ('f', 'books', 40))
+        self.assertAlmostEqual(regression['added_time'], 40 * 0.01 * 1.195, places=4)
+        self.assertLess(regression['p_value'], 0.01)
+
+    def test_min_count(self):
+        self.assertEqual(self.compare(spread(0.01, 20), spread(0.02, 20)), [])
+        self.assertEqual(len(self.compare(spread(0.01, 20), spread(0.02, 20), min_count=10)), 1)
+
+    def test_growth_below_the_threshold_is_ignored(self):
+        self.assertEqual(self.compare(spread(0.01), spread(0.011)), [])
+        self.assertEqual(len(self.compare(spread(0.01), spread(0.011), threshold=0.05)), 1)
+
+    def test_alpha(self):
+        # A shift of a few values is not significant at a strict level
+        baseline, candidate = spread(0.01, 30), spread(0.01, 27) + [0.05] * 3
+        self.assertEqual(self.compare(baseline, candidate, min_count=10, alpha=0.001), [])
+        self.assertEqual(len(self.compare(baseline, candidate, min_count=10, alpha=0.5)), 1)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            RegressionDetector(config=CONFIG, min_count=1)
+        with self.assertRaises(ValueError):
+            RegressionDetector(config=CONFIG, alpha=1)
+
+    def test_detect_windows_records_regressions(self):
+        now = timezone.now()
+        sql = "SELECT * FROM book WHERE id = 1"
+        QueryRecord.objects.bulk_create([
+            QueryRecord(query=sql, fingerprint=fingerprint(sql), view_name='books', duration=duration, timestamp=timestamp)
+            for durations, timestamp in [(spread(0.01), now - timedelta(hours=2)), (spread(0.02), now - timedelta(minutes=30))]
+            for duration in durations
+        ])
+        detector = RegressionDetector(config=CONFIG)
+        [regression] = detector.detect_windows(now - timedelta(hours=3), now - timedelta(hours=1), now - timedelta(hours=1), now)
+        self.assertEqual((regression.kind, regression.view_name), (QueryRegression.KIND_WINDOW, 'books'))
+        self.assertEqual(QueryRegression.objects.count(), 1)
+        # Running the comparison again replaces its regressions
+        detector.detect_windows(now - timedelta(hours=3), now - timedelta(hours=1), now - timedelta(hours=1), now)
+        self.assertEqual(QueryRegression.objects.count(), 1)
@@ -7,6 +7,15 @@ urlpatterns = [
     path('', views.QueryListView.as_view(), name='query_list'),
     path('query/<int:pk>/', views.QueryDetailView.as_view(), name='query_detail'),
     path('query_analyze/', views.query_analyze_view, name='query_analyze'),
+    path('query_analyze/stream/', views.query_analyze_stream_view, name='query_analyze_stream'),
     path('analysis/', views.AnalysisListView.as_view(), name='analysis_list'),
     path('analysis/<int:pk>/', views.AnalysisDetailView.as_view(), name='analysis_detail'),
+    path('patterns/', views.QueryPatternListView.as_view(), name='pattern_list'),
+    path('n-plus-one/', views.NPlusOneListView.as_view(), name='n_plus_one_list'),
+    path('regressions/', views.RegressionListView.as_view(), name='regression_list'),
+    path('jobs/', views.AnalysisJobListView.as_view(), name='job_list'),
+    path('jobs/start/', views.analysis_job_start_view, name='job_start'),
+    path('jobs/<int:pk>/', views.analysis_job_status_view, name='job_status'),
+    path('jobs/<int:pk>/cancel/', views.analysis_job_cancel_view, name='job_cancel'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,40 +1,62 @@
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.views.generic import ListView, DetailView
 from django.contrib import messages
-from .models import QueryRecord, QueryAnalysis
-from .services import QueryOptimizerAI
+from django.db.models import Sum
+from .models import QueryRecord, QueryAnalysis, QueryPattern, NPlusOneFinding, QueryRegression, AnalysisJob
+from .services import get_optimizer
+from .jobs import record_analysis, start_job
+from .metrics import CONTENT_TYPE, get_metrics
+from .analysis_cache import AnalysisCache
+from .pagination import CursorPaginationMixin
+from .sinks import capture_alias
+from .stats import cached_stats, query_stats, rollup_stats, view_name_filter, view_names
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from datetime import datetime, timedelta
+import json
+import logging
 
+logger = logging.getLogger(__name__)
 
-class QueryListView(ListView):
+STATS_FILTERS = ['date_from', 'date_to', 'slowness', 'analysis_status', 'view_name', 'min_duration', 'max_duration']
+# Filters the hourly rollups can answer without reading QueryRecord
+ROLLUP_FILTERS = {'date_from', 'date_to', 'view_name'}
+QUERY_SORTS = ['-timestamp', 'timestamp', '-duration', 'duration', 'view_name', '-view_name']
+
+
+def parse_day(value, days=0):
+    """Start of the day `value` (YYYY-MM-DD) plus `days`, in the current time zone, or None"""
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=days)
+    except (ValueError, TypeError):
+        return None
+    return timezone.make_aware(day) if settings.USE_TZ else day
+
+
+class QueryListView(CursorPaginationMixin, ListView):
     template_name = 'query_optimizer/query_list.html'
     model = QueryRecord
     paginate_by = 15
     context_object_name = 'queries'
     
     def get_queryset(self):
-        queryset = QueryRecord.objects.select_related('analysis').order_by('-timestamp')
+        queryset = QueryRecord.objects.using(capture_alias()).select_related('analysis')
         
         # Apply filters
         filters = {}
         
-        # Date range filter
-        date_from = self.request.GET.get('date_from')
-        date_to = self.request.GET.get('date_to')
+        # Date range filter, as timestamp bounds so the timestamp index is used
+        date_from = parse_day(self.request.GET.get('date_from'))
+        date_to = parse_day(self.request.GET.get('date_to'), days=1)
         
         if date_from:
-            try:
-                date_from = datetime.strptime(date_from, '%Y-%m-%d')
-                filters['timestamp__date__gte'] = date_from
-            except (ValueError, TypeError):
-                pass
+            filters['timestamp__gte'] = date_from
                 
         if date_to:
-            try:
-                date_to = datetime.strptime(date_to, '%Y-%m-%d')
-                filters['timestamp__date__lte'] = date_to
-            except (ValueError, TypeError):
-                pass
+            filters['timestamp__lt'] = date_to
         
         # Slowness filter
         slowness = self.request.GET.get('slowness')
@@ -53,7 +75,7 @@ class QueryListView(ListView):
         # View name filter
         view_name = self.request.GET.get('view_name')
         if view_name:
-            filters['view_name__icontains'] = view_name
+            filters.update(view_name_filter(view_name))
             
         # Duration range filter
         min_duration = self.request.GET.get('min_duration')
@@ -75,23 +97,36 @@ class QueryListView(ListView):
         if filters:
             queryset = queryset.filter(**filters)
             
-        # Sort by
-        sort_by = self.request.GET.get('sort_by', '-timestamp')
-        valid_sort_fields = {
-            'timestamp': 'timestamp',
-            '-timestamp': '-timestamp',
-            'duration': 'duration',
-            '-duration': '-duration',
-            'view_name': 'view_name',
-            '-view_name': '-view_name'
-        }
-        if sort_by in valid_sort_fields:
-            queryset = queryset.order_by(valid_sort_fields[sort_by])
-            
+        # Ordering is applied by the cursor paginator
         return queryset
+
+    def get_cursor_ordering(self):
+        sort_by = self.request.GET.get('sort_by', '-timestamp')
+        return sort_by if sort_by in QUERY_SORTS else '-timestamp'
+
+    def get_stats(self):
+        """
+        Counts of the filtered queries, cached for a few seconds.
+
+        Date and view filters are answered from the hourly rollups, other
+        filters with a single aggregate over the filtered queries.
+        """
+        if getattr(self, '_stats', None) is None:
+            params = {key: self.request.GET[key] for key in STATS_FILTERS if self.request.GET.get(key)}
+            if set(params) <= ROLLUP_FILTERS:
+                self._stats = cached_stats('rollups', params, lambda: rollup_stats(
+                    parse_day(params.get('date_from')),
+                    parse_day(params.get('date_to'), days=1),
+                    params.get('view_name'),
+                ))
+            else:
+                self._stats = cached_stats('queries', params, lambda: query_stats(self.object_list))
+        return self._stats
+
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        stats = self.get_stats()
         
         # Add filter values to context
         context.update({
@@ -105,13 +140,17 @@ class QueryListView(ListView):
             'sort_by': self.request.GET.get('sort_by', '-timestamp'),
             
             # Add statistics
-            'total_count': self.get_queryset().count(),
-            'slow_count': self.get_queryset().filter(is_slow=True).count(),
-            'analyzed_count': self.get_queryset().filter(analysis__isnull=False).count(),
+            'total_count': stats['total'],
+            'estimated_total': stats['estimated_total'],
+            'slow_count': stats['slow'],
+            'analyzed_count': stats['analyzed'],
+            
+            # Add the latest N+1 findings next to the slow queries
+            'n_plus_one_findings': NPlusOneFinding.objects.using(capture_alias()).order_by('-last_seen')[:5],
+            'n_plus_one_count': NPlusOneFinding.objects.using(capture_alias()).count(),
             
             # Add unique view names for filter dropdown
-            'view_names': QueryRecord.objects.values_list('view_name', flat=True)
-                .distinct().order_by('view_name'),
+            'view_names': cached_stats('view_names', {}, view_names),
                 
             # Add sort options
             'sort_options': [
@@ -132,6 +171,9 @@ class QueryDetailView(DetailView):
     model = QueryRecord
     context_object_name = 'selected_query'
 
+    def get_queryset(self):
+        return QueryRecord.objects.using(capture_alias())
+
 
 def query_analyze_view(request):
     if request.method != 'POST':
@@ -143,7 +185,7 @@ def query_analyze_view(request):
         return redirect('query_optimizer:query_list')
 
     try:
-        query_record = QueryRecord.objects.get(id=query_id)
+        query_record = QueryRecord.objects.using(capture_alias()).get(id=query_id)
     except QueryRecord.DoesNotExist:
         messages.error(request, 'Query not found.')
         return redirect('query_optimizer:query_list')
@@ -153,50 +195,106 @@ def query_analyze_view(request):
         messages.info(request, 'This query has already been analyzed.')
         return redirect('query_optimizer:query_detail', pk=query_record.id)
 
+    # Reuse the analysis of a query with the same shape
+    optimizer = get_optimizer()
+    cache = AnalysisCache(optimizer.provider, optimizer.model)
+    analysis = cache.get(query_record)
+    if analysis is not None:
+        record_analysis(query_record, analysis, cached=True)
+        messages.success(request, 'A query with the same shape was already analyzed, its analysis was reused.')
+        return redirect('query_optimizer:query_detail', pk=query_record.id)
+
     # Run analysis
-    optimizer = QueryOptimizerAI()
     analysis = optimizer.analyze_query(query_record)
     if not analysis:
         messages.error(request, 'Failed to analyze the query. Please try again later.')
         return redirect('query_optimizer:query_detail', pk=query_record.id)
 
-    QueryAnalysis.objects.create(
-        query_record=query_record,
-        analysis=analysis,
-        suggested_optimization=analysis.get('optimization_suggestions', '')
-    )
+    record_analysis(query_record, analysis)
+    cache.set(query_record, analysis)
     messages.success(request, 'Query analyzed successfully!')
     return redirect('query_optimizer:query_detail', pk=query_record.id)
 
 
-class AnalysisListView(ListView):
+def query_analyze_stream_view(request):
+    """
+    Analyze a query and stream the completion while it is generated.
+
+    The response is newline-delimited JSON: "chunk" events carry text as it
+    arrives, then a "done" event carries the URL of the query, or an "error"
+    event a message.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+
+    try:
+        query_record = QueryRecord.objects.using(capture_alias()).select_related('stack', 'analysis').get(id=int(request.POST.get('query_id', '')))
+    except (ValueError, QueryRecord.DoesNotExist):
+        return JsonResponse({'error': 'Query not found.'}, status=404)
+
+    detail_url = reverse('query_optimizer:query_detail', args=[query_record.id])
+
+    def event(kind, **data):
+        return json.dumps({'type': kind, **data}) + '\n'
+
+    def events():
+        if hasattr(query_record, 'analysis'):
+            yield event('done', url=detail_url)
+            return
+
+        optimizer = get_optimizer()
+        cache = AnalysisCache(optimizer.provider, optimizer.model)
+        analysis = cache.get(query_record)
+        if analysis is not None:
+            record_analysis(query_record, analysis, cached=True)
+            yield event('chunk', text=json.dumps(analysis, indent=2))
+            yield event('done', url=detail_url, cached=True)
+            return
+
+        parts = []
+        try:
+            for chunk in optimizer.analyze_query_stream(query_record):
+                parts.append(chunk)
+                yield event('chunk', text=chunk)
+        except Exception as e:
+            logger.info(f"AI analysis failed with {optimizer.provider}: {e}")
+            yield event('error', message='Failed to analyze the query. Please try again later.')
+            return
+
+        analysis = optimizer.parse_response(''.join(parts))
+        record_analysis(query_record, analysis)
+        cache.set(query_record, analysis)
+        yield event('done', url=detail_url)
+
+    response = StreamingHttpResponse(events(), content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class AnalysisListView(CursorPaginationMixin, ListView):
     template_name = 'query_optimizer/analysis_list.html'
     model = QueryAnalysis
     paginate_by = 10
     context_object_name = 'analysis_list'
     
     def get_queryset(self):
-        queryset = QueryAnalysis.objects.order_by('-created_at')
+        queryset = QueryAnalysis.objects.using(capture_alias())
         
         # Apply filters
-        date_from = self.request.GET.get('date_from')
-        date_to = self.request.GET.get('date_to')
+        date_from = parse_day(self.request.GET.get('date_from'))
+        date_to = parse_day(self.request.GET.get('date_to'), days=1)
         
         if date_from:
-            try:
-                date_from = datetime.strptime(date_from, '%Y-%m-%d')
-                queryset = queryset.filter(created_at__date__gte=date_from)
-            except (ValueError, TypeError):
-                pass
+            queryset = queryset.filter(created_at__gte=date_from)
                 
         if date_to:
-            try:
-                date_to = datetime.strptime(date_to, '%Y-%m-%d')
-                queryset = queryset.filter(created_at__date__lte=date_to)
-            except (ValueError, TypeError):
-                pass
+            queryset = queryset.filter(created_at__lt=date_to)
 
         return queryset
+
+    def get_cursor_ordering(self):
+        return '-created_at'
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -214,6 +312,9 @@ class AnalysisDetailView(DetailView):
     template_name = 'query_optimizer/analysis_detail.html'
     model = QueryAnalysis
     context_object_name = 'analysis'
+
+    def get_queryset(self):
+        return QueryAnalysis.objects.using(capture_alias())
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -238,3 +339,151 @@ class AnalysisDetailView(DetailView):
         context.update(query_context)
         
         return context
+
+
+class QueryPatternListView(ListView):
+    template_name = 'query_optimizer/pattern_list.html'
+    model = QueryPattern
+    paginate_by = 25
+    context_object_name = 'patterns'
+
+    def get_queryset(self):
+        return QueryPattern.objects.using(capture_alias()).defer('sketch').order_by('-estimated_total_duration')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['grand_total'] = QueryPattern.objects.using(capture_alias()).aggregate(total=Sum('estimated_total_duration'))['total'] or 0
+        return context
+
+
+class NPlusOneListView(ListView):
+    template_name = 'query_optimizer/n_plus_one_list.html'
+    model = NPlusOneFinding
+    paginate_by = 25
+    context_object_name = 'findings'
+
+    def get_queryset(self):
+        queryset = NPlusOneFinding.objects.using(capture_alias()).order_by('-last_seen')
+
+        view_name = self.request.GET.get('view_name')
+        if view_name:
+            queryset = queryset.filter(view_name=view_name)
+
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['view_name'] = self.request.GET.get('view_name', '')
+        return context
+
+
+class RegressionListView(ListView):
+    template_name = 'query_optimizer/regression_list.html'
+    model = QueryRegression
+    paginate_by = 25
+    context_object_name = 'regressions'
+
+    def get_queryset(self):
+        queryset = QueryRegression.objects.using(capture_alias()).order_by('-added_time')
+
+        candidate = self.request.GET.get('candidate')
+        if candidate:
+            queryset = queryset.filter(candidate=candidate)
+
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['candidate'] = self.request.GET.get('candidate', '')
+        return context
+
+
+class AnalysisJobListView(ListView):
+    template_name = 'query_optimizer/job_list.html'
+    model = AnalysisJob
+    paginate_by = 15
+    context_object_name = 'jobs'
+
+    def get_queryset(self):
+        return AnalysisJob.objects.using(capture_alias()).defer('failed_ids').order_by('-created_at')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['source_choices'] = AnalysisJob.SOURCE_CHOICES
+        context['has_active_jobs'] = any(job.is_active for job in context['jobs'])
+        return context
+
+
+def analysis_job_start_view(request):
+    if request.method != 'POST':
+        return redirect('query_optimizer:job_list')
+
+    source = request.POST.get('source', AnalysisJob.SOURCE_SLOW)
+    if source not in dict(AnalysisJob.SOURCE_CHOICES):
+        messages.error(request, 'Unknown query source.')
+        return redirect('query_optimizer:job_list')
+
+    try:
+        limit = int(request.POST['limit']) if request.POST.get('limit') else None
+        concurrency = int(request.POST.get('concurrency') or 4)
+    except ValueError:
+        messages.error(request, 'Limit and concurrency must be numbers.')
+        return redirect('query_optimizer:job_list')
+
+    if concurrency < 1 or (limit is not None and limit < 1):
+        messages.error(request, 'Limit and concurrency must be at least 1.')
+        return redirect('query_optimizer:job_list')
+
+    job = AnalysisJob.objects.using(capture_alias()).create(source=source, limit=limit, concurrency=concurrency)
+    start_job(job)
+    messages.success(request, f'Analysis job #{job.pk} started.')
+    return redirect('query_optimizer:job_list')
+
+
+def analysis_job_status_view(request, pk):
+    """Progress of an analysis job as JSON, for polling"""
+    job = get_object_or_404(AnalysisJob.objects.using(capture_alias()), pk=pk)
+    return JsonResponse({
+        'id': job.pk,
+        'source': job.source,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'succeeded': job.succeeded,
+        'failed': job.failed,
+        'progress': job.progress,
+        'last_error': job.last_error,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    })
+
+
+def analysis_job_cancel_view(request, pk):
+    if request.method != 'POST':
+        return redirect('query_optimizer:job_list')
+
+    updated = AnalysisJob.objects.using(capture_alias()).filter(
+        pk=pk, status__in=[AnalysisJob.STATUS_PENDING, AnalysisJob.STATUS_RUNNING]
+    ).update(status=AnalysisJob.STATUS_CANCELLED)
+    if updated:
+        messages.info(request, f'Analysis job #{pk} will stop after its current chunk.')
+    else:
+        messages.error(request, 'This job is not running.')
+    return redirect('query_optimizer:job_list')
+
+
+def metrics_view(request):
+    """
+    In-process query metrics in the Prometheus text format.
+
+    Reads no table. When `metrics_token` is set, scrapers must send it as a
+    bearer token.
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        raise Http404("Query metrics are off, set metrics in QUERY_OPTIMIZER_CONFIG")
+
+    token = getattr(settings, 'QUERY_OPTIMIZER_CONFIG', {}).get('metrics_token')
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return HttpResponse("Invalid metrics token", status=401, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,280 @@
+from django.db import close_old_connections
+from query_optimizer.sinks import capture_alias, get_config, persist_events
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue to ask the worker to flush and exit
+_STOP = None
+
+
+def _writer_loop(events_queue, batch_size, flush_interval, using, counters):
+    """
+    Drain capture events from `events_queue` and persist them in batches.
+
+    A batch is written once it holds `batch_size` events or `flush_interval`
+    seconds have passed since its first event. The loop flushes what it holds
+    and returns when it receives the stop sentinel.
+    """
+    batch = []
+    deadline = None
+    running = True
+
+    while running:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            event = events_queue.get(timeout=timeout)
+        except queue.Empty:
+            event = False
+
+        if event is _STOP:
+            running = False
+        elif event is not False:
+            batch.append(event)
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+
+        if batch and (not running or len(batch) >= batch_size or time.monotonic() >= deadline):
+            try:
+                persist_events(batch, using=using)
+                counters.add('written', len(batch))
+            except Exception as e:
+                counters.add('failed', len(batch))
+                logger.error(f"Query writer failed to persist {len(batch)} events: {str(e)}", exc_info=True)
+                close_old_connections()
+            batch = []
+            deadline = None
+
+
+class WriterCounters:
+    """Written/failed event counters of a writer running in this process"""
+
+    def __init__(self):
+        self.written = 0
+        self.failed = 0
+
+    def add(self, name, count):
+        setattr(self, name, getattr(self, name) + count)
+
+
+class SharedWriterCounters:
+    """Written/failed event counters shared with a writer process"""
+
+    def __init__(self, context):
+        self.values = {
+            'written': context.Value('q', 0),
+            'failed': context.Value('q', 0),
+        }
+
+    def add(self, name, count):
+        value = self.values[name]
+        with value.get_lock():
+            value.value += count
+
+    @property
+    def written(self):
+        return self.values['written'].value
+
+    @property
+    def failed(self):
+        return self.values['failed'].value
+
+
+class QueryWriter:
+    """
+    Base class for off-request writers.
+
+    The request thread only puts events on a bounded queue; it never blocks.
+    When the queue is full the event is dropped and counted.
+    """
+    mode = None
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=1.0, using=None):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.using = using
+        self.dropped = 0
+        self.queue = None
+        self.counters = None
+
+    def put(self, events):
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self, timeout=10.0):
+        raise NotImplementedError
+
+    def is_alive(self):
+        raise NotImplementedError
+
+    def depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues cannot report their size on macOS
+            return -1
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'alive': self.is_alive(),
+            'depth': self.depth(),
+            'dropped': self.dropped,
+            'written': self.counters.written,
+            'failed': self.counters.failed,
+        }
+
+
+class ThreadQueryWriter(QueryWriter):
+    """Persists capture events from a daemon thread with its own DB connection"""
+    mode = 'thread'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.queue = queue.Queue(maxsize=self.max_queue)
+        self.counters = WriterCounters()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='query-optimizer-writer',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self):
+        try:
+            _writer_loop(self.queue, self.batch_size, self.flush_interval, self.using, self.counters)
+        finally:
+            close_old_connections()
+
+    def stop(self, timeout=10.0):
+        if not self.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Query writer queue is full, some captured queries will be lost on shutdown")
+            return
+        self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+def _process_main(events_queue, batch_size, flush_interval, using, counters):
+    """Entry point of the writer process"""
+    import django
+    django.setup()
+
+    try:
+        _writer_loop(events_queue, batch_size, flush_interval, using, counters)
+    finally:
+        close_old_connections()
+
+
+class ProcessQueryWriter(QueryWriter):
+    """
+    Persists capture events from a separate worker process.
+
+    The worker is started with the `spawn` method by default so that it does
+    not inherit the application's threads or open database connections; it
+    sets Django up again from DJANGO_SETTINGS_MODULE.
+    """
+    mode = 'process'
+
+    def __init__(self, start_method='spawn', **kwargs):
+        super().__init__(**kwargs)
+        self.context = multiprocessing.get_context(start_method)
+        self.queue = self.context.Queue(maxsize=self.max_queue)
+        self.counters = SharedWriterCounters(self.context)
+        self._process = None
+
+    def start(self):
+        self._process = self.context.Process(
+            target=_process_main,
+            args=(self.queue, self.batch_size, self.flush_interval, self.using, self.counters),
+            name='query-optimizer-writer',
+            daemon=True,
+        )
+        self._process.start()
+
+    def stop(self, timeout=10.0):
+        if not self.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Query writer queue is full, some captured queries will be lost on shutdown")
+            return
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+
+WRITER_CLASSES = {
+    'thread': ThreadQueryWriter,
+    'process': ProcessQueryWriter,
+}
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Return the writer of the current process, starting it on first use.
+
+    A writer started before a fork is not usable in the child, so a new one
+    is started whenever the process id changes.
+    """
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer_pid != os.getpid():
+                config = get_config()
+                mode = config.get('persistence', 'thread')
+                if mode not in WRITER_CLASSES:
+                    raise ValueError(f"persistence mode {mode} does not use a background writer")
+
+                kwargs = {
+                    'max_queue': config.get('writer_max_queue', 10000),
+                    'batch_size': config.get('bulk_batch_size', 500),
+                    'flush_interval': config.get('writer_flush_interval', 1.0),
+                    'using': capture_alias(config),
+                }
+                if mode == 'process':
+                    kwargs['start_method'] = config.get('writer_start_method', 'spawn')
+
+                writer = WRITER_CLASSES[mode](**kwargs)
+                writer.start()
+                atexit.register(writer.stop)
+                _writer, _writer_pid = writer, os.getpid()
+    return _writer
+
+
+def shutdown_writer(timeout=10.0):
+    """Flush pending events and stop the writer of the current process"""
+    global _writer
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid():
+            _writer.stop(timeout)
+        _writer = None
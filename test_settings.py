@@ -0,0 +1,56 @@
+"""Settings the test suite runs with: python -m pytest, or django-admin test --settings=test_settings"""
+SECRET_KEY = 'tests'
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+USE_TZ = True
+ROOT_URLCONF = 'query_optimizer.tests'
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'query_optimizer',
+]
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+]
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
+
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+    # A second alias for the tests of the `database` option
+    'capture': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+}
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+QUERY_OPTIMIZER_CONFIG = {
+    'provider': 'openai',
+    'model': 'gpt-4o-mini',
+    'api_key': 'tests',
+    'n_plus_one_threshold': 0,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'loggers': {'query_optimizer': {'level': 'CRITICAL'}},
+}